@@ -7,6 +7,7 @@ from fastapi.middleware.cors import CORSMiddleware
 import whisper
 import tempfile
 import os
+import importlib.util
 from typing import Optional
 from enum import Enum
 import logging
@@ -15,33 +16,26 @@ import logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-# Try to import FunASR
-try:
-    from funasr import AutoModel
-    FUNASR_AVAILABLE = True
+# The optional engines are only imported when first used, which keeps the startup fast
+def is_installed(*modules: str) -> bool:
+    return all(importlib.util.find_spec(module) is not None for module in modules)
+
+FUNASR_AVAILABLE = is_installed("funasr")
+if FUNASR_AVAILABLE:
     logger.info("FunASR is available")
-except ImportError:
-    FUNASR_AVAILABLE = False
+else:
     logger.warning("FunASR not available. Install with: pip install funasr")
 
-# Try to import Faster Whisper
-try:
-    from faster_whisper import WhisperModel as FasterWhisperModel
-    FASTER_WHISPER_AVAILABLE = True
+FASTER_WHISPER_AVAILABLE = is_installed("faster_whisper")
+if FASTER_WHISPER_AVAILABLE:
     logger.info("Faster Whisper is available")
-except ImportError:
-    FASTER_WHISPER_AVAILABLE = False
+else:
     logger.warning("Faster Whisper not available. Install with: pip install faster-whisper")
 
-# Try to import Transformers (Wav2Vec2)
-try:
-    from transformers import Wav2Vec2Processor, Wav2Vec2ForCTC
-    import torch
-    import torchaudio
-    TRANSFORMERS_AVAILABLE = True
+TRANSFORMERS_AVAILABLE = is_installed("transformers", "torch", "torchaudio")
+if TRANSFORMERS_AVAILABLE:
     logger.info("Transformers (Wav2Vec2) is available")
-except ImportError:
-    TRANSFORMERS_AVAILABLE = False
+else:
     logger.warning("Transformers not available. Install with: pip install transformers torch torchaudio")
 
 app = FastAPI(
@@ -91,7 +85,10 @@ def get_whisper_model(model_size: str):
     """Load and cache Whisper model."""
     if model_size not in whisper_cache:
         logger.info(f"Loading Whisper model: {model_size}")
-        whisper_cache[model_size] = whisper.load_model(model_size)
+        # SHARED_WEIGHTS memory-maps the weights, shared by the workers of `uvicorn --workers`:
+        # the first worker loading the model makes the float32 copy, and the others map it
+        shared_weights = os.getenv('SHARED_WEIGHTS', 'false').lower() != 'false'
+        whisper_cache[model_size] = whisper.load_model(model_size, mmap=shared_weights)
     return whisper_cache[model_size]
 
 def get_funasr_model(model_name: str):
@@ -101,6 +98,7 @@ def get_funasr_model(model_name: str):
     
     if model_name not in funasr_cache:
         logger.info(f"Loading FunASR model: {model_name}")
+        from funasr import AutoModel
         funasr_cache[model_name] = AutoModel(model=model_name)
     return funasr_cache[model_name]
 
@@ -111,6 +109,7 @@ def get_faster_whisper_model(model_size: str):
     
     if model_size not in faster_whisper_cache:
         logger.info(f"Loading Faster Whisper model: {model_size}")
+        from faster_whisper import WhisperModel as FasterWhisperModel
         # Use CPU with 4 threads for better performance
         faster_whisper_cache[model_size] = FasterWhisperModel(
             model_size, 
@@ -127,6 +126,7 @@ def get_wav2vec2_model(model_name: str = "facebook/wav2vec2-base-960h"):
     
     if model_name not in wav2vec2_cache:
         logger.info(f"Loading Wav2Vec2 model: {model_name}")
+        from transformers import Wav2Vec2Processor, Wav2Vec2ForCTC
         processor = Wav2Vec2Processor.from_pretrained(model_name)
         model = Wav2Vec2ForCTC.from_pretrained(model_name)
         wav2vec2_cache[model_name] = {"processor": processor, "model": model}
@@ -298,6 +298,7 @@ async def transcribe_audio(
             # Load audio
             logger.info(f"Starting Wav2Vec2 transcription")
             import librosa
+            import torch
             speech, rate = librosa.load(temp_file_path, sr=16000)
             
             # Process audio
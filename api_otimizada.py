@@ -18,6 +18,9 @@ HOST = os.getenv('HOST', '0.0.0.0')
 PORT = int(os.getenv('PORT', 8001))
 MAX_FILE_SIZE = int(os.getenv('MAX_FILE_SIZE', 26214400))  # 25MB default
 LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO')
+WORKERS = int(os.getenv('MAX_WORKERS', 1))
+# Memory-map the weights, so that worker processes on the CPU share a single copy of the model
+SHARED_WEIGHTS = os.getenv('SHARED_WEIGHTS', 'true' if WORKERS > 1 else 'false').lower() != 'false'
 
 # Configure logging
 logging.basicConfig(
@@ -65,9 +68,18 @@ def get_model(model_size: str):
     """Load and cache Whisper model."""
     if model_size not in model_cache:
         logger.info(f"Loading Whisper model: {model_size}")
-        model_cache[model_size] = whisper.load_model(model_size)
+        model_cache[model_size] = whisper.load_model(model_size, mmap=SHARED_WEIGHTS)
     return model_cache[model_size]
 
+@app.on_event("startup")
+def warmup_default_model():
+    """Load and warm up the default model before serving, so that the first request is not slower."""
+    if os.getenv('WARMUP', 'true').lower() == 'false':
+        return
+    model_name = os.getenv('WHISPER_MODEL', 'base')
+    logger.info(f"Warming up Whisper model: {model_name}")
+    whisper.warmup(get_model(model_name), word_timestamps=True)
+
 def clean_repetitions(text: str) -> str:
     """Remove repetições excessivas do texto."""
     if not text:
@@ -153,6 +165,7 @@ async def transcribe_audio(
     compression_ratio_threshold: float = Form(2.4, description="Limite para detectar repetições"),
     logprob_threshold: float = Form(-1.0, description="Limite de probabilidade logarítmica"),
     no_speech_threshold: float = Form(0.6, description="Limite para detectar silêncio"),
+    repetition_threshold: Optional[int] = Form(None, description="Interromper a janela quando um trecho se repete N vezes seguidas"),
     condition_on_previous_text: bool = Form(True, description="Usar contexto anterior"),
     
     # Parâmetros de qualidade
@@ -171,6 +184,7 @@ async def transcribe_audio(
     **Parâmetros anti-repetição:**
     - **temperature**: 0.0 = mais determinístico (menos repetições)
     - **compression_ratio_threshold**: Detecta repetições (padrão: 2.4)
+    - **repetition_threshold**: Interrompe loops de repetição durante a decodificação
     - **condition_on_previous_text**: False reduz dependência de contexto ruim
     
     **Melhorias:**
@@ -204,12 +218,14 @@ async def transcribe_audio(
         
         # Parâmetros otimizados com environment variables defaults
         compression_ratio_threshold = compression_ratio_threshold if compression_ratio_threshold is not None else float(os.getenv('COMPRESSION_RATIO_THRESHOLD', 1.8))
+        repetition_threshold = repetition_threshold if repetition_threshold is not None else int(os.getenv('REPETITION_THRESHOLD', 0)) or None
         condition_on_previous_text = condition_on_previous_text if condition_on_previous_text is not None else os.getenv('CONDITION_ON_PREVIOUS_TEXT', 'false').lower() != 'false'
         
         transcription_options = {
             "language": language,
             "temperature": temperatures,
             "compression_ratio_threshold": compression_ratio_threshold,
+            "repetition_threshold": repetition_threshold,
             "logprob_threshold": logprob_threshold, 
             "no_speech_threshold": no_speech_threshold,
             "condition_on_previous_text": condition_on_previous_text,
@@ -275,6 +291,55 @@ async def transcribe_audio(
             except:
                 pass
 
+@app.post("/detect-language")
+async def detect_languages(
+    files: List[UploadFile] = File(...),
+    model: Optional[str] = Form(None, description="Whisper model to use"),
+    duration: float = Form(30.0, description="Segundos analisados no início de cada arquivo"),
+    top_k: int = Form(5, description="Quantidade de idiomas mais prováveis retornados")
+):
+    """
+    Identificar o idioma de vários arquivos de uma vez, sem transcrevê-los.
+
+    Apenas os primeiros `duration` segundos de cada arquivo são decodificados, e os
+    espectrogramas passam pelo encoder em lotes, com uma única passagem por arquivo.
+    """
+    temp_file_paths = []
+    try:
+        for file in files:
+            with tempfile.NamedTemporaryFile(delete=False, suffix=os.path.splitext(file.filename)[1]) as temp_file:
+                temp_file.write(await file.read())
+                temp_file_paths.append(temp_file.name)
+
+        model_name = model or os.getenv('WHISPER_MODEL', 'base')
+        whisper_model = get_model(model_name)
+        logger.info(f"Detecting language of {len(files)} files with model: {model_name}")
+
+        language_probs = whisper.detect_language_batch(whisper_model, temp_file_paths, duration=duration)
+
+        results = []
+        for file, probs in zip(files, language_probs):
+            ranked = sorted(probs.items(), key=lambda item: item[1], reverse=True)
+            results.append({
+                "filename": file.filename,
+                "language": ranked[0][0],
+                "probability": ranked[0][1],
+                "top_languages": dict(ranked[:top_k])
+            })
+
+        return JSONResponse(content={"engine": "whisper", "model": model_name, "results": results})
+
+    except Exception as e:
+        logger.error(f"Language detection failed: {str(e)}")
+        raise HTTPException(status_code=500, detail=f"Language detection failed: {str(e)}")
+
+    finally:
+        for temp_file_path in temp_file_paths:
+            try:
+                os.unlink(temp_file_path)
+            except:
+                pass
+
 @app.post("/add_correction")
 async def add_correction(
     wrong_word: str = Form(..., description="Palavra incorreta"),
@@ -543,4 +608,11 @@ if __name__ == "__main__":
     logger.info(f"🚀 Starting Whisper Enhanced API on {HOST}:{PORT}")
     logger.info(f"🎯 Default model: {os.getenv('WHISPER_MODEL', 'base')}")
     logger.info(f"🧹 Clean repetitions: {os.getenv('CLEAN_REPETITIONS', 'true')}")
-    uvicorn.run(app, host=HOST, port=PORT)
\ No newline at end of file
+    if SHARED_WEIGHTS:
+        # Download and convert the default model once, before the workers memory-map it
+        logger.info(f"🔗 Sharing the model weights between {WORKERS} workers")
+        whisper.load_model(os.getenv('WHISPER_MODEL', 'base'), device="cpu", mmap=True)
+    if WORKERS > 1:
+        uvicorn.run("api_otimizada:app", host=HOST, port=PORT, workers=WORKERS)
+    else:
+        uvicorn.run(app, host=HOST, port=PORT)
\ No newline at end of file
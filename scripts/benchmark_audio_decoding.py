@@ -0,0 +1,96 @@
+#!/usr/bin/env python3
+"""
+Benchmark of `load_audio` on the files of a folder, comparing the in-process decoding of WAV
+files, and of the formats of `soundfile` when it is installed, with the former ffmpeg subprocess
+for every file, after checking how close their waveforms are. WAV copies of each file, at
+16 kHz mono and 48 kHz stereo, are measured as well.
+
+    PYTHONPATH=. python scripts/benchmark_audio_decoding.py --audio_dir audios --repeat 5
+"""
+
+import argparse
+import os
+import statistics
+import subprocess
+import tempfile
+import time
+
+import numpy as np
+
+from whisper.audio import SAMPLE_RATE, _decode_in_process, load_audio
+
+
+def load_audio_ffmpeg(file: str):
+    """The previous implementation, which starts ffmpeg for every file"""
+    # fmt: off
+    cmd = [
+        "ffmpeg",
+        "-nostdin",
+        "-threads", "0",
+        "-i", file,
+        "-f", "s16le",
+        "-ac", "1",
+        "-acodec", "pcm_s16le",
+        "-ar", str(SAMPLE_RATE),
+        "-"
+    ]
+    # fmt: on
+    out = subprocess.run(cmd, capture_output=True, check=True).stdout
+    return np.frombuffer(out, np.int16).flatten().astype(np.float32) / 32768.0
+
+
+def convert(file: str, output: str, sr: int, channels: int):
+    cmd = ["ffmpeg", "-nostdin", "-y", "-i", file, "-ar", str(sr), "-ac", str(channels)]
+    subprocess.run(
+        [*cmd, "-acodec", "pcm_s16le", output], capture_output=True, check=True
+    )
+
+
+def measure(function, repeat: int) -> float:
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        timings.append(time.perf_counter() - start)
+    return statistics.median(timings)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--audio_dir", default="audios")
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    files = sorted(
+        os.path.join(args.audio_dir, name) for name in os.listdir(args.audio_dir)
+    )
+    with tempfile.TemporaryDirectory() as temp_dir:
+        for i, file in enumerate(list(files)):
+            for sr, channels in [(SAMPLE_RATE, 1), (48000, 2)]:
+                output = os.path.join(temp_dir, f"{i:02d}_{sr}_{channels}ch.wav")
+                convert(file, output, sr, channels)
+                files.append(output)
+
+        total_ffmpeg, total_load = 0.0, 0.0
+        for file in files:
+            expected, audio = load_audio_ffmpeg(file), load_audio(file)
+            length = min(len(expected), len(audio))
+            error = np.sum((audio[:length] - expected[:length]) ** 2)
+            snr = 10 * np.log10(np.sum(expected**2) / max(error, 1e-20))
+
+            ffmpeg = measure(lambda: load_audio_ffmpeg(file), args.repeat)
+            load = measure(lambda: load_audio(file), args.repeat)
+            total_ffmpeg, total_load = total_ffmpeg + ffmpeg, total_load + load
+            decoder = "in-process" if _decode_in_process(file) else "ffmpeg"
+            print(
+                f"{os.path.basename(file)[-44:]:>44} {len(audio) / SAMPLE_RATE:6.1f} s"
+                f" {decoder:>10}: {ffmpeg * 1e3:7.1f} ms -> {load * 1e3:7.1f} ms,"
+                f" {len(audio) - len(expected):+d} samples, SNR {snr:5.1f} dB"
+            )
+        print(
+            f"{'total':>44}: {total_ffmpeg * 1e3:.1f} ms -> {total_load * 1e3:.1f} ms"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,205 @@
+#!/usr/bin/env python3
+"""
+Micro-benchmark for `BeamSearchDecoder`, comparing the tensorized implementation with the
+former one building Python tuples and dicts for every candidate, after checking that both
+select the same beams and return the same finished sequences on random log probabilities.
+
+    PYTHONPATH=. python scripts/benchmark_beam_search.py --beam_size 5 --length 100
+"""
+
+import argparse
+import time
+from typing import List, Optional, Tuple
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+from torch import Tensor
+
+from whisper.decoding import BeamSearchDecoder, Inference
+
+
+class LoopedBeamSearchDecoder(BeamSearchDecoder):
+    """The previous implementation, which ranks the candidates in Python"""
+
+    def reset(self):
+        self.finished_sequences = None
+
+    def update(
+        self, tokens: Tensor, logits: Tensor, sum_logprobs: Tensor
+    ) -> Tuple[Tensor, bool]:
+        if tokens.shape[0] % self.beam_size != 0:
+            raise ValueError(f"{tokens.shape}[0] % {self.beam_size} != 0")
+
+        n_audio = tokens.shape[0] // self.beam_size
+        if self.finished_sequences is None:  # for the first update
+            self.finished_sequences = [{} for _ in range(n_audio)]
+
+        logprobs = F.log_softmax(logits.float(), dim=-1)
+        next_tokens, source_indices, finished_sequences = [], [], []
+        for i in range(n_audio):
+            scores, sources, finished = {}, {}, {}
+
+            # STEP 1: calculate the cumulative log probabilities for possible candidates
+            for j in range(self.beam_size):
+                idx = i * self.beam_size + j
+                prefix = tokens[idx].tolist()
+                for logprob, token in zip(*logprobs[idx].topk(self.beam_size + 1)):
+                    new_logprob = (sum_logprobs[idx] + logprob).item()
+                    sequence = tuple(prefix + [token.item()])
+                    scores[sequence] = new_logprob
+                    sources[sequence] = idx
+
+            # STEP 2: rank the candidates and keep the top beam_size sequences for each audio
+            saved = 0
+            for sequence in sorted(scores, key=scores.get, reverse=True):
+                if sequence[-1] == self.eot:
+                    finished[sequence] = scores[sequence]
+                else:
+                    sum_logprobs[len(next_tokens)] = scores[sequence]
+                    next_tokens.append(sequence)
+                    source_indices.append(sources[sequence])
+
+                    saved += 1
+                    if saved == self.beam_size:
+                        break
+
+            finished_sequences.append(finished)
+
+        tokens = torch.tensor(next_tokens, device=tokens.device)
+        self.inference.rearrange_kv_cache(source_indices)
+
+        # add newly finished sequences to self.finished_sequences
+        assert len(self.finished_sequences) == len(finished_sequences)
+        for previously_finished, newly_finished in zip(
+            self.finished_sequences, finished_sequences
+        ):
+            for seq in sorted(newly_finished, key=newly_finished.get, reverse=True):
+                if len(previously_finished) >= self.max_candidates:
+                    break  # the candidate list is full
+                previously_finished[seq] = newly_finished[seq]
+
+        # mark as completed if all audio has enough number of samples
+        completed = all(
+            len(sequences) >= self.max_candidates
+            for sequences in self.finished_sequences
+        )
+        return tokens, completed
+
+    def finalize(self, preceding_tokens: Tensor, sum_logprobs: Tensor):
+        # collect all finished sequences, including patience, and add unfinished ones if not enough
+        sum_logprobs = sum_logprobs.cpu()
+        for i, sequences in enumerate(self.finished_sequences):
+            if (
+                len(sequences) < self.beam_size
+            ):  # when not enough sequences are finished
+                for j in list(np.argsort(sum_logprobs[i]))[::-1]:
+                    sequence = preceding_tokens[i, j].tolist() + [self.eot]
+                    sequences[tuple(sequence)] = sum_logprobs[i][j].item()
+                    if len(sequences) >= self.beam_size:
+                        break
+
+        tokens: List[List[Tensor]] = [
+            [torch.tensor(seq) for seq in sequences.keys()]
+            for sequences in self.finished_sequences
+        ]
+        sum_logprobs: List[List[float]] = [
+            list(sequences.values()) for sequences in self.finished_sequences
+        ]
+        return tokens, sum_logprobs
+
+
+class RecordingInference(Inference):
+    """Records the beam rearrangements instead of updating a kv cache"""
+
+    def __init__(self):
+        self.source_indices = []
+
+    def rearrange_kv_cache(self, source_indices):
+        self.source_indices.append(list(source_indices))
+
+
+def random_logits(
+    generator, n_rows: int, n_vocab: int, eot: int, eot_bias: float, ties: bool
+):
+    """Logits with an adjustable chance of sampling EOT, optionally quantized to create ties"""
+    logits = torch.randn(n_rows, n_vocab, generator=generator)
+    if ties:
+        logits = logits.mul(4).round().div(2)
+    logits[:, eot] += eot_bias
+    return logits
+
+
+def run_search(decoder, initial_tokens, logit_steps):
+    decoder.reset()
+    tokens = initial_tokens.clone()
+    sum_logprobs = torch.zeros(tokens.shape[0], device=tokens.device)
+    for logits in logit_steps:
+        tokens, completed = decoder.update(tokens, logits.clone(), sum_logprobs)
+        if completed:
+            break
+    n_audio = tokens.shape[0] // decoder.beam_size
+    return decoder.finalize(
+        tokens.reshape(n_audio, decoder.beam_size, -1),
+        sum_logprobs.reshape(n_audio, decoder.beam_size),
+    )
+
+
+def check_equivalence(beam_size: int, patience: Optional[float], n_trials: int):
+    generator = torch.Generator().manual_seed(0)
+    n_vocab, eot, n_audio, length = 20, 0, 3, 30
+    for trial in range(n_trials):
+        eot_bias = float(trial % 4)
+        initial_tokens = torch.full((n_audio * beam_size, 3), n_vocab - 1)
+        logit_steps = [
+            random_logits(generator, n_audio * beam_size, n_vocab, eot, eot_bias, True)
+            for _ in range(length)
+        ]
+        # the initial beams are identical, and so are their logits
+        logit_steps[0] = logit_steps[0][::beam_size].repeat_interleave(beam_size, dim=0)
+
+        results = []
+        for decoder_class in [LoopedBeamSearchDecoder, BeamSearchDecoder]:
+            inference = RecordingInference()
+            decoder = decoder_class(beam_size, eot, inference, patience)
+            tokens, sum_logprobs = run_search(decoder, initial_tokens, logit_steps)
+            tokens = [[t.tolist() for t in sequences] for sequences in tokens]
+            results.append((tokens, sum_logprobs, inference.source_indices))
+
+        assert results[0] == results[1], f"beam search differs in trial {trial}"
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--beam_size", type=int, default=5)
+    parser.add_argument("--patience", type=float, default=None)
+    parser.add_argument("--length", type=int, default=100, help="decoding steps")
+    parser.add_argument("--n_vocab", type=int, default=51865)
+    parser.add_argument("--trials", type=int, default=200, help="equivalence checks")
+    parser.add_argument("--device", default="cpu")
+    args = parser.parse_args()
+
+    for patience in sorted({None, 2.0, args.patience}, key=lambda p: p or 0):
+        check_equivalence(args.beam_size, patience, args.trials)
+    print(f"identical results in {args.trials} random searches per patience value")
+
+    # EOT is never selected, so that every decoder runs for the full length
+    generator = torch.Generator().manual_seed(1)
+    logit_steps = [
+        random_logits(generator, args.beam_size, args.n_vocab, 0, -np.inf, False)
+        for _ in range(args.length)
+    ]
+    logit_steps = [logits.to(args.device) for logits in logit_steps]
+    initial_tokens = torch.full((args.beam_size, 3), 1, device=args.device)
+
+    for decoder_class in [LoopedBeamSearchDecoder, BeamSearchDecoder]:
+        decoder = decoder_class(args.beam_size, 0, RecordingInference(), args.patience)
+        start = time.perf_counter()
+        run_search(decoder, initial_tokens, logit_steps)
+        elapsed = time.perf_counter() - start
+        name = decoder_class.__name__
+        print(f"{name:>24}: {elapsed / args.length * 1e6:9.1f} us per step")
+
+
+if __name__ == "__main__":
+    main()
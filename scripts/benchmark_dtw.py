@@ -0,0 +1,78 @@
+#!/usr/bin/env python3
+"""
+Micro-benchmark for the DTW of word-level timestamps, comparing `dtw_cpu` and a serial build of
+it that releases the GIL with the anti-diagonal sweep of `dtw_cpu_banded`, over the whole cost
+matrix and within Sakoe-Chiba bands, after checking that the full sweeps return the same paths
+as `dtw_cpu`.
+
+    PYTHONPATH=. python scripts/benchmark_dtw.py --tokens 200 400 800 --frames 1500 --band 2.0
+"""
+
+import argparse
+import timeit
+
+import numba
+import numpy as np
+
+from whisper.audio import TOKENS_PER_SECOND
+from whisper.timing import (
+    backtrace,
+    dtw_cpu,
+    dtw_cpu_banded,
+    dtw_wavefront,
+    dtw_wavefront_parallel,
+    sakoe_chiba_band,
+)
+
+
+def alignment_matrix(n_tokens: int, n_frames: int) -> np.ndarray:
+    """Negative attention-like scores, peaking around a monotonic random path"""
+    centers = np.sort(np.random.rand(n_tokens)) * n_frames
+    frames = np.arange(n_frames)
+    scores = np.exp(-(((frames[None] - centers[:, None]) / 20) ** 2))
+    return -(scores + 0.3 * np.random.rand(n_tokens, n_frames))
+
+
+# the kernel the threads of `add_word_timestamps_batch` could run instead of `dtw_wavefront`
+dtw_cpu_serial = numba.jit(nopython=True, nogil=True)(dtw_cpu.py_func)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--tokens", type=int, nargs="+", default=[200, 400, 800])
+    parser.add_argument("--frames", type=int, default=1500, help="1500 for 30 seconds")
+    parser.add_argument("--band", type=float, default=2.0, help="radius in seconds")
+    parser.add_argument("--number", type=int, default=10, help="timed repetitions")
+    args = parser.parse_args()
+
+    np.random.seed(0)
+    for n_tokens in args.tokens:
+        x = alignment_matrix(n_tokens, args.frames)
+        expected = dtw_cpu(x)
+        lo = np.ones(n_tokens, dtype=np.int64)
+        hi = np.full(n_tokens, args.frames, dtype=np.int64)
+        for kernel in [dtw_wavefront, dtw_wavefront_parallel]:
+            assert np.array_equal(backtrace(kernel(x, lo, hi)), expected)
+        assert np.array_equal(dtw_cpu_serial(x), expected)
+        centers = (np.arange(n_tokens) + 0.5) * args.frames / n_tokens
+        band = sakoe_chiba_band(centers, args.band * TOKENS_PER_SECOND, args.frames)
+        cells = (band[1] - band[0] + 1).sum()
+
+        threads = numba.get_num_threads()
+        print(f"{n_tokens} tokens x {args.frames} frames, {threads} threads")
+        candidates = [
+            ("dtw_cpu", lambda: dtw_cpu(x)),
+            ("serial", lambda: dtw_cpu_serial(x)),
+            ("wavefront", lambda: backtrace(dtw_wavefront(x, lo, hi))),
+            ("full", lambda: dtw_cpu_banded(x)),
+            ("parallel", lambda: backtrace(dtw_wavefront_parallel(x, lo, hi))),
+            (f"banded {cells / x.size:.0%}", lambda: dtw_cpu_banded(x, band)),
+        ]
+        for name, function in candidates:
+            function()  # compile
+            seconds = timeit.timeit(function, number=args.number)
+            print(f"{name:>14}: {seconds / args.number * 1e3:9.2f} ms")
+
+
+if __name__ == "__main__":
+    main()
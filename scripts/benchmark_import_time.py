@@ -0,0 +1,66 @@
+#!/usr/bin/env python3
+"""
+Benchmark of the time to import `whisper` for a few uses, measured in fresh interpreters, next to
+importing every submodule as `import whisper` did before its attributes were imported lazily, and
+failing if the uses which need neither PyTorch nor numba import them again.
+
+    PYTHONPATH=. python scripts/benchmark_import_time.py --repeat 5
+"""
+
+import argparse
+import statistics
+import subprocess
+import sys
+
+STATEMENTS = {
+    "available_models": "import whisper; whisper.available_models()",
+    "tokenizer": "from whisper.tokenizer import get_tokenizer",
+    "transcribe": "import whisper; whisper.transcribe",
+    "word timestamps": "import whisper; import whisper.timing",
+    # the former `import whisper`, which imported every submodule
+    "eager": "import whisper.audio, whisper.decoding, whisper.model, whisper.transcribe, "
+    "whisper.timing",
+}
+LIGHT_STATEMENTS = ["available_models", "tokenizer"]
+HEAVY_MODULES = ["torch", "numba", "tiktoken", "tqdm", "triton"]
+
+PROBE = """
+import sys, time
+start = time.perf_counter()
+exec({statement!r})
+elapsed = time.perf_counter() - start
+print(elapsed, ",".join(m for m in {modules!r} if m in sys.modules))
+"""
+
+
+def measure(statement: str):
+    """Seconds to run the statement in a new interpreter, and the heavy modules it imported"""
+    code = PROBE.format(statement=statement, modules=HEAVY_MODULES)
+    output = subprocess.run(
+        [sys.executable, "-c", code], capture_output=True, check=True, text=True
+    ).stdout.split()
+    return float(output[0]), output[1].split(",") if len(output) > 1 else []
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--repeat", type=int, default=5, help="interpreters per use")
+    args = parser.parse_args()
+
+    regressions = []
+    for name, statement in STATEMENTS.items():
+        timings, modules = [], []
+        for _ in range(args.repeat):
+            elapsed, modules = measure(statement)
+            timings.append(elapsed)
+        imported = ", ".join(modules) or "-"
+        print(f"{name:>16}: {statistics.median(timings) * 1e3:8.1f} ms  ({imported})")
+        if name in LIGHT_STATEMENTS and {"torch", "numba"} & set(modules):
+            regressions.append(name)
+
+    if regressions:
+        sys.exit(f"PyTorch or numba is imported again by: {', '.join(regressions)}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,54 @@
+#!/usr/bin/env python3
+"""
+Micro-benchmark for `median_filter` on CPU, comparing the running median of `running_median`
+with the former median of sorted `unfold` windows on heads x tokens x frames tensors like the
+alignment weights of large-v3, after checking that both return identical values.
+
+    PYTHONPATH=. python scripts/benchmark_median_filter.py --heads 10 --tokens 200 --frames 1500
+"""
+
+import argparse
+import timeit
+
+import torch
+import torch.nn.functional as F
+
+from whisper.timing import median_filter
+
+
+def sorted_median_filter(x: torch.Tensor, filter_width: int):
+    """The previous implementation, which sorts every window"""
+    x = F.pad(x[None], (filter_width // 2, filter_width // 2, 0, 0), mode="reflect")
+    return x.unfold(-1, filter_width, 1).sort()[0][..., filter_width // 2][0]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--heads", type=int, default=10, help="10 for large-v3")
+    parser.add_argument("--tokens", type=int, default=200)
+    parser.add_argument("--frames", type=int, default=1500)
+    parser.add_argument("--widths", type=int, nargs="+", default=[7])
+    parser.add_argument("--number", type=int, default=10, help="timed repetitions")
+    args = parser.parse_args()
+
+    torch.manual_seed(0)
+    x = torch.randn(args.heads, args.tokens, args.frames).softmax(dim=-1)
+    x = (x - x.mean(dim=-2, keepdim=True)) / x.std(dim=-2, keepdim=True)
+
+    for filter_width in args.widths:
+        expected = sorted_median_filter(x, filter_width)
+        assert torch.equal(median_filter(x, filter_width), expected)
+        print(f"width {filter_width}, identical results on {tuple(x.shape)}")
+
+        for name, function in [
+            ("sorted", sorted_median_filter),
+            ("running", median_filter),
+        ]:
+            seconds = timeit.timeit(
+                lambda: function(x, filter_width), number=args.number
+            )
+            print(f"{name:>8}: {seconds / args.number * 1e3:9.2f} ms")
+
+
+if __name__ == "__main__":
+    main()
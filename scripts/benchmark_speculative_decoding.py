@@ -0,0 +1,88 @@
+#!/usr/bin/env python3
+"""
+Benchmark speculative decoding against plain greedy decoding on the audios/ corpus.
+
+Every file is transcribed twice with temperature 0, once with the main model alone and once
+with a smaller draft model proposing tokens, and the wall-clock times and whether the two
+transcriptions are identical are reported.
+
+    PYTHONPATH=. python scripts/benchmark_speculative_decoding.py --model large-v2 --draft_model base
+"""
+
+import argparse
+import glob
+import os
+import time
+
+import torch
+
+import whisper
+
+
+def transcribe_timed(model, audio, **kwargs):
+    if torch.cuda.is_available():
+        torch.cuda.synchronize()
+    start = time.perf_counter()
+    result = model.transcribe(audio, temperature=0.0, **kwargs)
+    if torch.cuda.is_available():
+        torch.cuda.synchronize()
+    return result, time.perf_counter() - start
+
+
+def main():
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--model", default="large-v2", help="main model")
+    parser.add_argument("--draft_model", default="base", help="draft model")
+    parser.add_argument("--draft_len", type=int, default=4, help="tokens per proposal")
+    parser.add_argument("--audio_dir", default=os.path.join(root, "audios"))
+    parser.add_argument("--language", default=None, help="skips language detection")
+    parser.add_argument("--device", default=None, help="defaults to cuda if available")
+    args = parser.parse_args()
+
+    model = whisper.load_model(args.model, device=args.device)
+    draft_model = whisper.load_model(args.draft_model, device=model.device)
+    options = dict(language=args.language, fp16=model.device.type == "cuda")
+
+    paths = sorted(glob.glob(os.path.join(args.audio_dir, "*")))
+    if not paths:
+        parser.error(f"no audio files found in {args.audio_dir}")
+
+    # warm up both models so that the first file is not penalized
+    audio = whisper.pad_or_trim(whisper.load_audio(paths[0]))
+    model.transcribe(audio, temperature=0.0, **options)
+    model.transcribe(audio, temperature=0.0, draft_model=draft_model, **options)
+
+    total_baseline = total_speculative = 0.0
+    print(f"{'file':<48} {'greedy':>8} {'spec.':>8} {'speedup':>8}  same")
+    for path in paths:
+        audio = whisper.load_audio(path)
+        baseline, baseline_time = transcribe_timed(model, audio, **options)
+        speculative, speculative_time = transcribe_timed(
+            model,
+            audio,
+            draft_model=draft_model,
+            draft_len=args.draft_len,
+            **options,
+        )
+        total_baseline += baseline_time
+        total_speculative += speculative_time
+
+        same = baseline["text"] == speculative["text"]
+        speedup = baseline_time / speculative_time
+        name = os.path.basename(path)[:48]
+        print(
+            f"{name:<48} {baseline_time:>7.2f}s {speculative_time:>7.2f}s "
+            f"{speedup:>7.2f}x  {same}"
+        )
+
+    speedup = total_baseline / total_speculative
+    print(
+        f"{'total':<48} {total_baseline:>7.2f}s {total_speculative:>7.2f}s "
+        f"{speedup:>7.2f}x"
+    )
+
+
+if __name__ == "__main__":
+    main()
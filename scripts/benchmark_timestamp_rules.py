@@ -0,0 +1,123 @@
+#!/usr/bin/env python3
+"""
+Micro-benchmark for `ApplyTimestampRules`, comparing the batched implementation with the
+former per-row Python loop on random token histories, after checking that both produce
+identical logits.
+
+    PYTHONPATH=. python scripts/benchmark_timestamp_rules.py --batch_size 5 --length 100
+"""
+
+import argparse
+import timeit
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+
+from whisper.decoding import ApplyTimestampRules
+from whisper.tokenizer import get_tokenizer
+
+
+class LoopedTimestampRules(ApplyTimestampRules):
+    """The previous implementation, which loops over the batch in Python"""
+
+    def apply(self, logits: torch.Tensor, tokens: torch.Tensor):
+        if self.tokenizer.no_timestamps is not None:
+            logits[:, self.tokenizer.no_timestamps] = -np.inf
+
+        for k in range(tokens.shape[0]):
+            sampled_tokens = tokens[k, self.sample_begin :]
+            seq = [t for t in sampled_tokens.tolist()]
+            last_was_timestamp = (
+                len(seq) >= 1 and seq[-1] >= self.tokenizer.timestamp_begin
+            )
+            penultimate_was_timestamp = (
+                len(seq) < 2 or seq[-2] >= self.tokenizer.timestamp_begin
+            )
+
+            if last_was_timestamp:
+                if penultimate_was_timestamp:
+                    logits[k, self.tokenizer.timestamp_begin :] = -np.inf
+                else:
+                    logits[k, : self.tokenizer.eot] = -np.inf
+
+            timestamps = sampled_tokens[
+                sampled_tokens.ge(self.tokenizer.timestamp_begin)
+            ]
+            if timestamps.numel() > 0:
+                if last_was_timestamp and not penultimate_was_timestamp:
+                    timestamp_last = timestamps[-1]
+                else:
+                    timestamp_last = timestamps[-1] + 1
+                logits[k, self.tokenizer.timestamp_begin : timestamp_last] = -np.inf
+
+        if tokens.shape[1] == self.sample_begin:
+            logits[:, : self.tokenizer.timestamp_begin] = -np.inf
+            if self.max_initial_timestamp_index is not None:
+                last_allowed = (
+                    self.tokenizer.timestamp_begin + self.max_initial_timestamp_index
+                )
+                logits[:, last_allowed + 1 :] = -np.inf
+
+        logprobs = F.log_softmax(logits.float(), dim=-1)
+        for k in range(tokens.shape[0]):
+            timestamp_logprob = logprobs[k, self.tokenizer.timestamp_begin :].logsumexp(
+                dim=-1
+            )
+            max_text_token_logprob = logprobs[k, : self.tokenizer.timestamp_begin].max()
+            if timestamp_logprob > max_text_token_logprob:
+                logits[k, : self.tokenizer.timestamp_begin] = -np.inf
+
+
+def random_history(tokenizer, batch_size: int, sample_begin: int, length: int):
+    """Token histories alternating text and increasing timestamp tokens"""
+    rows = []
+    for _ in range(batch_size):
+        row = list(tokenizer.sot_sequence)[:sample_begin]
+        timestamp = tokenizer.timestamp_begin
+        while len(row) < sample_begin + length:
+            if np.random.rand() < 0.15:
+                timestamp += np.random.randint(0, 20)
+                row.append(min(timestamp, tokenizer.timestamp_begin + 1500))
+            else:
+                row.append(np.random.randint(0, tokenizer.eot))
+        rows.append(row)
+    return torch.tensor(rows)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--batch_size", type=int, default=5, help="e.g. the beam size")
+    parser.add_argument("--length", type=int, default=100, help="sampled tokens")
+    parser.add_argument("--number", type=int, default=200, help="timed repetitions")
+    parser.add_argument("--device", default="cpu")
+    args = parser.parse_args()
+
+    np.random.seed(0)
+    tokenizer = get_tokenizer(multilingual=True, language="en", task="transcribe")
+    sample_begin = len(tokenizer.sot_sequence)
+    n_vocab = tokenizer.timestamp_begin + 1501
+    batched = ApplyTimestampRules(tokenizer, sample_begin, 50)
+    looped = LoopedTimestampRules(tokenizer, sample_begin, 50)
+
+    # check the equivalence on every prefix length, including the first step
+    tokens = random_history(tokenizer, args.batch_size, sample_begin, args.length)
+    tokens = tokens.to(args.device)
+    for n in range(sample_begin, tokens.shape[1] + 1):
+        logits = torch.randn(args.batch_size, n_vocab, device=args.device) * 5
+        expected, actual = logits.clone(), logits.clone()
+        looped.apply(expected, tokens[:, :n])
+        batched.apply(actual, tokens[:, :n])
+        assert torch.equal(expected, actual), f"logits differ at length {n}"
+    print(f"identical logits for {tokens.shape[1] - sample_begin + 1} prefix lengths")
+
+    logits = torch.randn(args.batch_size, n_vocab, device=args.device)
+    for name, rules in [("looped", looped), ("batched", batched)]:
+        seconds = timeit.timeit(
+            lambda: rules.apply(logits.clone(), tokens), number=args.number
+        )
+        print(f"{name:>8}: {seconds / args.number * 1e6:9.1f} us per step")
+
+
+if __name__ == "__main__":
+    main()
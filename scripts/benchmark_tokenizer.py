@@ -0,0 +1,82 @@
+#!/usr/bin/env python3
+"""
+Benchmark of the tokenizer initialization, comparing the encoding built from the binary ranks
+cache with the former parsing of the `.tiktoken` vocabulary, line by line, after checking that
+both give the same ranks.
+
+    PYTHONPATH=. python scripts/benchmark_tokenizer.py --repeat 10
+"""
+
+import argparse
+import base64
+import os
+import statistics
+import tempfile
+import time
+
+import tiktoken
+
+from whisper.tokenizer import load_ranks
+
+ASSETS = os.path.join(os.path.dirname(__file__), "..", "whisper", "assets")
+PAT_STR = (
+    r"""'s|'t|'re|'ve|'m|'ll|'d| ?\p{L}+| ?\p{N}+| ?[^\s\p{L}\p{N}]+|\s+(?!\S)|\s+"""
+)
+
+
+def parse_ranks(vocab_path: str):
+    """The previous implementation, which base64-decodes every line of the vocabulary"""
+    return {
+        base64.b64decode(token): int(rank)
+        for token, rank in (line.split() for line in open(vocab_path) if line)
+    }
+
+
+def measure(function, repeat: int) -> float:
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        timings.append(time.perf_counter() - start)
+    return statistics.median(timings)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument(
+        "--name", default="multilingual", choices=["multilingual", "gpt2"]
+    )
+    parser.add_argument("--repeat", type=int, default=10)
+    args = parser.parse_args()
+
+    vocab_path = os.path.join(ASSETS, f"{args.name}.tiktoken")
+    with tempfile.TemporaryDirectory() as cache_dir:
+        expected = parse_ranks(vocab_path)
+        first = time.perf_counter()
+        assert load_ranks(vocab_path, cache_dir) == expected  # writes the cache
+        first = time.perf_counter() - first
+        assert load_ranks(vocab_path, cache_dir) == expected
+        print(f"identical ranks; writing the cache took {first * 1e3:.1f} ms")
+
+        def encoding(ranks):
+            return tiktoken.Encoding(
+                name=args.name,
+                pat_str=PAT_STR,
+                mergeable_ranks=ranks,
+                special_tokens={},
+            )
+
+        for name, load in [
+            ("parsed", lambda: parse_ranks(vocab_path)),
+            ("cached", lambda: load_ranks(vocab_path, cache_dir)),
+        ]:
+            ranks_time = measure(load, args.repeat)
+            total_time = measure(lambda: encoding(load()), args.repeat)
+            print(
+                f"{name:>8}: ranks {ranks_time * 1e3:6.1f} ms, "
+                f"with the encoding {total_time * 1e3:6.1f} ms"
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -2,6 +2,9 @@ import random as rand
 
 import numpy
 import pytest
+import torch
+
+from whisper.model import ModelDimensions, Whisper
 
 
 def pytest_configure(config):
@@ -12,3 +15,32 @@ def pytest_configure(config):
 def random():
     rand.seed(42)
     numpy.random.seed(42)
+
+
+@pytest.fixture
+def random_model():
+    def build(n_layer: int = 2, n_state: int = 64, n_vocab: int = 51865) -> Whisper:
+        dims = ModelDimensions(
+            n_mels=80,
+            n_audio_ctx=1500,
+            n_audio_state=n_state,
+            n_audio_head=2,
+            n_audio_layer=n_layer,
+            n_vocab=n_vocab,
+            n_text_ctx=448,
+            n_text_state=n_state,
+            n_text_head=2,
+            n_text_layer=n_layer,
+        )
+        model = Whisper(dims).eval()
+        # the text positional embedding is allocated uninitialized, as it is always loaded
+        torch.nn.init.normal_(model.decoder.positional_embedding, std=0.02)
+        return model
+
+    return build
+
+
+@pytest.fixture
+def model(random_model):
+    torch.manual_seed(0)
+    return random_model()
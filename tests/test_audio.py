@@ -1,8 +1,23 @@
 import os.path
+import wave
 
 import numpy as np
+import pytest
+import torch
 
-from whisper.audio import SAMPLE_RATE, load_audio, log_mel_spectrogram
+import whisper.audio
+from whisper.audio import (
+    N_SAMPLES,
+    SAMPLE_RATE,
+    LogMelStream,
+    cached_log_mel_spectrogram,
+    load_audio,
+    load_audio_chunks,
+    log_mel_spectrogram,
+    prefetch_audio,
+    resample,
+    speech_activity,
+)
 
 
 def test_audio():
@@ -17,3 +32,151 @@ def test_audio():
 
     assert np.allclose(mel_from_audio, mel_from_file)
     assert mel_from_audio.max() - mel_from_audio.min() <= 2.0
+
+    # only the beginning of the file is decoded when a duration is given
+    head = load_audio(audio_path, duration=2.5)
+    assert head.shape[0] == SAMPLE_RATE * 5 // 2
+    # up to the resampling filter at the cut
+    assert np.allclose(head[:-100], audio[: head.shape[0] - 100], atol=1e-4)
+
+
+@pytest.mark.parametrize("prefetch", [0, 2])
+def test_prefetch_audio(prefetch):
+    audio_path = os.path.join(os.path.dirname(__file__), "jfk.flac")
+    missing_path = os.path.join(os.path.dirname(__file__), "missing.flac")
+    files = [audio_path, missing_path, audio_path]
+
+    results = list(prefetch_audio(files, prefetch))
+    assert [file for file, _ in results] == files
+
+    # a file failing to decode only raises when its result is requested
+    assert np.array_equal(results[0][1].result(), load_audio(audio_path))
+    with pytest.raises(RuntimeError):
+        results[1][1].result()
+    assert np.array_equal(results[2][1].result(), results[0][1].result())
+
+
+@pytest.mark.parametrize("padding", [0, N_SAMPLES])
+def test_log_mel_stream(padding):
+    audio_path = os.path.join(os.path.dirname(__file__), "jfk.flac")
+    chunks = list(load_audio_chunks(audio_path, chunk_length=SAMPLE_RATE))
+    assert all(len(chunk) == SAMPLE_RATE for chunk in chunks[:-1])
+    audio = np.concatenate(chunks)
+    with pytest.raises(RuntimeError):
+        list(load_audio_chunks(os.path.join(os.path.dirname(__file__), "missing.flac")))
+
+    mel = log_mel_spectrogram(audio, padding=padding)
+    stream = LogMelStream(audio_path, padding=padding, chunk_length=3333)
+    assert stream.shape == tuple(mel.shape)
+
+    # forward slices read the file once, and slices of forgotten frames read it again
+    for start, end in [(0, 100), (50, 1200), (1100, None), (10, 20)]:
+        assert torch.allclose(stream[:, start:end], mel[:, start:end], atol=1e-6)
+
+    speech = speech_activity(mel, end=1000)
+    assert torch.equal(speech_activity(stream, end=1000), speech)
+    assert torch.equal(speech_activity(mel[:, :1000]), speech)
+
+
+def test_cached_log_mel_spectrogram(tmp_path):
+    audio_path = os.path.join(os.path.dirname(__file__), "jfk.flac")
+    cache_dir = tmp_path / "mel"
+    mel = log_mel_spectrogram(audio_path, padding=N_SAMPLES)
+
+    cached = cached_log_mel_spectrogram(
+        audio_path, padding=N_SAMPLES, cache_dir=cache_dir
+    )
+    assert cached.dtype == torch.float16
+    assert torch.allclose(cached.float(), mel, atol=1e-3)
+    assert len(os.listdir(cache_dir)) == 1
+
+    # a copy of the file is read from the cache, but not with another number of Mel bins
+    copy_path = tmp_path / "copy.flac"
+    with open(audio_path, "rb") as f:
+        copy_path.write_bytes(f.read())
+    copied = cached_log_mel_spectrogram(
+        str(copy_path), padding=N_SAMPLES, cache_dir=cache_dir
+    )
+    assert torch.equal(copied, cached)
+    assert len(os.listdir(cache_dir)) == 1
+
+    cached_log_mel_spectrogram(
+        str(copy_path), 128, padding=N_SAMPLES, cache_dir=cache_dir
+    )
+    assert len(os.listdir(cache_dir)) == 2
+
+    # float32 copies are exact, and the least recently used copies are evicted
+    (oldest,) = [path for path in cache_dir.iterdir() if "-128-" in path.name]
+    os.utime(oldest, ns=(0, 0))
+    exact = cached_log_mel_spectrogram(
+        audio_path,
+        padding=N_SAMPLES,
+        dtype=torch.float32,
+        cache_dir=cache_dir,
+        max_size=3 * cached.numel() * 2 + 1024,
+    )
+    assert torch.equal(exact, mel)
+    assert not oldest.exists()
+    assert len(os.listdir(cache_dir)) == 2
+
+
+def write_wav(path, audio: np.ndarray, sr: int, channels: int = 1):
+    with wave.open(str(path), "wb") as f:
+        f.setnchannels(channels)
+        f.setsampwidth(2)
+        f.setframerate(sr)
+        samples = np.repeat(audio[:, None], channels, axis=1)
+        f.writeframes(np.round(samples * 32767).astype("<i2").tobytes())
+
+
+def test_load_audio_in_process(tmp_path, monkeypatch):
+    audio = load_audio(os.path.join(os.path.dirname(__file__), "jfk.flac"))
+    write_wav(tmp_path / "mono.wav", audio, SAMPLE_RATE)
+    write_wav(tmp_path / "stereo.wav", resample(audio, SAMPLE_RATE, 48000), 48000, 2)
+    (tmp_path / "broken.wav").write_bytes(b"RIFF")
+
+    # ffmpeg is not needed for WAV files, but decodes the files that are not
+    def ffmpeg(*args, **kwargs):
+        raise RuntimeError("ffmpeg should not run")
+
+    monkeypatch.setattr(whisper.audio, "run", ffmpeg)
+    monkeypatch.setattr(whisper.audio, "Popen", ffmpeg)
+    expected = np.round(audio * 32767) / 32768
+    assert np.array_equal(load_audio(str(tmp_path / "mono.wav")), expected)
+    assert np.array_equal(
+        load_audio(str(tmp_path / "mono.wav"), duration=2.5),
+        expected[: SAMPLE_RATE * 5 // 2],
+    )
+
+    stereo = load_audio(str(tmp_path / "stereo.wav"))
+    assert stereo.shape == audio.shape
+    assert np.allclose(stereo, audio, atol=5e-3)
+
+    # streaming goes through the same decoder and resampler
+    chunks = list(load_audio_chunks(str(tmp_path / "stereo.wav"), chunk_length=7000))
+    assert all(len(chunk) == 7000 for chunk in chunks[:-1])
+    assert np.allclose(np.concatenate(chunks), stereo, atol=1e-6)
+
+    with pytest.raises(RuntimeError, match="ffmpeg should not run"):
+        load_audio(str(tmp_path / "broken.wav"))
+
+
+def test_load_audio_soundfile(tmp_path, monkeypatch):
+    soundfile = pytest.importorskip("soundfile")
+    audio = load_audio(os.path.join(os.path.dirname(__file__), "jfk.flac"))
+    soundfile.write(
+        str(tmp_path / "audio.flac"), resample(audio, SAMPLE_RATE, 22050), 22050
+    )
+
+    def ffmpeg(*args, **kwargs):
+        raise RuntimeError("ffmpeg should not run")
+
+    monkeypatch.setattr(whisper.audio, "run", ffmpeg)
+    monkeypatch.setattr(whisper.audio, "Popen", ffmpeg)
+    decoded = load_audio(str(tmp_path / "audio.flac"))
+    assert decoded.shape == audio.shape
+    assert np.allclose(decoded, audio, atol=5e-3)
+    assert len(load_audio(str(tmp_path / "audio.flac"), duration=2.5)) == 40000
+
+    chunks = list(load_audio_chunks(str(tmp_path / "audio.flac"), chunk_length=7000))
+    assert np.allclose(np.concatenate(chunks), decoded, atol=1e-6)
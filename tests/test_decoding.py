@@ -0,0 +1,348 @@
+import copy
+import os.path
+
+import numpy as np
+import pytest
+import torch
+
+import whisper
+from whisper.audio import (
+    N_FRAMES,
+    N_SAMPLES,
+    SAMPLE_RATE,
+    log_mel_spectrogram,
+    pad_or_trim,
+)
+from whisper.decoding import (
+    ApplyTimestampRules,
+    BeamSearchDecoder,
+    Inference,
+    StopRepetitions,
+    SuppressTokens,
+    detect_language_windows,
+    suppression_mask,
+)
+from whisper.model import disable_sdpa
+from whisper.tokenizer import get_tokenizer
+
+
+@pytest.fixture
+def mel():
+    torch.manual_seed(1)
+    return torch.randn(2, 80, 3000)
+
+
+@pytest.mark.parametrize("without_timestamps", [False, True])
+def test_speculative_decoding(model, random_model, mel, without_timestamps: bool):
+    options = whisper.DecodingOptions(
+        fp16=False, sample_len=64, without_timestamps=without_timestamps
+    )
+    expected = whisper.decode(model, mel, options)
+
+    # an identical draft model has every proposal accepted, a random one almost none
+    torch.manual_seed(2)
+    for draft_model in [copy.deepcopy(model), random_model(n_layer=1, n_state=32)]:
+        for draft_len in [1, 4]:
+            results = whisper.decode(
+                model, mel, options, draft_model=draft_model, draft_len=draft_len
+            )
+            for result, reference in zip(results, expected):
+                assert result.tokens == reference.tokens
+                assert result.avg_logprob == pytest.approx(
+                    reference.avg_logprob, abs=1e-4
+                )
+                assert result.no_speech_prob == pytest.approx(
+                    reference.no_speech_prob, abs=1e-4
+                )
+
+
+def test_speculative_decoding_options(model, mel):
+    with pytest.raises(ValueError):
+        whisper.decode(model, mel, fp16=False, draft_model=model)
+    with pytest.raises(ValueError):
+        draft_model = copy.deepcopy(model)
+        whisper.decode(model, mel, fp16=False, draft_model=draft_model, beam_size=5)
+
+
+def test_apply_timestamp_rules():
+    tokenizer = get_tokenizer(multilingual=True, language="en", task="transcribe")
+    sample_begin = len(tokenizer.sot_sequence)
+    rules = ApplyTimestampRules(tokenizer, sample_begin, None)
+    text, timestamp = 100, tokenizer.timestamp_begin
+
+    histories = [
+        [text, timestamp + 5, timestamp + 5],  # a segment was closed
+        [timestamp + 5, text, timestamp + 7],  # a segment was opened
+        [timestamp + 3, text, text],  # a segment is open
+        [text, text, text],  # no timestamps at all
+    ]
+    tokens = torch.tensor([list(tokenizer.sot_sequence) + h for h in histories])
+    logits = torch.zeros(len(histories), timestamp + 1501)
+    logits[:, text] = 10.0
+    rules.apply(logits, tokens)
+
+    # a single sequence takes another path, which gives the same logits
+    for i in range(len(histories)):
+        single = torch.zeros(1, timestamp + 1501)
+        single[:, text] = 10.0
+        rules.apply(single, tokens[i : i + 1])
+        assert torch.equal(single[0], logits[i])
+    initial_rules = ApplyTimestampRules(tokenizer, sample_begin, 50)
+    batch = torch.randn(2, timestamp + 1501)
+    single = batch[:1].clone()
+    initial_rules.apply(batch, tokens[:2, :sample_begin])
+    initial_rules.apply(single, tokens[:1, :sample_begin])
+    assert torch.equal(single[0], batch[0])
+
+    suppressed = logits.isinf()
+    assert suppressed[:, tokenizer.no_timestamps].all()
+
+    assert not suppressed[0, : tokenizer.eot].any()
+    assert suppressed[0, timestamp:].all()
+
+    assert suppressed[1, : tokenizer.eot].all()
+    assert suppressed[1, timestamp : timestamp + 7].all()
+    assert not suppressed[1, timestamp + 7 :].any()
+
+    assert suppressed[2, timestamp : timestamp + 4].all()
+    assert not suppressed[2, timestamp + 4 :].any()
+
+    assert not suppressed[3, : tokenizer.eot].any()
+    assert not suppressed[3, timestamp:].any()
+
+
+def test_suppress_tokens():
+    suppress_tokens = SuppressTokens([5, 3, 11])
+    logits = torch.randn(3, 20)
+    expected = logits.clone()
+    expected[:, [3, 5, 11]] = -np.inf
+
+    suppress_tokens.apply(logits, torch.zeros(3, 1, dtype=torch.long))
+    assert torch.equal(logits, expected)
+    assert suppression_mask((5, 3, 11), 20, logits.device) is suppression_mask(
+        (5, 3, 11), 20, logits.device
+    )
+    for n_vocab in range(21, 41):
+        suppression_mask((5, 3, 11), n_vocab, logits.device)
+    assert suppression_mask.cache_info().currsize <= 8
+
+
+def test_decoding_task_set_prompt(model, mel):
+    tokenizer = get_tokenizer(multilingual=True, language="en", task="transcribe")
+    options = whisper.DecodingOptions(language="en", fp16=False, sample_len=32)
+    task = whisper.decoding.DecodingTask(model, options)
+
+    for prompt in [tokenizer.encode(" hello world"), None, [220, 50400, 100]]:
+        expected = whisper.decode(model, mel, options, prompt=prompt)
+        task.set_prompt(prompt)
+        results = task.run(mel)
+        assert [r.tokens for r in results] == [r.tokens for r in expected]
+
+
+class SourceInference(Inference):
+    def rearrange_kv_cache(self, source_indices):
+        self.source_indices = source_indices
+
+
+def test_beam_search_decoder():
+    inference = SourceInference()
+    decoder = BeamSearchDecoder(2, 0, inference)
+    tokens = torch.tensor([[3], [3]])
+    sum_logprobs = torch.zeros(2)
+
+    # the identical initial beams propose their candidates once; EOT ranks first
+    logits = torch.tensor([[0.6, 0.3, 0.1], [0.6, 0.3, 0.1]]).log()
+    tokens, completed = decoder.update(tokens, logits, sum_logprobs)
+    assert tokens.tolist() == [[3, 1], [3, 2]] and not completed
+    assert inference.source_indices == [1, 1]
+
+    # both EOT candidates rank above the beams, but only one more fits the candidates
+    logits = torch.tensor([[0.5, 0.25, 0.25], [0.9, 0.05, 0.05]]).log()
+    tokens, completed = decoder.update(tokens, logits, sum_logprobs)
+    assert tokens.tolist() == [[3, 1, 1], [3, 1, 2]] and completed
+    assert inference.source_indices == [0, 0]
+
+    sequences, scores = decoder.finalize(tokens[None], sum_logprobs[None])
+    assert [t.tolist() for t in sequences[0]] == [[3, 0], [3, 1, 0]]
+    assert scores[0] == pytest.approx(np.log([0.6, 0.15]))
+
+
+def test_stop_repetitions():
+    tokenizer = get_tokenizer(multilingual=True, language="en", task="transcribe")
+    sample_begin = len(tokenizer.sot_sequence)
+    stop = StopRepetitions(tokenizer, sample_begin, threshold=3, max_ngram=4)
+    a, b, c, timestamp = 100, 200, 300, tokenizer.timestamp_begin
+
+    histories = [
+        [c, a, b, c, a, b, c, a, b],  # a trigram repeated three times
+        [a, b, c, a, b, c, a, b, c, b],  # not ending with the repeated n-gram
+        [a, timestamp + 4, b, a, timestamp + 9, b, a, timestamp + 20, b],  # timestamps
+        [c, c, a, b, a, b, a, b, a, b, c],  # a bigram repeated, then interrupted
+        [b, a, b, a, b, a, b, a, b, a, b],  # a repeated n-gram longer than max_ngram
+    ]
+    length = max(map(len, histories))
+    tokens = torch.tensor(
+        [list(tokenizer.sot_sequence) + [b] * (length - len(h)) + h for h in histories]
+    )
+    assert stop.detect(tokens).tolist() == [True, False, True, False, True]
+
+    # the prompt before sample_begin is not considered
+    assert not stop.detect(tokens[:, : sample_begin + 2]).any()
+
+    logits = torch.randn(len(histories), timestamp + 1501)
+    stop.apply(logits, tokens)
+    assert (logits[[0, 2, 4]].argmax(dim=-1) == tokenizer.eot).all()
+    assert logits[[0, 2, 4]].isinf().sum(dim=-1).tolist() == [logits.shape[-1] - 1] * 3
+    assert not logits[[1, 3]].isinf().any()
+
+    # the two timestamps closing a segment are not a repeated unigram
+    stop = StopRepetitions(tokenizer, sample_begin, threshold=2, max_ngram=4)
+    histories = [
+        [timestamp, a, b, c, timestamp + 50, timestamp + 50],
+        [timestamp, a, b, timestamp + 50, timestamp + 50, c, b, timestamp + 90],
+        [timestamp, c, a, timestamp + 50, a, timestamp + 90],
+    ]
+    tokens = torch.tensor(
+        [list(tokenizer.sot_sequence) + [b] * (8 - len(h)) + h for h in histories]
+    )
+    assert stop.detect(tokens).tolist() == [False, False, True]
+
+
+def test_repetition_threshold(model, mel):
+    options = whisper.DecodingOptions(fp16=False, without_timestamps=True)
+    for result in whisper.decode(model, mel, options):
+        assert len(result.tokens) == 224 and not result.repetitive
+
+    # the random model is stuck repeating a single token, which stops the decoding early
+    for result in whisper.decode(model, mel, options, repetition_threshold=5):
+        assert len(result.tokens) == 5 and result.repetitive
+
+
+@pytest.mark.parametrize(
+    "sampling", [dict(), dict(beam_size=3), dict(temperature=1.0, best_of=3)]
+)
+def test_capture_alignment(model, mel, sampling: dict):
+    tokenizer = get_tokenizer(multilingual=True, language="en", task="transcribe")
+    text_tokens = [220, 262, 286, 290, 318, 257]
+    suppress_tokens = [t for t in range(model.dims.n_vocab) if t not in text_tokens]
+
+    # flatten the output distribution, sample from a few text tokens, and stop on repetitions
+    model = copy.deepcopy(model)
+    with torch.no_grad():
+        model.decoder.token_embedding.weight.mul_(0.05)
+    torch.manual_seed(3)
+    options = whisper.DecodingOptions(
+        language="en",
+        fp16=False,
+        without_timestamps=True,
+        suppress_tokens=suppress_tokens,
+        repetition_threshold=3,
+        repetition_max_ngram=2,
+        capture_alignment=True,
+        **sampling,
+    )
+    result = whisper.decode(model, mel[0], options)
+    assert len(result.tokens) > 0
+
+    # the same context as the additional forward pass of `find_alignment`
+    tokens = [*tokenizer.sot_sequence_including_notimestamps, *result.tokens]
+    tokens = torch.tensor([tokens + [tokenizer.eot]])
+    QKs = [None] * model.dims.n_text_layer
+    hooks = [
+        block.cross_attn.register_forward_hook(
+            lambda _, ins, outs, index=i: QKs.__setitem__(index, outs[-1][0])
+        )
+        for i, block in enumerate(model.decoder.blocks)
+    ]
+    with torch.no_grad(), disable_sdpa():
+        logits = model(mel[:1], tokens)[0, len(tokenizer.sot_sequence) : -1]
+    for hook in hooks:
+        hook.remove()
+
+    heads = model.alignment_heads.indices().T
+    expected = torch.stack([QKs[_l][_h] for _l, _h in heads])
+    expected = expected[:, len(tokenizer.sot_sequence) : -1]
+    assert torch.allclose(result.alignment_weights, expected, atol=1e-4)
+
+    probs = logits[:-1, : tokenizer.eot].softmax(dim=-1)
+    probs = probs[np.arange(len(result.tokens)), result.tokens]
+    assert result.token_probs == pytest.approx(probs.tolist(), abs=1e-6)
+
+
+def test_detect_language_batch(model):
+    audio_path = os.path.join(os.path.dirname(__file__), "jfk.flac")
+    audio = whisper.load_audio(audio_path)
+    rng = np.random.default_rng(0)
+    noise = rng.standard_normal(SAMPLE_RATE * 40).astype(np.float32) * 0.1
+    inputs = [audio_path, noise, torch.from_numpy(audio[: SAMPLE_RATE * 3])]
+
+    for duration in [30, 5]:
+        results = whisper.detect_language_batch(
+            model, inputs, duration=duration, batch_size=2, fp16=False
+        )
+        assert len(results) == len(inputs)
+
+        for item, result in zip([audio, noise, audio[: SAMPLE_RATE * 3]], results):
+            mel = log_mel_spectrogram(item[: SAMPLE_RATE * duration], padding=N_SAMPLES)
+            _, expected = whisper.detect_language(model, pad_or_trim(mel, N_FRAMES))
+            assert result.keys() == expected.keys()
+            assert sum(result.values()) == pytest.approx(1.0, abs=1e-4)
+            for language, probability in expected.items():
+                assert result[language] == pytest.approx(probability, abs=1e-4)
+
+
+def test_detect_language_windows(model):
+    torch.manual_seed(4)
+    mels = list(torch.randn(5, 80, 3000))
+    weights = [0.0, 0.5, 1.0, 0.25, 0.5]
+    features = model.encoder(torch.stack(mels))
+    _, expected = whisper.detect_language(model, features)
+
+    # without an early exit, the weighted average of every window
+    probs, first_features = detect_language_windows(
+        model, mels, weights, threshold=1.01, batch_size=3
+    )
+    for language, probability in probs.items():
+        average = sum(w * p[language] for w, p in zip(weights, expected)) / sum(weights)
+        assert probability == pytest.approx(average, abs=1e-5)
+    assert torch.allclose(first_features, features[0], atol=1e-4)
+
+    # a confident first window is the only one encoded
+    probs, _ = detect_language_windows(model, mels, [1.0] * 5, threshold=0.0)
+    assert probs == pytest.approx(expected[0], abs=1e-5)
+
+
+@pytest.mark.parametrize("language_detection_windows", [1, 3])
+def test_language_detection_first_window(model, language_detection_windows: int):
+    audio_path = os.path.join(os.path.dirname(__file__), "jfk.flac")
+    audio = whisper.load_audio(audio_path)
+    silence = np.zeros(SAMPLE_RATE * 25, dtype=np.float32)
+    audio = np.concatenate([silence, audio, silence, audio])
+
+    encoder_calls = []
+    model.encoder.register_forward_hook(lambda *_: encoder_calls.append(1))
+    options = dict(
+        temperature=0.0,
+        fp16=False,
+        sample_len=8,
+        condition_on_previous_text=False,
+        compression_ratio_threshold=None,
+        logprob_threshold=None,
+    )
+    result = whisper.transcribe(
+        model,
+        audio,
+        language_detection_windows=language_detection_windows,
+        language_detection_threshold=1.01,
+        **options,
+    )
+    n_calls = len(encoder_calls)
+
+    # the first window encoded by the language detection is decoded alike, and the other two
+    # windows are encoded as a batch, which is one encoder call more than decoding alone
+    encoder_calls.clear()
+    expected = whisper.transcribe(model, audio, language=result["language"], **options)
+    assert n_calls == len(encoder_calls) + (language_detection_windows > 1)
+    assert [s["tokens"] for s in result["segments"]] == [
+        s["tokens"] for s in expected["segments"]
+    ]
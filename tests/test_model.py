@@ -0,0 +1,123 @@
+import hashlib
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+import torch
+
+import whisper
+
+
+def test_load_model_mmap(model, tmp_path):
+    dims = model.dims
+
+    # saved in half precision, like the official checkpoints
+    checkpoint_file = str(tmp_path / "model.pt")
+    state_dict = {name: tensor.half() for name, tensor in model.state_dict().items()}
+    torch.save({"dims": dims.__dict__, "model_state_dict": state_dict}, checkpoint_file)
+
+    download_root = str(tmp_path / "cache")
+    expected = whisper.load_model(checkpoint_file, device="cpu")
+    loaded = whisper.load_model(
+        checkpoint_file, device="cpu", download_root=download_root, mmap=True
+    )
+    # the copy is made in the download root, not next to the checkpoint
+    assert sorted(os.listdir(tmp_path)) == ["cache", "model.pt"]
+    (mmap_name, lock_name) = sorted(os.listdir(download_root))
+    assert lock_name == f"{mmap_name}.lock"
+    mmap_file = os.path.join(download_root, mmap_name)
+
+    # including the buffers missing from the checkpoint
+    expected_tensors = {**expected.state_dict(), **dict(expected.named_buffers())}
+    tensors = {**loaded.state_dict(), **dict(loaded.named_buffers())}
+    assert tensors.keys() == expected_tensors.keys()
+    for name, tensor in tensors.items():
+        reference = expected_tensors[name]
+        assert tensor.device.type == "cpu" and tensor.dtype == reference.dtype
+        assert torch.equal(tensor.to_dense(), reference.to_dense()), name
+
+    # the float32 copy is made once, and again when the checkpoint changes, even to an older one
+    def load_copy():
+        whisper.load_model(
+            checkpoint_file, device="cpu", download_root=download_root, mmap=True
+        )
+        return os.stat(mmap_file).st_ino
+
+    inode = os.stat(mmap_file).st_ino
+    assert load_copy() == inode
+    mtime = os.path.getmtime(checkpoint_file)
+    os.utime(checkpoint_file, (mtime - 1000, mtime - 1000))
+    assert load_copy() != inode
+    assert sorted(os.listdir(download_root)) == [mmap_name, lock_name]
+
+    mel = torch.randn(1, 80, 3000)
+    tokens = torch.tensor([[50258, 50259, 50359]])
+    with torch.no_grad():
+        assert torch.equal(loaded(mel, tokens), expected(mel, tokens))
+
+
+def test_load_model_mmap_concurrent(model, tmp_path, monkeypatch):
+    checkpoint_file = str(tmp_path / "model.pt")
+    torch.save(
+        {"dims": model.dims.__dict__, "model_state_dict": model.state_dict()},
+        checkpoint_file,
+    )
+    download_root = str(tmp_path / "cache")
+
+    # the workers loading the model at the same time map a single copy, made by one of them
+    saved = []
+    save = torch.save
+    monkeypatch.setattr(torch, "save", lambda *args: saved.append(save(*args)))
+
+    def load(_):
+        return whisper.load_model(
+            checkpoint_file, device="cpu", download_root=download_root, mmap=True
+        )
+
+    with ThreadPoolExecutor(4) as executor:
+        models = list(executor.map(load, range(4)))
+    assert len(saved) == 1
+    for loaded in models:
+        assert torch.equal(loaded.decoder.ln.weight, model.decoder.ln.weight)
+
+
+@pytest.mark.parametrize("n_vocab", [51865, 51864])
+def test_warmup(random_model, n_vocab: int):
+    # English-only models have no language tokens to detect the language with
+    torch.manual_seed(0)
+    model = random_model(n_vocab=n_vocab)
+    assert model.is_multilingual == (n_vocab == 51865)
+    whisper.warmup(model, word_timestamps=True)
+
+
+def test_download_checksum_sidecar(tmp_path, monkeypatch):
+    content = os.urandom(1 << 16)
+    sha256 = hashlib.sha256(content).hexdigest()
+    source = tmp_path / "source" / sha256 / "model.pt"
+    source.parent.mkdir(parents=True)
+    source.write_bytes(content)
+    url, root = source.as_uri(), str(tmp_path / "cache")
+
+    hashed = []
+    sha256_function = whisper._sha256
+    monkeypatch.setattr(
+        whisper, "_sha256", lambda p: hashed.append(p) or sha256_function(p)
+    )
+
+    # hashed once after downloading, then trusted until the file changes or verify is set
+    target = whisper._download(url, root, in_memory=False)
+    assert len(hashed) == 1 and os.path.isfile(f"{target}.sha256")
+    assert whisper._download(url, root, in_memory=True) == content
+    assert len(hashed) == 1
+    whisper._download(url, root, in_memory=False, verify=True)
+    assert len(hashed) == 2
+
+    # a corrupted file does not match its record, and is downloaded again
+    with open(target, "r+b") as f:
+        f.write(b"corrupted")
+    os.utime(target, ns=(0, 0))
+    with pytest.warns(UserWarning, match="checksum does not match"):
+        whisper._download(url, root, in_memory=False)
+    assert len(hashed) == 4
+    with open(target, "rb") as f:
+        assert f.read() == content
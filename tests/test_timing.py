@@ -1,9 +1,27 @@
+import copy
+
 import numpy as np
 import pytest
 import scipy.ndimage
 import torch
 
-from whisper.timing import dtw_cpu, dtw_cuda, median_filter
+from whisper.audio import pad_or_trim
+from whisper.timing import (
+    add_word_timestamps,
+    add_word_timestamps_batch,
+    backtrace,
+    dtw_cpu,
+    dtw_cpu_banded,
+    dtw_cuda,
+    dtw_wavefront,
+    dtw_wavefront_parallel,
+    find_alignment,
+    median_filter,
+    running_median,
+    sakoe_chiba_band,
+)
+from whisper.tokenizer import get_tokenizer
+from whisper.utils import get_end
 
 sizes = [
     (10, 20),
@@ -52,6 +70,40 @@ def test_dtw(N: int, M: int):
     assert np.allclose(trace, dtw_trace)
 
 
+@pytest.mark.parametrize("N, M", sizes)
+@pytest.mark.parametrize("dtype", [np.float32, np.float64])
+def test_dtw_wavefront_equivalence(N: int, M: int, dtype):
+    x = np.random.randn(N, M).astype(dtype)
+    x[:, ::7] = np.round(x[:, ::7])  # with ties
+    lo, hi = np.ones(N, dtype=np.int64), np.full(N, M, dtype=np.int64)
+    expected = dtw_cpu(x)
+
+    for kernel in [dtw_wavefront, dtw_wavefront_parallel]:
+        trace = kernel(x, lo, hi)
+        assert trace.dtype == np.int8
+        assert np.array_equal(backtrace(trace), expected)
+    assert np.array_equal(dtw_cpu_banded(x), expected)
+
+
+@pytest.mark.parametrize("N, M", sizes)
+def test_dtw_banded(N: int, M: int):
+    x = np.random.rand(N, M)
+    expected = dtw_cpu(x)
+
+    # any band containing the optimal path gives the same path
+    lo = np.array([expected[1][expected[0] == i].min() + 1 for i in range(N)])
+    hi = np.array([expected[1][expected[0] == i].max() + 1 for i in range(N)])
+    assert np.array_equal(dtw_cpu_banded(x, (lo, hi)), expected)
+
+    # narrow bands around arbitrary rows are widened until the path is possible
+    for radius in [0.0, 2.5, M / 10]:
+        center = np.sort(np.random.rand(N) * M)
+        lo, hi = sakoe_chiba_band(center, radius, M)
+        i, j = dtw_cpu_banded(x, (lo, hi))
+        assert (i[0], j[0], i[-1], j[-1]) == (0, 0, N - 1, M - 1)
+        assert ((lo[i] <= j + 1) & (j + 1 <= hi[i])).all()
+
+
 @pytest.mark.requires_cuda
 @pytest.mark.parametrize("N, M", sizes)
 def test_dtw_cuda_equivalence(N: int, M: int):
@@ -84,6 +136,30 @@ def test_median_filter(shape):
         assert np.allclose(filtered, scipy_filtered)
 
 
+@pytest.mark.parametrize("shape", shapes)
+def test_running_median(shape):
+    x = torch.randn(*shape)
+    x[..., ::3] = x[..., ::3].round()  # with ties
+    x[..., 1::11] = np.inf
+
+    for filter_width in [1, 3, 5, 7, 13]:
+        padded = torch.nn.functional.pad(x, (filter_width // 2,) * 2)
+        expected = padded.unfold(-1, filter_width, 1).sort()[0][..., filter_width // 2]
+        rows = padded.reshape(-1, padded.shape[-1]).numpy()
+        filtered = running_median(rows, filter_width).reshape(expected.shape)
+        assert np.array_equal(filtered, expected.numpy())
+
+    # inputs with NaN are filtered by sorting, which orders NaN last
+    x[..., 0] = np.nan
+    padded = np.pad(x, [(0, 0)] * (x.ndim - 1) + [(3, 3)], mode="reflect")
+    expected = torch.from_numpy(padded).unfold(-1, 7, 1).sort()[0][..., 3]
+    assert np.array_equal(median_filter(x, 7), expected, equal_nan=True)
+
+    # other devices than the CPU, e.g. MPS, are filtered by sorting too
+    filtered = median_filter(x.to("meta"), 7)
+    assert filtered.device.type == "meta" and filtered.shape == expected.shape
+
+
 @pytest.mark.requires_cuda
 @pytest.mark.parametrize("shape", shapes)
 def test_median_filter_equivalence(shape):
@@ -94,3 +170,79 @@ def test_median_filter_equivalence(shape):
         filtered_gpu = median_filter(x.cuda(), filter_width).cpu()
 
         assert np.allclose(filtered_cpu, filtered_gpu)
+
+
+def test_find_alignment_audio_features(model):
+    tokenizer = get_tokenizer(multilingual=True, language="en", task="transcribe")
+    text_tokens = tokenizer.encode(" And so my fellow Americans")
+    mel = torch.randn(80, 3000)
+
+    expected = find_alignment(model, tokenizer, text_tokens, mel, 2000)
+    with torch.no_grad():
+        audio_features = model.embed_audio(mel[None])[0]
+    alignment = find_alignment(
+        model, tokenizer, text_tokens, mel, 2000, audio_features=audio_features
+    )
+    assert [(t.word, t.start, t.end) for t in alignment] == [
+        (t.word, t.start, t.end) for t in expected
+    ]
+    assert [t.probability for t in alignment] == pytest.approx(
+        [t.probability for t in expected], abs=1e-6
+    )
+
+
+@pytest.mark.parametrize("num_workers", [1, 2])
+def test_add_word_timestamps_batch(model, num_workers: int):
+    tokenizer = get_tokenizer(multilingual=True, language="en", task="transcribe")
+    mel = torch.randn(80, 7000)
+
+    # consecutive windows of segments, including one whose segment was cleared
+    texts = [[" And so my fellow", " Americans"], [""], [" ask not what", " your"]]
+    seeks, num_frames = [0, 2500, 3000], [2500, 500, 2600]
+    windows = []
+    for window_texts, seek, frames in zip(texts, seeks, num_frames):
+        duration = frames / 100 / len(window_texts)
+        windows.append(
+            [
+                dict(
+                    seek=seek,
+                    start=seek / 100 + i * duration,
+                    end=seek / 100 + (i + 1) * duration,
+                    tokens=tokenizer.encode(text),
+                )
+                for i, text in enumerate(window_texts)
+            ]
+        )
+
+    expected = copy.deepcopy(windows)
+    last_speech_timestamp = 0.0
+    for segments, seek, frames in zip(expected, seeks, num_frames):
+        add_word_timestamps(
+            segments=segments,
+            model=model,
+            tokenizer=tokenizer,
+            mel=pad_or_trim(mel[:, seek : seek + frames], 3000),
+            num_frames=frames,
+            last_speech_timestamp=last_speech_timestamp,
+        )
+        last_speech_timestamp = get_end(segments)
+
+    add_word_timestamps_batch(
+        windows=windows,
+        model=model,
+        tokenizer=tokenizer,
+        mel=mel,
+        num_frames=num_frames,
+        batch_size=2,
+        num_workers=num_workers,
+    )
+    for segment, reference in zip(sum(windows, []), sum(expected, [])):
+        assert (segment["start"], segment["end"]) == (
+            reference["start"],
+            reference["end"],
+        )
+        words = [(w["word"], w["start"], w["end"]) for w in segment["words"]]
+        assert words == [(w["word"], w["start"], w["end"]) for w in reference["words"]]
+        assert [w["probability"] for w in segment["words"]] == pytest.approx(
+            [w["probability"] for w in reference["words"]], abs=1e-5
+        )
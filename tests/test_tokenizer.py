@@ -1,6 +1,12 @@
+import base64
+import os
+import shutil
+import subprocess
+import sys
+
 import pytest
 
-from whisper.tokenizer import get_tokenizer
+from whisper.tokenizer import get_tokenizer, load_ranks
 
 
 @pytest.mark.parametrize("multilingual", [True, False])
@@ -32,3 +38,75 @@ def test_split_on_unicode():
 
     assert words == [" elle", " est", " l", "'", "\ufffd", "é", "rit", "oire"]
     assert word_tokens == [[8404], [871], [287], [6], [246], [526], [3210], [20378]]
+
+
+def test_decode():
+    tokenizer = get_tokenizer(multilingual=True, language="pt", task="transcribe")
+    text = " Olá, ação e coração. 다람쥐 헌 쳇바퀴에 타고파 🎉"
+    tokens = tokenizer.encode(text)
+    timestamp = tokenizer.timestamp_begin
+    sequences = [
+        tokens,
+        [timestamp, *tokens[:5], timestamp + 7, tokenizer.eot],
+        tokens[1:-1],  # starting and ending within multi-byte characters
+        [],
+    ]
+
+    assert tokenizer.decode(sequences[0]) == text
+    for token_ids in sequences:
+        encoding = tokenizer.encoding
+        expected = encoding.decode([t for t in token_ids if t < timestamp])
+        assert tokenizer.decode(token_ids) == expected
+        assert tokenizer.decode_with_timestamps(token_ids) == encoding.decode(token_ids)
+
+    words, word_tokens = tokenizer.split_tokens_on_unicode(sequences[1] + sequences[2])
+    assert "".join(words) == tokenizer.decode_with_timestamps(
+        sequences[1] + sequences[2]
+    )
+    assert sum(word_tokens, []) == sequences[1] + sequences[2]
+
+
+def test_tokenizer_without_torch():
+    # the submodules of `whisper` are imported lazily, so that the tokenizer needs no PyTorch
+    code = (
+        "import sys, whisper; from whisper.tokenizer import get_tokenizer; "
+        "whisper.available_models(); get_tokenizer(multilingual=True).encode(' hello'); "
+        "assert 'torch' not in sys.modules and 'numba' not in sys.modules; "
+        "assert callable(whisper.transcribe)"
+    )
+    subprocess.run([sys.executable, "-c", code], check=True)
+
+
+def test_load_ranks(tmp_path):
+    vocab_path = os.path.join(os.path.dirname(__file__), "..", "whisper", "assets")
+    vocab_path = os.path.join(vocab_path, "gpt2.tiktoken")
+    expected = {
+        base64.b64decode(token): int(rank)
+        for token, rank in (line.split() for line in open(vocab_path) if line)
+    }
+    cache_dir = str(tmp_path / "cache")
+    cache_path = os.path.join(cache_dir, "gpt2.tiktoken.ranks")
+
+    # parsed and cached on first use, then read from the cache
+    assert load_ranks(vocab_path, cache_dir) == expected
+    assert os.path.isfile(cache_path)
+    inode = os.stat(cache_path).st_ino
+    assert load_ranks(vocab_path, cache_dir) == expected
+    assert os.stat(cache_path).st_ino == inode
+
+    # a vocabulary of another size or modification time does not match the cache
+    changed_path = str(tmp_path / "gpt2.tiktoken")
+    shutil.copyfile(vocab_path, changed_path)
+    assert load_ranks(changed_path, cache_dir) == expected
+    assert os.stat(cache_path).st_ino != inode
+    with open(vocab_path, "rb") as source, open(changed_path, "wb") as target:
+        target.write(b"IQ== 1\nIg== 0\n" + source.read().split(b"\n", 2)[2])
+    changed = load_ranks(changed_path, cache_dir)
+    assert changed[b"!"] == 1 and changed[b'"'] == 0
+    assert load_ranks(changed_path, cache_dir) == changed
+
+    # a truncated cache is ignored and written again
+    with open(cache_path, "r+b") as f:
+        f.truncate(10)
+    assert load_ranks(vocab_path, cache_dir) == expected
+    assert load_ranks(vocab_path, cache_dir) == expected
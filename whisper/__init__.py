@@ -1,19 +1,65 @@
 import hashlib
+import importlib
 import io
+import json
 import os
+import sys
 import urllib
 import warnings
-from typing import List, Optional, Union
+from contextlib import contextmanager
+from types import ModuleType
+from typing import TYPE_CHECKING, List, Optional, Union
 
-import torch
-from tqdm import tqdm
-
-from .audio import load_audio, log_mel_spectrogram, pad_or_trim
-from .decoding import DecodingOptions, DecodingResult, decode, detect_language
-from .model import ModelDimensions, Whisper
-from .transcribe import transcribe
 from .version import __version__
 
+if TYPE_CHECKING:
+    import torch
+
+    from .model import Whisper
+
+# the attributes imported from the submodules on first use, so that e.g. `available_models()`
+# and the tokenizer can be used without importing PyTorch and numba
+_LAZY_ATTRIBUTES = {
+    "load_audio": "audio",
+    "log_mel_spectrogram": "audio",
+    "pad_or_trim": "audio",
+    "DecodingOptions": "decoding",
+    "DecodingResult": "decoding",
+    "decode": "decoding",
+    "detect_language": "decoding",
+    "detect_language_batch": "decoding",
+    "ModelDimensions": "model",
+    "Whisper": "model",
+    "transcribe": "transcribe",
+}
+_LAZY_SUBMODULES = {"audio", "decoding", "model", "timing", "tokenizer", "utils"}
+
+
+def __getattr__(name: str):
+    if name in _LAZY_ATTRIBUTES:
+        module = importlib.import_module(f".{_LAZY_ATTRIBUTES[name]}", __name__)
+        value = globals()[name] = getattr(module, name)
+        return value
+    if name in _LAZY_SUBMODULES:
+        return importlib.import_module(f".{name}", __name__)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+def __dir__() -> List[str]:
+    return sorted({*globals(), *_LAZY_ATTRIBUTES, *_LAZY_SUBMODULES})
+
+
+class _LazyModule(ModuleType):
+    def __setattr__(self, name: str, value):
+        # importing the submodule `whisper.transcribe` sets it as an attribute of the package,
+        # which must remain the function `transcribe`
+        if name in _LAZY_ATTRIBUTES and isinstance(value, ModuleType):
+            return
+        super().__setattr__(name, value)
+
+
+sys.modules[__name__].__class__ = _LazyModule
+
 _MODELS = {
     "tiny.en": "https://openaipublic.azureedge.net/main/whisper/models/d3dd57d32accea0b295c96e26691aa14d8822fac7d9d27d5dc00b4ca2826dd03/tiny.en.pt",
     "tiny": "https://openaipublic.azureedge.net/main/whisper/models/65147644a518d12f04e32d6f3b26facc3f8dd46e5390956a9424a650c0ce22b9/tiny.pt",
@@ -51,7 +97,52 @@ _ALIGNMENT_HEADS = {
 }
 
 
-def _download(url: str, root: str, in_memory: bool) -> Union[bytes, str]:
+def _sha256(path: str) -> str:
+    """The SHA256 checksum of a file, which is read in chunks rather than into memory"""
+    sha256 = hashlib.sha256()
+    with open(path, "rb") as f:
+        while chunk := f.read(1 << 20):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+def _verify_checksum(path: str, expected_sha256: str, verify: bool = False) -> bool:
+    """
+    Whether the file has the expected SHA256 checksum. A successful check is recorded in a sidecar
+    file along with the size and modification time of the file, which is trusted by the next
+    checks instead of hashing the file again, unless `verify` is True.
+    """
+    stat = os.stat(path)
+    record = {
+        "size": stat.st_size,
+        "mtime_ns": stat.st_mtime_ns,
+        "sha256": expected_sha256,
+    }
+    sidecar = f"{path}.sha256"
+    if not verify:
+        try:
+            with open(sidecar) as f:
+                if json.load(f) == record:
+                    return True
+        except (OSError, ValueError):
+            pass
+
+    if _sha256(path) != expected_sha256:
+        return False
+
+    try:
+        temp_file = f"{sidecar}.{os.getpid()}.tmp"
+        with open(temp_file, "w") as f:
+            json.dump(record, f)
+        os.replace(temp_file, sidecar)
+    except OSError:
+        pass  # e.g. a read-only cache, where the file is hashed every time
+    return True
+
+
+def _download(
+    url: str, root: str, in_memory: bool, verify: bool = False
+) -> Union[bytes, str]:
     os.makedirs(root, exist_ok=True)
 
     expected_sha256 = url.split("/")[-2]
@@ -61,15 +152,15 @@ def _download(url: str, root: str, in_memory: bool) -> Union[bytes, str]:
         raise RuntimeError(f"{download_target} exists and is not a regular file")
 
     if os.path.isfile(download_target):
-        with open(download_target, "rb") as f:
-            model_bytes = f.read()
-        if hashlib.sha256(model_bytes).hexdigest() == expected_sha256:
-            return model_bytes if in_memory else download_target
+        if _verify_checksum(download_target, expected_sha256, verify):
+            return open(download_target, "rb").read() if in_memory else download_target
         else:
             warnings.warn(
                 f"{download_target} exists, but the SHA256 checksum does not match; re-downloading the file"
             )
 
+    from tqdm import tqdm
+
     with urllib.request.urlopen(url) as source, open(download_target, "wb") as output:
         with tqdm(
             total=int(source.info().get("Content-Length")),
@@ -86,13 +177,74 @@ def _download(url: str, root: str, in_memory: bool) -> Union[bytes, str]:
                 output.write(buffer)
                 loop.update(len(buffer))
 
-    model_bytes = open(download_target, "rb").read()
-    if hashlib.sha256(model_bytes).hexdigest() != expected_sha256:
+    if not _verify_checksum(download_target, expected_sha256, verify=True):
         raise RuntimeError(
             "Model has been downloaded but the SHA256 checksum does not not match. Please retry loading the model."
         )
 
-    return model_bytes if in_memory else download_target
+    return open(download_target, "rb").read() if in_memory else download_target
+
+
+def _mmap_checkpoint(checkpoint_file: str, root: str) -> dict:
+    """
+    Memory-map a copy of the checkpoint whose weights can be assigned to the model as they are,
+    i.e. saved in float32 and in the zip-based format of `torch.save`. The copy is made in `root`
+    on the first use, and again when the size or modification time of the checkpoint differs
+    from those recorded in the copy when it was made.
+    """
+    import torch
+
+    path = os.path.abspath(checkpoint_file)
+    stat = os.stat(path)
+    source = {"path": path, "size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+    stem = os.path.splitext(os.path.basename(path))[0]
+    digest = hashlib.sha256(path.encode()).hexdigest()[:16]
+    mmap_file = os.path.join(root, f"{stem}-{digest}.mmap.pt")
+
+    def load_copy() -> Optional[dict]:
+        if os.path.isfile(mmap_file):
+            checkpoint = torch.load(mmap_file, **kwargs)
+            if checkpoint.get("source") == source:
+                return checkpoint
+
+    kwargs = dict(map_location="cpu", weights_only=True, mmap=True)
+    if (checkpoint := load_copy()) is not None:
+        return checkpoint
+
+    os.makedirs(root, exist_ok=True)
+    # the workers of e.g. `uvicorn --workers` load the model at the same time; the copy is made
+    # by one of them, so that the others map the same file instead of replacing it with theirs
+    with _file_lock(f"{mmap_file}.lock"):
+        if (checkpoint := load_copy()) is not None:
+            return checkpoint
+
+        checkpoint = torch.load(path, map_location="cpu", weights_only=True)
+        checkpoint["model_state_dict"] = {
+            name: tensor.float() if tensor.is_floating_point() else tensor
+            for name, tensor in checkpoint["model_state_dict"].items()
+        }
+        checkpoint["source"] = source
+        temp_file = f"{mmap_file}.{os.getpid()}.tmp"
+        torch.save(checkpoint, temp_file)
+        os.replace(temp_file, mmap_file)
+    return torch.load(mmap_file, **kwargs)
+
+
+@contextmanager
+def _file_lock(lock_file: str):
+    """Hold an exclusive lock on `lock_file`; without `fcntl` (i.e. on Windows) nothing is locked"""
+    try:
+        import fcntl
+    except ImportError:
+        yield
+        return
+
+    with open(lock_file, "a") as fp:
+        fcntl.flock(fp, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(fp, fcntl.LOCK_UN)
 
 
 def available_models() -> List[str]:
@@ -102,10 +254,12 @@ def available_models() -> List[str]:
 
 def load_model(
     name: str,
-    device: Optional[Union[str, torch.device]] = None,
+    device: Optional[Union[str, "torch.device"]] = None,
     download_root: str = None,
     in_memory: bool = False,
-) -> Whisper:
+    mmap: bool = False,
+    verify: bool = False,
+) -> "Whisper":
     """
     Load a Whisper ASR model
 
@@ -120,21 +274,34 @@ def load_model(
         path to download the model files; by default, it uses "~/.cache/whisper"
     in_memory: bool
         whether to preload the model weights into host memory
+    mmap: bool
+        whether to memory-map the model weights from a float32 copy of the checkpoint, made in
+        `download_root` on the first use, instead of reading them. The weights are assigned to the model without
+        copies, which lowers the load time and memory usage, and the processes loading the same
+        model on the CPU share their memory pages
+    verify: bool
+        whether to hash a downloaded model file again, rather than trusting the checksum recorded
+        for the same file size and modification time when it was last verified
 
     Returns
     -------
     model : Whisper
         The Whisper ASR model instance
     """
+    import torch
+
+    from .model import ModelDimensions, Whisper
 
     if device is None:
         device = "cuda" if torch.cuda.is_available() else "cpu"
+    if mmap and in_memory:
+        raise ValueError("mmap and in_memory cannot be used together")
     if download_root is None:
         default = os.path.join(os.path.expanduser("~"), ".cache")
         download_root = os.path.join(os.getenv("XDG_CACHE_HOME", default), "whisper")
 
     if name in _MODELS:
-        checkpoint_file = _download(_MODELS[name], download_root, in_memory)
+        checkpoint_file = _download(_MODELS[name], download_root, in_memory, verify)
         alignment_heads = _ALIGNMENT_HEADS[name]
     elif os.path.isfile(name):
         checkpoint_file = open(name, "rb").read() if in_memory else name
@@ -144,18 +311,78 @@ def load_model(
             f"Model {name} not found; available models = {available_models()}"
         )
 
-    with (
-        io.BytesIO(checkpoint_file) if in_memory else open(checkpoint_file, "rb")
-    ) as fp:
-        kwargs = {"weights_only": True} if torch.__version__ >= "1.13" else {}
-        checkpoint = torch.load(fp, map_location=device, **kwargs)
-    del checkpoint_file
+    if mmap:
+        checkpoint = _mmap_checkpoint(checkpoint_file, download_root)
+        with torch.device("meta"):
+            model = Whisper(ModelDimensions(**checkpoint["dims"]))
+        model.load_state_dict(checkpoint["model_state_dict"], assign=True)
+    else:
+        with (
+            io.BytesIO(checkpoint_file) if in_memory else open(checkpoint_file, "rb")
+        ) as fp:
+            kwargs = {"weights_only": True} if torch.__version__ >= "1.13" else {}
+            checkpoint = torch.load(fp, map_location=device, **kwargs)
+        del checkpoint_file
 
-    dims = ModelDimensions(**checkpoint["dims"])
-    model = Whisper(dims)
-    model.load_state_dict(checkpoint["model_state_dict"])
+        dims = ModelDimensions(**checkpoint["dims"])
+        model = Whisper(dims)
+        model.load_state_dict(checkpoint["model_state_dict"])
 
     if alignment_heads is not None:
         model.set_alignment_heads(alignment_heads)
 
     return model.to(device)
+
+
+def warmup(model: "Whisper", word_timestamps: bool = False, **decode_options) -> None:
+    """
+    Load and compile what is otherwise prepared during the first transcription, i.e. the mel
+    filters, the tokenizer, the kernels of an encoder and decoder pass and, with
+    `word_timestamps`, the numba or Triton kernels of the alignment. Compiled numba kernels are
+    cached on disk, which makes warming up the next processes faster.
+
+    Parameters
+    ----------
+    model : Whisper
+        the Whisper model instance to warm up
+    word_timestamps : bool
+        whether to also prepare the extraction of word-level timestamps
+    decode_options : dict
+        keyword arguments to construct the `DecodingOptions` of the warm-up decoding, e.g. the
+        `language` and `task` to load the same tokenizer as the transcriptions to come
+    """
+    import numba
+    import numpy as np
+
+    from .audio import N_FRAMES, N_SAMPLES, log_mel_spectrogram
+    from .decoding import DecodingOptions, decode
+    from .timing import dtw_wavefront_parallel, find_alignment
+    from .tokenizer import get_tokenizer
+
+    decode_options.setdefault("language", None if model.is_multilingual else "en")
+    decode_options.setdefault("fp16", model.device.type == "cuda")
+    decode_options.setdefault("sample_len", 4)
+    audio = np.zeros(N_SAMPLES, dtype=np.float32)
+    mel = log_mel_spectrogram(audio, model.dims.n_mels, device=model.device)
+    result = decode(model, mel, DecodingOptions(**decode_options))
+
+    if word_timestamps:
+        tokenizer = get_tokenizer(
+            model.is_multilingual,
+            num_languages=model.num_languages,
+            language=result.language,
+            task=decode_options.get("task", "transcribe"),
+        )
+        text_tokens = tokenizer.encode(" Hello world.")
+        find_alignment(
+            model,
+            tokenizer,
+            text_tokens,
+            mel,
+            N_FRAMES,
+            audio_features=result.audio_features,
+        )
+        if numba.get_num_threads() > 1:
+            # the parallel DTW of long segments is not cached on disk
+            lo = hi = np.ones(1, dtype=np.int64)
+            dtw_wavefront_parallel(np.zeros((1, 1)), lo, hi)
@@ -1,7 +1,14 @@
+import hashlib
+import math
 import os
+import wave
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
 from functools import lru_cache
-from subprocess import CalledProcessError, run
-from typing import Optional, Union
+from itertools import chain
+from subprocess import PIPE, CalledProcessError, Popen, run
+from tempfile import TemporaryFile
+from typing import Iterable, Iterator, List, Optional, Tuple, Union
 
 import numpy as np
 import torch
@@ -22,10 +29,32 @@ FRAMES_PER_SECOND = exact_div(SAMPLE_RATE, HOP_LENGTH)  # 10ms per audio frame
 TOKENS_PER_SECOND = exact_div(SAMPLE_RATE, N_SAMPLES_PER_TOKEN)  # 20ms per audio token
 
 
-def load_audio(file: str, sr: int = SAMPLE_RATE):
+def _ffmpeg_command(file: str, sr: int, duration: Optional[float] = None) -> List[str]:
+    # fmt: off
+    return [
+        "ffmpeg",
+        "-nostdin",
+        "-threads", "0",
+        *(["-t", str(duration)] if duration is not None else []),
+        "-i", file,
+        "-f", "s16le",
+        "-ac", "1",
+        "-acodec", "pcm_s16le",
+        "-ar", str(sr),
+        "-"
+    ]
+    # fmt: on
+
+
+def load_audio(file: str, sr: int = SAMPLE_RATE, duration: Optional[float] = None):
     """
     Open an audio file and read as mono waveform, resampling as necessary
 
+    WAV files are decoded in process, as are the formats of the optional `soundfile` package when
+    it is installed (FLAC, Ogg Vorbis and Opus, and MP3 with libsndfile 1.1), and resampled with
+    `resample`; ffmpeg decodes the other files. Starting ffmpeg takes longer than decoding
+    most short voice notes.
+
     Parameters
     ----------
     file: str
@@ -34,32 +63,305 @@ def load_audio(file: str, sr: int = SAMPLE_RATE):
     sr: int
         The sample rate to resample the audio if necessary
 
+    duration: Optional[float]
+        If given, only the first `duration` seconds of the file are decoded
+
     Returns
     -------
     A NumPy array containing the audio waveform, in float32 dtype.
     """
+    decoded = _decode_in_process(file, duration)
+    if decoded is not None:
+        blocks, file_sr = decoded
+        audio = np.concatenate([np.zeros(0, np.float32), *blocks])
+        return resample(audio, file_sr, sr)
+
+    return _load_audio_ffmpeg(file, sr, duration)
 
+
+def _load_audio_ffmpeg(file: str, sr: int, duration: Optional[float] = None):
     # This launches a subprocess to decode audio while down-mixing
     # and resampling as necessary.  Requires the ffmpeg CLI in PATH.
-    # fmt: off
-    cmd = [
-        "ffmpeg",
-        "-nostdin",
-        "-threads", "0",
-        "-i", file,
-        "-f", "s16le",
-        "-ac", "1",
-        "-acodec", "pcm_s16le",
-        "-ar", str(sr),
-        "-"
-    ]
-    # fmt: on
+    cmd = _ffmpeg_command(file, sr, duration)
     try:
         out = run(cmd, capture_output=True, check=True).stdout
     except CalledProcessError as e:
         raise RuntimeError(f"Failed to load audio: {e.stderr.decode()}") from e
 
-    return np.frombuffer(out, np.int16).flatten().astype(np.float32) / 32768.0
+    audio = np.frombuffer(out, np.int16).astype(np.float32)
+    audio /= 32768.0
+    return audio
+
+
+def _decode_in_process(
+    file: str, duration: Optional[float] = None, block_frames: Optional[int] = None
+) -> Optional[Tuple[Iterator[np.ndarray], int]]:
+    """
+    The mono waveform of a file, in blocks of `block_frames` frames or in a single block, and
+    its sample rate, or None if the file is left to ffmpeg
+    """
+    try:
+        f = wave.open(file, "rb")
+    except (OSError, EOFError, wave.Error):
+        # not a WAV file, or not integer PCM, the only encoding that `wave` reads
+        return _decode_soundfile(file, duration, block_frames)
+
+    width, channels, file_sr = f.getsampwidth(), f.getnchannels(), f.getframerate()
+    if width not in {1, 2, 3, 4}:
+        f.close()
+        return None
+    n_frames = f.getnframes()
+    if duration is not None:
+        n_frames = min(n_frames, round(duration * file_sr))
+
+    def blocks():
+        with f:
+            remaining = n_frames
+            while remaining > 0:
+                data = f.readframes(min(remaining, block_frames or remaining))
+                if not data:
+                    break
+                remaining -= len(data) // (width * channels)
+                yield _downmix(_pcm_to_float(data, width).reshape(-1, channels))
+
+    return blocks(), file_sr
+
+
+def _pcm_to_float(data: bytes, width: int) -> np.ndarray:
+    if width == 1:  # unsigned
+        audio = np.frombuffer(data, np.uint8).astype(np.float32)
+        audio -= 128.0
+        audio /= 128.0
+    elif width == 2:  # as ffmpeg converts it
+        audio = np.frombuffer(data, "<i2").astype(np.float32)
+        audio /= 32768.0
+    else:  # 24-bit samples fill the upper bytes of int32
+        samples = np.zeros((len(data) // width, 4), np.uint8)
+        samples[:, 4 - width :] = np.frombuffer(data, np.uint8).reshape(-1, width)
+        audio = samples.view("<i4").ravel().astype(np.float32)
+        audio /= 2147483648.0
+    return audio
+
+
+def _decode_soundfile(
+    file: str, duration: Optional[float] = None, block_frames: Optional[int] = None
+) -> Optional[Tuple[Iterator[np.ndarray], int]]:
+    try:
+        import soundfile
+    except (ImportError, OSError):  # OSError when libsndfile is missing
+        return None
+
+    try:
+        f = soundfile.SoundFile(file)
+    except Exception:
+        # ffmpeg decodes the formats that libsndfile does not, or tells why it cannot
+        return None
+
+    n_frames = -1 if duration is None else round(duration * f.samplerate)
+
+    def blocks():
+        with f:
+            remaining = n_frames
+            while remaining != 0:
+                size = block_frames or -1
+                if remaining > 0 and not 0 < size < remaining:
+                    size = remaining
+                frames = f.read(size, dtype="float32", always_2d=True)
+                if len(frames) == 0:
+                    break
+                yield _downmix(frames)
+                if size < 0:  # read to the end at once
+                    break
+                remaining -= len(frames) if remaining > 0 else 0
+
+    return blocks(), f.samplerate
+
+
+def _downmix(frames: np.ndarray) -> np.ndarray:
+    # averages the channels as ffmpeg does, faster than a mean over the short axis
+    audio = np.ascontiguousarray(frames[:, 0])
+    for channel in range(1, frames.shape[1]):
+        audio += frames[:, channel]
+    if frames.shape[1] > 1:
+        audio /= frames.shape[1]
+    return audio
+
+
+@lru_cache(maxsize=None)
+def _resampling_kernels(
+    orig_sr: int, sr: int, zero_crossings: int = 16, rolloff: float = 0.97
+) -> Tuple[torch.Tensor, int]:
+    """
+    The polyphase filters of a Kaiser-windowed sinc, one per output sample of a period of
+    `orig_sr` input samples, for sample rates divided by their GCD; the cutoff, window and
+    number of zero crossings are those of ffmpeg's default resampler.
+    """
+    cutoff = min(orig_sr, sr) * rolloff
+    width = math.ceil(zero_crossings * orig_sr / cutoff)
+    inputs = torch.arange(-width, width + orig_sr, dtype=torch.float64) / orig_sr
+    outputs = torch.arange(0, -sr, -1, dtype=torch.float64)[:, None] / sr
+    t = ((inputs + outputs) * cutoff).clamp(-zero_crossings, zero_crossings)
+
+    beta = torch.tensor(9.0, dtype=torch.float64)
+    window = torch.i0(beta * (1 - (t / zero_crossings) ** 2).sqrt()) / torch.i0(beta)
+    kernels = torch.sinc(t) * window * cutoff / orig_sr
+    return kernels[:, None].float(), width
+
+
+def _polyphase(samples: np.ndarray, kernels: torch.Tensor, orig_sr: int) -> np.ndarray:
+    """The output samples of every full window of the filters over the padded `samples`"""
+    waveform = torch.from_numpy(np.ascontiguousarray(samples, np.float32))
+    resampled = F.conv1d(waveform[None, None], kernels, stride=orig_sr)
+    return resampled[0].T.reshape(-1).numpy()
+
+
+def resample(audio: np.ndarray, orig_sr: int, sr: int = SAMPLE_RATE) -> np.ndarray:
+    """
+    Resample a waveform from `orig_sr` to `sr` with a band-limited sinc interpolation, which runs
+    as a strided convolution with one filter per output sample of each period of the two rates
+    """
+    if orig_sr == sr:
+        return audio
+
+    gcd = math.gcd(orig_sr, sr)
+    orig_sr, sr = orig_sr // gcd, sr // gcd
+    kernels, width = _resampling_kernels(orig_sr, sr)
+
+    padded = np.pad(audio.astype(np.float32, copy=False), (width, width + orig_sr))
+    length = -(-len(audio) * sr // orig_sr)
+    return _polyphase(padded, kernels, orig_sr)[:length]
+
+
+def resample_blocks(
+    blocks: Iterable[np.ndarray], orig_sr: int, sr: int = SAMPLE_RATE
+) -> Iterator[np.ndarray]:
+    """
+    `resample` over consecutive blocks of a waveform, keeping only the input samples that the
+    filters have yet to cover; the concatenated output is the resampled waveform
+    """
+    if orig_sr == sr:
+        yield from blocks
+        return
+
+    gcd = math.gcd(orig_sr, sr)
+    orig_sr, sr = orig_sr // gcd, sr // gcd
+    kernels, width = _resampling_kernels(orig_sr, sr)
+    size = kernels.shape[-1]
+
+    samples = np.zeros(width, np.float32)
+    n_input, n_output = 0, 0
+    for block in blocks:
+        n_input += len(block)
+        samples = np.concatenate([samples, block])
+        if (n_steps := (len(samples) - size) // orig_sr + 1) > 0:
+            yield _polyphase(
+                samples[: (n_steps - 1) * orig_sr + size], kernels, orig_sr
+            )
+            samples = samples[n_steps * orig_sr :]
+            n_output += n_steps * sr
+
+    samples = np.concatenate([samples, np.zeros(width + orig_sr, np.float32)])
+    length = -(-n_input * sr // orig_sr)
+    yield _polyphase(samples, kernels, orig_sr)[: length - n_output]
+
+
+def load_audio_chunks(
+    file: str, sr: int = SAMPLE_RATE, chunk_length: int = N_SAMPLES
+) -> Iterator[np.ndarray]:
+    """
+    Open an audio file and read it as consecutive blocks of the mono waveform given by
+    `load_audio`, decoded and resampled by the same decoder, so that only one block is in memory
+    at a time
+
+    Parameters
+    ----------
+    file: str
+        The audio file to open
+
+    sr: int
+        The sample rate to resample the audio if necessary
+
+    chunk_length: int
+        The number of samples in each block, except the last one which may be shorter
+
+    Returns
+    -------
+    An iterator of NumPy arrays containing the audio waveform, in float32 dtype.
+    """
+    decoded = _decode_in_process(file, block_frames=chunk_length)
+    if decoded is not None:
+        blocks, file_sr = decoded
+        yield from _rechunk(resample_blocks(blocks, file_sr, sr), chunk_length)
+        return
+
+    cmd = _ffmpeg_command(file, sr)
+    with TemporaryFile() as stderr, Popen(cmd, stdout=PIPE, stderr=stderr) as process:
+        try:
+            while block := process.stdout.read(chunk_length * 2):
+                audio = np.frombuffer(block, np.int16).astype(np.float32)
+                audio /= 32768.0
+                yield audio
+        except GeneratorExit:
+            # the remaining blocks are not needed
+            process.kill()
+            raise
+        if process.wait() != 0:
+            stderr.seek(0)
+            raise RuntimeError(f"Failed to load audio: {stderr.read().decode()}")
+
+
+def _rechunk(blocks: Iterable[np.ndarray], length: int) -> Iterator[np.ndarray]:
+    """The concatenated blocks, split into blocks of `length` samples but for the last one"""
+    pending = np.zeros(0, np.float32)
+    for block in blocks:
+        pending = np.concatenate([pending, block])
+        n_full = len(pending) // length * length
+        yield from pending[:n_full].reshape(-1, length)
+        pending = pending[n_full:]
+    if len(pending) > 0:
+        yield pending
+
+
+def prefetch_audio(
+    files: Iterable[str], prefetch: int = 1, sr: int = SAMPLE_RATE
+) -> Iterator[Tuple[str, "Future[np.ndarray]"]]:
+    """
+    Decode audio files in the background while the caller processes the previous ones
+
+    Parameters
+    ----------
+    files: Iterable[str]
+        The audio files to open, in the order they are yielded
+
+    prefetch: int
+        The number of files decoded ahead of the one being processed, each by its own
+        ffmpeg process; 0 decodes every file only when it is reached
+
+    sr: int
+        The sample rate to resample the audio if necessary
+
+    Returns
+    -------
+    An iterator of (file, future) pairs, whose `result()` returns the waveform given by
+    `load_audio` or raises its error, so that a file failing to decode can be skipped.
+    """
+    files = iter(files)
+    pending = deque()
+    with ThreadPoolExecutor(max(prefetch, 1), thread_name_prefix="ffmpeg") as pool:
+        try:
+            while True:
+                # ffmpeg runs in a subprocess, so the threads only wait for its output
+                while len(pending) <= prefetch:
+                    file = next(files, None)
+                    if file is None:
+                        break
+                    pending.append((file, pool.submit(load_audio, file, sr)))
+                if not pending:
+                    return
+                yield pending.popleft()
+        finally:
+            for _, future in pending:
+                future.cancel()
 
 
 def pad_or_trim(array, length: int = N_SAMPLES, *, axis: int = -1):
@@ -155,3 +457,212 @@ def log_mel_spectrogram(
     log_spec = torch.maximum(log_spec, log_spec.max() - 8.0)
     log_spec = (log_spec + 4.0) / 4.0
     return log_spec
+
+
+def cached_log_mel_spectrogram(
+    file: str,
+    n_mels: int = 80,
+    padding: int = 0,
+    dtype: torch.dtype = torch.float16,
+    cache_dir: Optional[str] = None,
+    max_size: int = 2 << 30,
+) -> torch.Tensor:
+    """
+    Compute the log-Mel spectrogram of an audio file as `log_mel_spectrogram`, or read it from a
+    `.npy` copy in `cache_dir` named after the SHA256 checksum of the file, `n_mels`, `padding`
+    and `dtype`, so that transcribing the same recording with several models decodes it only once.
+    The copy is memory-mapped, and made on first use unless the cache directory is not writable.
+
+    The spectrogram is returned in `dtype` either way; float16 halves the size of the cache and
+    rounds the spectrogram as fp16 inference does, but changes the results of fp32 inference.
+    The least recently used copies are deleted once the cache exceeds `max_size` bytes.
+    """
+    sha256 = hashlib.sha256()
+    with open(file, "rb") as f:
+        while block := f.read(1 << 20):
+            sha256.update(block)
+
+    if cache_dir is None:
+        default = os.path.join(os.path.expanduser("~"), ".cache")
+        cache_dir = os.path.join(os.getenv("XDG_CACHE_HOME", default), "whisper", "mel")
+    name = f"{sha256.hexdigest()}-{n_mels}-{padding}-{str(dtype).split('.')[-1]}.npy"
+    cache_path = os.path.join(cache_dir, name)
+
+    try:
+        # copy-on-write, so that the tensor is writable without changing the cache
+        mel = torch.from_numpy(np.load(cache_path, mmap_mode="c"))
+        os.utime(cache_path)  # the modification time orders the eviction
+        return mel
+    except (OSError, ValueError):
+        pass
+
+    mel = log_mel_spectrogram(file, n_mels, padding=padding).to(dtype)
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        temp_path = f"{cache_path}.{os.getpid()}.tmp"
+        with open(temp_path, "wb") as f:
+            np.save(f, mel.numpy())
+        os.replace(temp_path, cache_path)
+        _evict_least_recently_used(cache_dir, max_size)
+    except OSError:
+        pass
+
+    return mel
+
+
+def _evict_least_recently_used(cache_dir: str, max_size: int):
+    entries = []
+    for entry in os.scandir(cache_dir):
+        if entry.name.endswith(".npy"):
+            stat = entry.stat()
+            entries.append((stat.st_mtime_ns, stat.st_size, entry.path))
+
+    total = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries):
+        if total <= max_size:
+            break
+        try:
+            os.remove(path)
+        except FileNotFoundError:  # evicted by another process
+            pass
+        total -= size
+
+
+class LogMelStream:
+    """
+    The log-Mel spectrogram of an audio file, as computed by `log_mel_spectrogram(file, n_mels,
+    padding)`, but from blocks of `load_audio_chunks` and only for the frames being sliced, so that
+    the memory stays constant regardless of the duration of the file.
+
+    Slicing `mel[:, start:end]` decodes the file forward up to `end` and forgets the frames before
+    `start`; slicing frames which were forgotten decodes the file again from the beginning. The file
+    is also decoded once when the stream is created, to find the number of frames and the maximum
+    that the spectrogram is normalized with.
+    """
+
+    def __init__(
+        self,
+        file: str,
+        n_mels: int = 80,
+        padding: int = 0,
+        chunk_length: int = N_SAMPLES,
+        dtype: torch.dtype = torch.float32,
+    ):
+        self.file = file
+        self.n_mels = n_mels
+        self.padding = padding
+        self.chunk_length = chunk_length
+        self.dtype = dtype
+
+        n_frames, max_value = 0, -np.inf
+        for log_spec in self._log_specs():
+            n_frames += log_spec.shape[-1]
+            max_value = max(max_value, log_spec.max().item())
+        self.shape = (n_mels, n_frames)
+        self.floor = max_value - 8.0
+
+        self._reader: Optional[Iterator[torch.Tensor]] = None
+        self._offset = 0  # the frame at the start of self._frames
+        self._frames = torch.empty(n_mels, 0)
+
+    def _log_specs(self) -> Iterator[torch.Tensor]:
+        """The log-Mel spectrogram before its normalization, in blocks of consecutive frames"""
+        window = torch.hann_window(N_FFT)
+        filters = mel_filters(torch.device("cpu"), self.n_mels)
+
+        def log_spec(samples: np.ndarray, n_frames: int) -> torch.Tensor:
+            samples = torch.from_numpy(samples[: (n_frames - 1) * HOP_LENGTH + N_FFT])
+            stft = torch.stft(
+                samples,
+                N_FFT,
+                HOP_LENGTH,
+                window=window,
+                center=False,
+                return_complex=True,
+            )
+            mel_spec = filters @ stft.abs() ** 2
+            return torch.clamp(mel_spec, min=1e-10).log10()
+
+        # the samples of the frames yet to compute, with the reflection padding of the centered STFT
+        samples = np.zeros(0, np.float32)
+        n_samples, n_frames, reflected = 0, 0, False
+        blocks = chain(
+            load_audio_chunks(self.file, chunk_length=self.chunk_length),
+            [np.zeros(self.padding, np.float32)],
+        )
+        for block in blocks:
+            n_samples += len(block)
+            samples = np.concatenate([samples, block])
+            if not reflected:
+                if len(samples) <= N_FFT // 2:
+                    continue
+                samples = np.concatenate([samples[N_FFT // 2 : 0 : -1], samples])
+                reflected = True
+            if (n := (len(samples) - N_FFT) // HOP_LENGTH + 1) > 0:
+                yield log_spec(samples, n)
+                samples = samples[n * HOP_LENGTH :]
+                n_frames += n
+
+        if not reflected:
+            samples = np.pad(samples, (N_FFT // 2, 0), mode="reflect")
+        samples = np.concatenate([samples, samples[-2 : -N_FFT // 2 - 2 : -1]])
+        # the last frame of the STFT is left out, as in log_mel_spectrogram
+        if (n := n_samples // HOP_LENGTH - n_frames) > 0:
+            yield log_spec(samples, n)
+
+    def __getitem__(self, index: Tuple[slice, slice]) -> torch.Tensor:
+        """The frames of `mel[:, start:end]`; other indices are not supported"""
+        rows, frames = index
+        if rows != slice(None) or frames.step not in {None, 1}:
+            raise IndexError(
+                "only slices of frames, as in mel[:, start:end], are supported"
+            )
+        start, end, _ = frames.indices(self.shape[-1])
+        end = max(start, end)
+
+        if self._reader is None or start < self._offset:
+            self._reader = self._log_specs()
+            self._offset, self._frames = 0, torch.empty(self.n_mels, 0)
+        while True:
+            forgotten = min(start - self._offset, self._frames.shape[-1])
+            self._frames = self._frames[:, forgotten:]
+            self._offset += forgotten
+            if self._offset + self._frames.shape[-1] >= end:
+                break
+            self._frames = torch.cat([self._frames, next(self._reader)], dim=-1)
+
+        log_spec = torch.clamp(self._frames[:, : end - start], min=self.floor)
+        return ((log_spec + 4.0) / 4.0).to(self.dtype)
+
+    def frame_energy(self, end: Optional[int] = None) -> torch.Tensor:
+        """The mean of each frame up to `end` over the Mel bins, read 30 seconds at a time"""
+        end = self.shape[-1] if end is None else min(end, self.shape[-1])
+        energy = [
+            self[:, start : min(start + N_FRAMES, end)].float().mean(dim=-2)
+            for start in range(0, end, N_FRAMES)
+        ]
+        return torch.cat(energy) if energy else torch.empty(0)
+
+
+def speech_activity(
+    mel: Union[torch.Tensor, LogMelStream],
+    threshold: float = 0.25,
+    end: Optional[int] = None,
+) -> torch.Tensor:
+    """
+    Estimate which frames of a log-Mel spectrogram contain speech, as those whose mean energy is
+    `threshold` above the noise floor of the spectrogram; 0.25 is 10 dB in the units of
+    `log_mel_spectrogram`. A cheap voice activity detection, which cannot tell speech from music.
+    Only the frames before `end` are considered, if given.
+
+    Returns
+    -------
+    torch.Tensor, shape = (n_frames,)
+        A boolean Tensor, True for the frames estimated to contain speech
+    """
+    if isinstance(mel, LogMelStream):
+        energy = mel.frame_energy(end)
+    else:
+        energy = mel[..., :end].float().mean(dim=-2)
+    noise_floor = energy.kthvalue(max(1, energy.shape[-1] // 10)).values
+    return energy > noise_floor + threshold
@@ -1,4 +1,6 @@
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass, field, replace
+from functools import lru_cache
 from typing import TYPE_CHECKING, Dict, Iterable, List, Optional, Sequence, Tuple, Union
 
 import numpy as np
@@ -7,7 +9,15 @@ import torch.nn.functional as F
 from torch import Tensor
 from torch.distributions import Categorical
 
-from .audio import CHUNK_LENGTH
+from .audio import (
+    CHUNK_LENGTH,
+    N_FRAMES,
+    N_SAMPLES,
+    SAMPLE_RATE,
+    load_audio,
+    log_mel_spectrogram,
+    pad_or_trim,
+)
 from .tokenizer import Tokenizer, get_tokenizer
 from .utils import compression_ratio
 
@@ -77,6 +87,97 @@ def detect_language(
     return language_tokens, language_probs
 
 
+@torch.no_grad()
+def detect_language_batch(
+    model: "Whisper",
+    audio: Iterable[Union[str, np.ndarray, Tensor]],
+    *,
+    duration: float = CHUNK_LENGTH,
+    batch_size: int = 16,
+    num_workers: int = 4,
+    fp16: bool = True,
+) -> List[Dict[str, float]]:
+    """
+    Detect the spoken language of many audio files from their first `duration` seconds, returning
+    the probability distribution over all languages for each of them.
+
+    Only the beginning of each file is decoded, by up to `num_workers` ffmpeg processes at a time,
+    and the mel spectrograms go through the encoder in batches of `batch_size`, so that each file
+    costs a single encoder pass instead of a transcription.
+    """
+    dtype = torch.float16 if fp16 and model.device.type != "cpu" else torch.float32
+    num_samples = min(round(duration * SAMPLE_RATE), N_SAMPLES)
+
+    def log_mel(item) -> Tensor:
+        if isinstance(item, str):
+            item = load_audio(item, duration=num_samples / SAMPLE_RATE)
+        # computed like the first window of `transcribe`, with 30 seconds of padding
+        mel = log_mel_spectrogram(
+            item[:num_samples], model.dims.n_mels, padding=N_SAMPLES
+        )
+        return pad_or_trim(mel, N_FRAMES)
+
+    audio = list(audio)
+    language_probs = []
+    with ThreadPoolExecutor(max(1, num_workers)) as executor:
+        for i in range(0, len(audio), batch_size):
+            mels = list(executor.map(log_mel, audio[i : i + batch_size]))
+            mel = torch.stack(mels).to(model.device, dtype)
+            language_probs.extend(detect_language(model, mel)[1])
+
+    return language_probs
+
+
+@torch.no_grad()
+def detect_language_windows(
+    model: "Whisper",
+    mels: Sequence[Tensor],
+    weights: Sequence[float],
+    *,
+    threshold: float = 0.9,
+    batch_size: int = 4,
+) -> Tuple[Dict[str, float], Tensor]:
+    """
+    Detect the spoken language from several 30-second windows of the same audio, averaging their
+    language probabilities weighted by `weights`, e.g. the amount of speech in each window.
+
+    The first window is encoded alone and the others in batches of `batch_size`, stopping as soon
+    as the aggregated probability of the most likely language exceeds `threshold`, so that a
+    confident first window costs no more than `detect_language`.
+
+    Returns
+    -------
+    language_probs : Dict[str, float]
+        the aggregated probability distribution over all languages
+    audio_features : Tensor, shape = (n_audio_ctx, n_audio_state)
+        the encoded first window, which can be decoded without encoding it again
+    """
+    if all(weight <= 0 for weight in weights):
+        weights = [1.0] * len(mels)
+
+    totals: Dict[str, float] = {}
+    total_weight = 0.0
+    audio_features = None
+    batches = [[0]] + [
+        list(range(i, min(i + batch_size, len(mels))))
+        for i in range(1, len(mels), batch_size)
+    ]
+    for batch in batches:
+        features = model.encoder(torch.stack([mels[i] for i in batch]))
+        if audio_features is None:
+            audio_features = features[0]
+        for i, probs in zip(batch, detect_language(model, features)[1]):
+            for language, probability in probs.items():
+                totals[language] = totals.get(language, 0.0) + weights[i] * probability
+            total_weight += weights[i]
+
+        if total_weight > 0 and max(totals.values()) / total_weight >= threshold:
+            break
+
+    language_probs = {c: p / total_weight for c, p in totals.items()}
+    return language_probs, audio_features
+
+
 @dataclass(frozen=True)
 class DecodingOptions:
     # whether to perform X->X "transcribe" or X->English "translate"
@@ -110,6 +211,20 @@ class DecodingOptions:
     without_timestamps: bool = False  # use <|notimestamps|> to sample text tokens only
     max_initial_timestamp: Optional[float] = 1.0
 
+    # speculative decoding: a smaller model sharing the same tokenizer proposes up to
+    # `draft_len` tokens at a time, which are verified in a single forward pass; greedy only
+    draft_model: Optional["Whisper"] = None
+    draft_len: int = 4
+
+    # stop sampling a sequence once it repeats an n-gram of up to `repetition_max_ngram` tokens
+    # `repetition_threshold` times in a row, and flag the result as repetitive
+    repetition_threshold: Optional[int] = None
+    repetition_max_ngram: int = 8
+
+    # capture the cross-attention weights of the alignment heads while decoding, which saves
+    # the additional forward pass otherwise needed for word-level timestamps
+    capture_alignment: bool = False
+
     # implementation details
     fp16: bool = True  # use fp16 for most of the calculation
 
@@ -125,6 +240,11 @@ class DecodingResult:
     no_speech_prob: float = np.nan
     temperature: float = np.nan
     compression_ratio: float = np.nan
+    repetitive: bool = False
+    # with capture_alignment: the weights of the query predicting each token and the final EOT,
+    # shape = (n_alignment_heads, len(tokens) + 1, n_audio_ctx), and the token probabilities
+    alignment_weights: Optional[Tensor] = None
+    token_probs: Optional[List[float]] = None
 
 
 class Inference:
@@ -142,7 +262,12 @@ class Inference:
 
 
 class PyTorchInference(Inference):
-    def __init__(self, model: "Whisper", initial_token_length: int):
+    def __init__(
+        self,
+        model: "Whisper",
+        initial_token_length: int,
+        capture_alignment: bool = False,
+    ):
         self.model: "Whisper" = model
         self.initial_token_length = initial_token_length
         self.kv_cache = {}
@@ -152,22 +277,74 @@ class PyTorchInference(Inference):
         value_modules = [block.attn.value for block in self.model.decoder.blocks]
         self.kv_modules = key_modules + value_modules
 
+        # the cross-attention weights of the alignment heads in the last forward pass,
+        # shape = (n_batch, n_alignment_heads, n_tokens, n_audio_ctx), if captured
+        self.alignment_heads: List[Tuple[int, int]] = []
+        if capture_alignment:
+            self.alignment_heads = model.alignment_heads.indices().T.tolist()
+        self.alignment_qk: Optional[Tensor] = None
+        self.cross_qks: Dict[int, Tensor] = {}
+
+    @property
+    def cached_length(self) -> int:
+        """The number of leading token positions already stored in the kv cache"""
+        if self.kv_modules[0] not in self.kv_cache:
+            return 0
+        return self.kv_cache[self.kv_modules[0]].shape[1]
+
     def logits(self, tokens: Tensor, audio_features: Tensor) -> Tensor:
         if not self.kv_cache:
             self.kv_cache, self.hooks = self.model.install_kv_cache_hooks()
+            self.hooks.extend(self._install_alignment_hooks())
 
         if tokens.shape[-1] > self.initial_token_length:
-            # only need to use the last token except in the first forward pass
-            tokens = tokens[:, -1:]
+            # only need to use the tokens not yet in the cache except in the first forward pass;
+            # this is the last token only, unless the cache has been rewound.
+            tokens = tokens[:, self.cached_length :]
+
+        logits = self.model.decoder(tokens, audio_features, kv_cache=self.kv_cache)
+
+        if self.alignment_heads:
+            self.alignment_qk = torch.stack(
+                [
+                    self.cross_qks[layer][:, head]
+                    for layer, head in self.alignment_heads
+                ],
+                dim=1,
+            )
 
-        return self.model.decoder(tokens, audio_features, kv_cache=self.kv_cache)
+        return logits
+
+    def _install_alignment_hooks(self):
+        hooks = []
+        for layer in sorted({layer for layer, _ in self.alignment_heads}):
+            cross_attn = self.model.decoder.blocks[layer].cross_attn
+            cross_attn.use_sdpa = False  # SDPA does not return the attention weights
+            hooks.append(
+                cross_attn.register_forward_hook(
+                    lambda _, ins, outs, index=layer: self.cross_qks.__setitem__(
+                        index, outs[-1]
+                    )
+                )
+            )
+        return hooks
 
     def cleanup_caching(self):
         for hook in self.hooks:
             hook.remove()
 
+        for layer in {layer for layer, _ in self.alignment_heads}:
+            self.model.decoder.blocks[layer].cross_attn.__dict__.pop("use_sdpa", None)
+
         self.kv_cache = {}
         self.hooks = []
+        self.cross_qks = {}
+
+    def rewind_kv_cache(self, length: int):
+        """Discard the self-attention keys and values cached beyond the first `length` tokens"""
+        if self.cached_length > length:
+            for module in self.kv_modules:
+                self.kv_cache[module] = self.kv_cache[module][:, :length].detach()
 
     def rearrange_kv_cache(self, source_indices):
         if source_indices != list(range(len(source_indices))):
@@ -311,14 +488,25 @@ class BeamSearchDecoder(TokenDecoder):
         self.inference = inference
         self.patience = patience or 1.0
         self.max_candidates: int = round(beam_size * self.patience)
-        self.finished_sequences = None
+
+        # finished sequences of each audio, in the order they were found; the extra slot at
+        # index `max_candidates` absorbs the writes of candidates that are not kept
+        self.finished_tokens: Optional[Tensor] = (
+            None  # (n_audio, max_candidates + 1, length)
+        )
+        self.finished_lengths: Optional[Tensor] = None  # (n_audio, max_candidates + 1)
+        self.finished_logprobs: Optional[Tensor] = None  # (n_audio, max_candidates + 1)
+        self.n_finished: Optional[Tensor] = None  # (n_audio,)
 
         assert (
             self.max_candidates > 0
         ), f"Invalid beam size ({beam_size}) or patience ({patience})"
 
     def reset(self):
-        self.finished_sequences = None
+        self.finished_tokens = None
+        self.finished_lengths = None
+        self.finished_logprobs = None
+        self.n_finished = None
 
     def update(
         self, tokens: Tensor, logits: Tensor, sum_logprobs: Tensor
@@ -326,82 +514,118 @@ class BeamSearchDecoder(TokenDecoder):
         if tokens.shape[0] % self.beam_size != 0:
             raise ValueError(f"{tokens.shape}[0] % {self.beam_size} != 0")
 
-        n_audio = tokens.shape[0] // self.beam_size
-        if self.finished_sequences is None:  # for the first update
-            self.finished_sequences = [{} for _ in range(n_audio)]
+        n_audio, n_beams = tokens.shape[0] // self.beam_size, self.beam_size
+        n_tokens = tokens.shape[-1]
+        n_candidates = n_beams * (n_beams + 1)
+        first_update = self.finished_tokens is None
+        self._reserve(n_audio, n_tokens + 1, tokens.device)
 
+        # STEP 1: calculate the cumulative log probabilities for possible candidates
         logprobs = F.log_softmax(logits.float(), dim=-1)
-        next_tokens, source_indices, finished_sequences = [], [], []
-        for i in range(n_audio):
-            scores, sources, finished = {}, {}, {}
-
-            # STEP 1: calculate the cumulative log probabilities for possible candidates
-            for j in range(self.beam_size):
-                idx = i * self.beam_size + j
-                prefix = tokens[idx].tolist()
-                for logprob, token in zip(*logprobs[idx].topk(self.beam_size + 1)):
-                    new_logprob = (sum_logprobs[idx] + logprob).item()
-                    sequence = tuple(prefix + [token.item()])
-                    scores[sequence] = new_logprob
-                    sources[sequence] = idx
-
-            # STEP 2: rank the candidates and keep the top beam_size sequences for each audio
-            saved = 0
-            for sequence in sorted(scores, key=scores.get, reverse=True):
-                if sequence[-1] == self.eot:
-                    finished[sequence] = scores[sequence]
-                else:
-                    sum_logprobs[len(next_tokens)] = scores[sequence]
-                    next_tokens.append(sequence)
-                    source_indices.append(sources[sequence])
-
-                    saved += 1
-                    if saved == self.beam_size:
-                        break
-
-            finished_sequences.append(finished)
-
-        tokens = torch.tensor(next_tokens, device=tokens.device)
-        self.inference.rearrange_kv_cache(source_indices)
+        top_logprobs, top_tokens = logprobs.topk(n_beams + 1)
+        scores = (sum_logprobs[:, None] + top_logprobs).view(n_audio, n_candidates)
+        top_tokens = top_tokens.view(n_audio, n_candidates)
+        sources = torch.arange(n_audio * n_beams, device=tokens.device)
+        sources = sources.view(n_audio, n_beams)
+
+        # STEP 2: rank the candidates; the sort is stable to break ties in beam order
+        order = scores.sort(dim=-1, descending=True, stable=True).indices
+        is_unique = torch.ones_like(order, dtype=torch.bool)
+        if first_update:
+            # identical beams, e.g. the initial ones, propose the same candidates only once, from
+            # the last of these beams; later beams are always distinct sequences
+            beams = tokens.view(n_audio, n_beams, 1, n_tokens)
+            same = (beams == beams.transpose(1, 2)).all(dim=-1)
+            beam_index = torch.arange(n_beams, device=tokens.device)
+            last_same = torch.where(same, beam_index, -1).amax(dim=-1)
+            sources = sources[:, :1] + last_same
+            is_unique = ~same.tril(diagonal=-1).any(dim=-1)
+            is_unique = is_unique.repeat_interleave(n_beams + 1, dim=-1)
+            is_unique = is_unique.gather(-1, order)
+            unique_first = (~is_unique).byte().sort(dim=-1, stable=True).indices
+            order = order.gather(-1, unique_first)
+            is_unique = is_unique.gather(-1, unique_first)
+
+        scores = scores.gather(-1, order)
+        candidates = top_tokens.gather(-1, order)
+        sources = sources.gather(-1, order // (n_beams + 1))
+
+        # keep the top beam_size unfinished candidates, and the finished ones ranked above them
+        is_finished = candidates == self.eot
+        n_unfinished = (~is_finished & is_unique).cumsum(dim=-1)
+        keep = ~is_finished & is_unique & (n_unfinished <= n_beams)
+        finish = is_finished & is_unique & (n_unfinished < n_beams)
+
+        positions = torch.arange(n_candidates, device=tokens.device)
+        kept = torch.where(keep, positions, n_candidates).sort(dim=-1).values
+        kept = kept[:, :n_beams]
+        source_indices = sources.gather(-1, kept).flatten()
+        sum_logprobs.copy_(scores.gather(-1, kept).flatten())
+        next_tokens = candidates.gather(-1, kept).flatten()
+
+        # add newly finished sequences to the free slots of self.finished_tokens
+        finished = torch.where(finish, positions, n_candidates).sort(dim=-1).values
+        finished = finished[:, :n_beams]  # at most one EOT candidate per beam
+        slots = self.n_finished[:, None] + torch.arange(n_beams, device=tokens.device)
+        slots = torch.where(
+            (finished < n_candidates) & (slots < self.max_candidates),
+            slots,
+            self.max_candidates,
+        )
+        finished = finished.clamp(max=n_candidates - 1)
+        audio_index = torch.arange(n_audio, device=tokens.device)[:, None]
+        finished_sources = sources.gather(-1, finished)
+        self.finished_tokens[audio_index, slots, :n_tokens] = tokens[finished_sources]
+        self.finished_lengths[audio_index, slots] = n_tokens + 1
+        self.finished_logprobs[audio_index, slots] = scores.gather(-1, finished)
+        self.n_finished = (slots < self.max_candidates).sum(dim=-1) + self.n_finished
 
-        # add newly finished sequences to self.finished_sequences
-        assert len(self.finished_sequences) == len(finished_sequences)
-        for previously_finished, newly_finished in zip(
-            self.finished_sequences, finished_sequences
-        ):
-            for seq in sorted(newly_finished, key=newly_finished.get, reverse=True):
-                if len(previously_finished) >= self.max_candidates:
-                    break  # the candidate list is full
-                previously_finished[seq] = newly_finished[seq]
+        tokens = torch.cat([tokens[source_indices], next_tokens[:, None]], dim=-1)
+        self.inference.rearrange_kv_cache(source_indices.tolist())
 
         # mark as completed if all audio has enough number of samples
-        completed = all(
-            len(sequences) >= self.max_candidates
-            for sequences in self.finished_sequences
-        )
+        completed = (self.n_finished >= self.max_candidates).all()
         return tokens, completed
 
+    def _reserve(self, n_audio: int, length: int, device: torch.device):
+        """Allocate or grow the finished sequence buffers to hold `length` tokens"""
+        if self.finished_tokens is None:
+            shape = (n_audio, self.max_candidates + 1)
+            self.finished_tokens = torch.full((*shape, length), self.eot, device=device)
+            self.finished_lengths = torch.zeros(shape, dtype=torch.long, device=device)
+            self.finished_logprobs = torch.zeros(shape, device=device)
+            self.n_finished = torch.zeros(n_audio, dtype=torch.long, device=device)
+        elif length > self.finished_tokens.shape[-1]:
+            capacity = max(length, 2 * self.finished_tokens.shape[-1])
+            padding = (0, capacity - self.finished_tokens.shape[-1])
+            self.finished_tokens = F.pad(self.finished_tokens, padding, value=self.eot)
+
     def finalize(self, preceding_tokens: Tensor, sum_logprobs: Tensor):
         # collect all finished sequences, including patience, and add unfinished ones if not enough
         sum_logprobs = sum_logprobs.cpu()
-        for i, sequences in enumerate(self.finished_sequences):
-            if (
-                len(sequences) < self.beam_size
-            ):  # when not enough sequences are finished
+        finished_tokens = self.finished_tokens.cpu()
+        lengths = self.finished_lengths.tolist()
+        logprobs = self.finished_logprobs.tolist()
+
+        tokens: List[List[Tensor]] = []
+        scores: List[List[float]] = []
+        for i, n_finished in enumerate(self.n_finished.tolist()):
+            sequences = [
+                finished_tokens[i, k, : lengths[i][k]] for k in range(n_finished)
+            ]
+            sequence_logprobs = logprobs[i][:n_finished]
+            if n_finished < self.beam_size:  # when not enough sequences are finished
                 for j in list(np.argsort(sum_logprobs[i]))[::-1]:
                     sequence = preceding_tokens[i, j].tolist() + [self.eot]
-                    sequences[tuple(sequence)] = sum_logprobs[i][j].item()
+                    sequences.append(torch.tensor(sequence))
+                    sequence_logprobs.append(sum_logprobs[i][j].item())
                     if len(sequences) >= self.beam_size:
                         break
 
-        tokens: List[List[Tensor]] = [
-            [torch.tensor(seq) for seq in sequences.keys()]
-            for sequences in self.finished_sequences
-        ]
-        sum_logprobs: List[List[float]] = [
-            list(sequences.values()) for sequences in self.finished_sequences
-        ]
-        return tokens, sum_logprobs
+            tokens.append(sequences)
+            scores.append(sequence_logprobs)
+
+        return tokens, scores
 
 
 class LogitFilter:
@@ -420,22 +644,43 @@ class LogitFilter:
         raise NotImplementedError
 
 
+# a mask per filter, vocabulary size and device; kept small, as the masks hold device memory
+@lru_cache(maxsize=8)
+def suppression_mask(
+    suppress_tokens: Tuple[int, ...], n_vocab: int, device: torch.device
+) -> Tensor:
+    """An additive mask of shape (n_vocab,) which is -inf at `suppress_tokens` and 0 elsewhere"""
+    mask = torch.zeros(n_vocab, device=device)
+    mask[list(suppress_tokens)] = -np.inf
+    return mask
+
+
 class SuppressBlank(LogitFilter):
     def __init__(self, tokenizer: Tokenizer, sample_begin: int):
         self.tokenizer = tokenizer
         self.sample_begin = sample_begin
+        self.blank_tokens = tuple(tokenizer.encode(" ") + [tokenizer.eot])
 
     def apply(self, logits: Tensor, tokens: Tensor):
         if tokens.shape[1] == self.sample_begin:
-            logits[:, self.tokenizer.encode(" ") + [self.tokenizer.eot]] = -np.inf
+            logits += suppression_mask(
+                self.blank_tokens, logits.shape[-1], logits.device
+            )
 
 
 class SuppressTokens(LogitFilter):
     def __init__(self, suppress_tokens: Sequence[int]):
-        self.suppress_tokens = list(suppress_tokens)
+        self.suppress_tokens = tuple(suppress_tokens)
 
     def apply(self, logits: Tensor, tokens: Tensor):
-        logits[:, self.suppress_tokens] = -np.inf
+        logits += suppression_mask(
+            self.suppress_tokens, logits.shape[-1], logits.device
+        )
+
+
+def _row_mask(rows: Tensor) -> Tensor:
+    """An additive (n_batch, 1) mask, which is cheaper than a full-width masked_fill"""
+    return torch.where(rows, -np.inf, 0.0)[:, None]
 
 
 class ApplyTimestampRules(LogitFilter):
@@ -454,55 +699,150 @@ class ApplyTimestampRules(LogitFilter):
         if self.tokenizer.no_timestamps is not None:
             logits[:, self.tokenizer.no_timestamps] = -np.inf
 
+        if tokens.shape[0] == 1 and tokens.device.type == "cpu":
+            self._apply_single(logits, tokens)
+            return
+
         # timestamps have to appear in pairs, except directly before EOT; mask logits accordingly
-        for k in range(tokens.shape[0]):
-            sampled_tokens = tokens[k, self.sample_begin :]
-            seq = [t for t in sampled_tokens.tolist()]
-            last_was_timestamp = (
-                len(seq) >= 1 and seq[-1] >= self.tokenizer.timestamp_begin
+        timestamp_begin = self.tokenizer.timestamp_begin
+        sampled_tokens = tokens[:, self.sample_begin :]
+        is_timestamp = sampled_tokens >= timestamp_begin
+        n_batch, n_sampled = is_timestamp.shape
+
+        true = torch.ones(n_batch, dtype=torch.bool, device=tokens.device)
+        last_was_timestamp = is_timestamp[:, -1] if n_sampled >= 1 else ~true
+        penultimate_was_timestamp = is_timestamp[:, -2] if n_sampled >= 2 else true
+
+        # has to be non-timestamp
+        timestamp_mask = (last_was_timestamp & penultimate_was_timestamp)[:, None]
+        # cannot be normal text tokens
+        pair_opened = last_was_timestamp & ~penultimate_was_timestamp
+        logits[:, : self.tokenizer.eot] += _row_mask(pair_opened)
+
+        if n_sampled > 0:
+            # timestamps shouldn't decrease; forbid timestamp tokens smaller than the last
+            # also force each segment to have a nonzero length, to prevent infinite looping
+            positions = torch.arange(n_sampled, device=tokens.device)
+            last_index = torch.where(is_timestamp, positions, -1).amax(dim=-1)
+            timestamp_last = sampled_tokens.gather(-1, last_index.clamp(min=0)[:, None])
+            timestamp_last = timestamp_last - timestamp_begin + (~pair_opened)[:, None]
+            timestamps = torch.arange(
+                logits.shape[-1] - timestamp_begin, device=logits.device
             )
-            penultimate_was_timestamp = (
-                len(seq) < 2 or seq[-2] >= self.tokenizer.timestamp_begin
+            has_timestamp = (last_index >= 0)[:, None]
+            timestamp_mask = timestamp_mask | (
+                has_timestamp & (timestamps < timestamp_last)
             )
 
-            if last_was_timestamp:
-                if penultimate_was_timestamp:  # has to be non-timestamp
-                    logits[k, self.tokenizer.timestamp_begin :] = -np.inf
-                else:  # cannot be normal text tokens
-                    logits[k, : self.tokenizer.eot] = -np.inf
-
-            timestamps = sampled_tokens[
-                sampled_tokens.ge(self.tokenizer.timestamp_begin)
-            ]
-            if timestamps.numel() > 0:
-                # timestamps shouldn't decrease; forbid timestamp tokens smaller than the last
-                # also force each segment to have a nonzero length, to prevent infinite looping
-                if last_was_timestamp and not penultimate_was_timestamp:
-                    timestamp_last = timestamps[-1]
-                else:
-                    timestamp_last = timestamps[-1] + 1
-                logits[k, self.tokenizer.timestamp_begin : timestamp_last] = -np.inf
+        logits[:, timestamp_begin:].masked_fill_(timestamp_mask, -np.inf)
 
         if tokens.shape[1] == self.sample_begin:
             # suppress generating non-timestamp tokens at the beginning
-            logits[:, : self.tokenizer.timestamp_begin] = -np.inf
+            logits[:, :timestamp_begin] = -np.inf
 
             # apply the `max_initial_timestamp` option
             if self.max_initial_timestamp_index is not None:
-                last_allowed = (
-                    self.tokenizer.timestamp_begin + self.max_initial_timestamp_index
-                )
+                last_allowed = timestamp_begin + self.max_initial_timestamp_index
                 logits[:, last_allowed + 1 :] = -np.inf
 
         # if sum of probability over timestamps is above any other token, sample timestamp
         logprobs = F.log_softmax(logits.float(), dim=-1)
-        for k in range(tokens.shape[0]):
-            timestamp_logprob = logprobs[k, self.tokenizer.timestamp_begin :].logsumexp(
-                dim=-1
-            )
-            max_text_token_logprob = logprobs[k, : self.tokenizer.timestamp_begin].max()
-            if timestamp_logprob > max_text_token_logprob:
-                logits[k, : self.tokenizer.timestamp_begin] = -np.inf
+        timestamp_logprob = logprobs[:, timestamp_begin:].logsumexp(dim=-1)
+        max_text_token_logprob = logprobs[:, :timestamp_begin].amax(dim=-1)
+        logits[:, :timestamp_begin] += _row_mask(
+            timestamp_logprob > max_text_token_logprob
+        )
+
+    def _apply_single(self, logits: Tensor, tokens: Tensor):
+        """
+        The same rules for a single sequence on the CPU, e.g. greedy decoding, where reading the
+        tokens once and slicing the logits is cheaper than building the masks of the batch
+        """
+        timestamp_begin = self.tokenizer.timestamp_begin
+        seq = tokens[0, self.sample_begin :].tolist()
+        last_was_timestamp = len(seq) >= 1 and seq[-1] >= timestamp_begin
+        penultimate_was_timestamp = len(seq) < 2 or seq[-2] >= timestamp_begin
+
+        if last_was_timestamp:
+            if penultimate_was_timestamp:  # has to be non-timestamp
+                logits[0, timestamp_begin:] = -np.inf
+            else:  # cannot be normal text tokens
+                logits[0, : self.tokenizer.eot] = -np.inf
+
+        timestamp_last = next((t for t in reversed(seq) if t >= timestamp_begin), None)
+        if timestamp_last is not None:
+            # timestamps shouldn't decrease; forbid timestamp tokens smaller than the last
+            # also force each segment to have a nonzero length, to prevent infinite looping
+            if not last_was_timestamp or penultimate_was_timestamp:
+                timestamp_last += 1
+            logits[0, timestamp_begin:timestamp_last] = -np.inf
+
+        if not seq:
+            # suppress generating non-timestamp tokens at the beginning
+            logits[0, :timestamp_begin] = -np.inf
+
+            # apply the `max_initial_timestamp` option
+            if self.max_initial_timestamp_index is not None:
+                last_allowed = timestamp_begin + self.max_initial_timestamp_index
+                logits[0, last_allowed + 1 :] = -np.inf
+
+        # if sum of probability over timestamps is above any other token, sample timestamp
+        logprobs = F.log_softmax(logits[0].float(), dim=-1)
+        timestamp_logprob = logprobs[timestamp_begin:].logsumexp(dim=-1)
+        if timestamp_logprob > logprobs[:timestamp_begin].max():
+            logits[0, :timestamp_begin] = -np.inf
+
+
+class StopRepetitions(LogitFilter):
+    """
+    Forces EOT once the sampled tokens end with an n-gram of up to `max_ngram` tokens repeated
+    `threshold` times in a row, so that degenerate loops stop early instead of running until
+    `sample_len`. Timestamp tokens are compared as equal, as they keep increasing in a loop, but
+    n-grams made only of timestamps do not count, as two of them in a row close a segment.
+    """
+
+    def __init__(
+        self, tokenizer: Tokenizer, sample_begin: int, threshold: int, max_ngram: int
+    ):
+        self.tokenizer = tokenizer
+        self.sample_begin = sample_begin
+        self.threshold = threshold
+        self.max_ngram = max_ngram
+        self.window = threshold * max_ngram
+
+        # compare position `window - 1 - j` with the one `n` tokens earlier, for each n-gram
+        # length n and each j < n * (threshold - 1); the other comparisons are made trivial
+        ngram = torch.arange(1, max_ngram + 1)[:, None]
+        offset = torch.arange(max_ngram * (threshold - 1))
+        self.current = self.window - 1 - offset
+        self.previous = torch.where(
+            offset < ngram * (threshold - 1), self.current - ngram, self.current
+        )
+
+    def detect(self, tokens: Tensor) -> Tensor:
+        """Return whether each sequence currently ends with a repetition loop"""
+        tail = tokens[:, max(self.sample_begin, tokens.shape[1] - self.window) :]
+        timestamp_begin = self.tokenizer.timestamp_begin
+        tail = torch.where(tail >= timestamp_begin, timestamp_begin, tail)
+        if tail.shape[1] < self.window:
+            # left-pad with distinct negative values, which never match each other
+            n_pad = self.window - tail.shape[1]
+            padding = -1 - torch.arange(n_pad, device=tail.device)
+            tail = torch.cat([padding.expand(tail.shape[0], -1), tail], dim=1)
+
+        if self.current.device != tail.device:
+            self.current = self.current.to(tail.device)
+            self.previous = self.previous.to(tail.device)
+        current, previous = tail[:, self.current], tail[:, self.previous]
+        repeated = (current[:, None] == previous).all(dim=-1)  # for each n-gram length
+        is_text = tail[:, -self.max_ngram :].flip(-1) < timestamp_begin
+        return (repeated & (is_text.cumsum(dim=-1) > 0)).any(dim=-1)
+
+    def apply(self, logits: Tensor, tokens: Tensor):
+        repeating = self.detect(tokens)
+        eot = self.tokenizer.eot
+        logits += _row_mask(repeating)
+        logits[:, eot] = torch.where(repeating, 0.0, logits[:, eot])
 
 
 class DecodingTask:
@@ -532,12 +872,14 @@ class DecodingTask:
         if self.options.without_timestamps:
             self.sot_sequence = tokenizer.sot_sequence_including_notimestamps
 
-        self.initial_tokens: Tuple[int] = self._get_initial_tokens()
-        self.sample_begin: int = len(self.initial_tokens)
-        self.sot_index: int = self.initial_tokens.index(tokenizer.sot)
-
         # inference: implements the forward pass through the decoder, including kv caching
-        self.inference = PyTorchInference(model, len(self.initial_tokens))
+        self.inference = PyTorchInference(model, 0, options.capture_alignment)
+        self.alignment_steps: List[Tuple[Tensor, Tensor, Tensor, Tensor]] = []
+
+        # draft inference: the smaller model proposing tokens for speculative decoding
+        self.draft_inference: Optional[PyTorchInference] = None
+        if options.draft_model is not None:
+            self.draft_inference = PyTorchInference(options.draft_model, 0)
 
         # sequence ranker: implements how to rank a group of sampled sequences
         self.sequence_ranker = MaximumLikelihoodRanker(options.length_penalty)
@@ -550,25 +892,60 @@ class DecodingTask:
         else:
             self.decoder = GreedyDecoder(options.temperature, tokenizer.eot)
 
+        self.suppress_tokens: Tuple[int] = ()
+        if self.options.suppress_tokens:
+            self.suppress_tokens = self._get_suppress_tokens()
+
+        self.max_initial_timestamp_index: Optional[int] = None
+        if options.max_initial_timestamp:
+            precision = CHUNK_LENGTH / model.dims.n_audio_ctx  # usually 0.02 seconds
+            self.max_initial_timestamp_index = round(
+                self.options.max_initial_timestamp / precision
+            )
+
+        # the components above are independent of the prompt and can be reused across windows
+        self.set_prompt(options.prompt, options.prefix)
+
+    def set_prompt(
+        self,
+        prompt: Optional[Union[str, List[int]]] = None,
+        prefix: Optional[Union[str, List[int]]] = None,
+    ):
+        """Replace the prompt and prefix of the task, e.g. to decode the next 30-second window"""
+        self.options = replace(self.options, prompt=prompt, prefix=prefix)
+
+        self.initial_tokens: Tuple[int] = self._get_initial_tokens()
+        self.sample_begin: int = len(self.initial_tokens)
+        self.sot_index: int = self.initial_tokens.index(self.tokenizer.sot)
+
+        self.inference.initial_token_length = self.sample_begin
+        if self.draft_inference is not None:
+            self.draft_inference.initial_token_length = self.sample_begin
+
         # logit filters: applies various rules to suppress or penalize certain tokens
         self.logit_filters = []
         if self.options.suppress_blank:
             self.logit_filters.append(SuppressBlank(self.tokenizer, self.sample_begin))
-        if self.options.suppress_tokens:
-            self.logit_filters.append(SuppressTokens(self._get_suppress_tokens()))
-        if not options.without_timestamps:
-            precision = CHUNK_LENGTH / model.dims.n_audio_ctx  # usually 0.02 seconds
-            max_initial_timestamp_index = None
-            if options.max_initial_timestamp:
-                max_initial_timestamp_index = round(
-                    self.options.max_initial_timestamp / precision
-                )
+        if self.suppress_tokens:
+            self.logit_filters.append(SuppressTokens(self.suppress_tokens))
+        if not self.options.without_timestamps:
             self.logit_filters.append(
                 ApplyTimestampRules(
-                    tokenizer, self.sample_begin, max_initial_timestamp_index
+                    self.tokenizer, self.sample_begin, self.max_initial_timestamp_index
                 )
             )
 
+        # repetition detector: forces EOT once a sequence is stuck in a loop
+        self.stop_repetitions: Optional[StopRepetitions] = None
+        if self.options.repetition_threshold is not None:
+            self.stop_repetitions = StopRepetitions(
+                self.tokenizer,
+                self.sample_begin,
+                self.options.repetition_threshold,
+                self.options.repetition_max_ngram,
+            )
+            self.logit_filters.append(self.stop_repetitions)
+
     def _verify_options(self, options: DecodingOptions) -> DecodingOptions:
         if options.beam_size is not None and options.best_of is not None:
             raise ValueError("beam_size and best_of can't be given together")
@@ -581,6 +958,25 @@ class DecodingTask:
             0 <= options.length_penalty <= 1
         ):
             raise ValueError("length_penalty (alpha) should be a value between 0 and 1")
+        if options.repetition_threshold is not None:
+            if options.repetition_threshold < 2:
+                raise ValueError("repetition_threshold should be at least 2")
+            if options.repetition_max_ngram < 1:
+                raise ValueError("repetition_max_ngram should be a positive integer")
+        if options.draft_model is not None:
+            if options.temperature != 0 or options.beam_size is not None:
+                raise ValueError("draft_model requires greedy decoding (T=0, no beams)")
+            if options.draft_model is self.model:
+                raise ValueError("draft_model should be a different model instance")
+            if options.draft_len < 1:
+                raise ValueError("draft_len should be a positive integer")
+            draft_dims, dims = options.draft_model.dims, self.model.dims
+            if (draft_dims.n_vocab, draft_dims.n_mels) != (dims.n_vocab, dims.n_mels):
+                raise ValueError(
+                    "draft_model should share the vocabulary and mel bins of the model"
+                )
+            if options.capture_alignment:
+                raise ValueError("capture_alignment is not supported with draft_model")
 
         return options
 
@@ -641,18 +1037,19 @@ class DecodingTask:
 
         return tuple(sorted(set(suppress_tokens)))
 
-    def _get_audio_features(self, mel: Tensor):
+    def _get_audio_features(self, mel: Tensor, model: Optional["Whisper"] = None):
+        model = model or self.model
         if self.options.fp16:
             mel = mel.half()
 
         if mel.shape[-2:] == (
-            self.model.dims.n_audio_ctx,
-            self.model.dims.n_audio_state,
+            model.dims.n_audio_ctx,
+            model.dims.n_audio_state,
         ):
             # encoded audio features are given; skip audio encoding
             audio_features = mel
         else:
-            audio_features = self.model.encoder(mel)
+            audio_features = model.encoder(mel)
 
         if audio_features.dtype != (
             torch.float16 if self.options.fp16 else torch.float32
@@ -695,6 +1092,12 @@ class DecodingTask:
                 # now we need to consider the logits at the last token only
                 logits = logits[:, -1]
 
+                if self.inference.alignment_heads:
+                    # the word probabilities are over the text tokens, before any filtering
+                    text_logits = logits[:, : self.tokenizer.eot].float()
+                    text_logprobs = F.log_softmax(text_logits, dim=-1)
+                    previous_tokens = tokens
+
                 # apply the logit filters, e.g. for suppressing or applying penalty to
                 for logit_filter in self.logit_filters:
                     logit_filter.apply(logits, tokens)
@@ -702,16 +1105,150 @@ class DecodingTask:
                 # expand the tokens tensor with the selected next tokens
                 tokens, completed = self.decoder.update(tokens, logits, sum_logprobs)
 
+                if self.inference.alignment_heads:
+                    self._record_alignment(previous_tokens, tokens, text_logprobs)
+
+                if completed or tokens.shape[-1] > self.n_ctx:
+                    break
+        finally:
+            self.inference.cleanup_caching()
+
+        return tokens, sum_logprobs, no_speech_probs
+
+    def _record_alignment(
+        self, tokens: Tensor, next_tokens: Tensor, text_logprobs: Tensor
+    ):
+        """
+        Save the alignment weights of the last query of each sequence in `tokens`, along with the
+        token appended to each sequence in `next_tokens`, the row of `tokens` it extends, since
+        beam search may have rearranged the sequences, and its probability in that row.
+        """
+        n_audio = tokens.shape[0] // self.n_group
+        prefixes = tokens.view(n_audio, 1, self.n_group, -1)
+        extended = next_tokens[:, :-1].reshape(n_audio, self.n_group, 1, -1)
+        sources = (extended == prefixes).all(dim=-1).float().argmax(dim=-1)
+        offsets = torch.arange(n_audio, device=tokens.device)[:, None] * self.n_group
+        sources = (sources + offsets).flatten()
+
+        appended = next_tokens[:, -1]
+        probs = text_logprobs[sources, appended.clamp(max=self.tokenizer.eot - 1)].exp()
+        weights = self.inference.alignment_qk[:, :, -1]
+        self.alignment_steps.append((sources, appended, weights, probs))
+
+    def _collect_alignment(self, audio_index: int, sampled_tokens: List[int]):
+        """
+        Gather the alignment weights and token probabilities along a selected sequence, following
+        the rows whose prefix is the one of the sequence from each step to the next
+        """
+        n_sampled = len(sampled_tokens)
+        if len(self.alignment_steps) <= n_sampled:
+            return None, None  # the sampling stopped before predicting the end of text
+
+        device = self.alignment_steps[0][0].device
+        sequence = torch.tensor(sampled_tokens, device=device)
+        start = audio_index * self.n_group
+        rows = slice(start, start + self.n_group)
+        # every sequence of the group starts with the initial tokens
+        match = torch.ones(self.n_group, dtype=torch.bool, device=device)
+
+        weights, probs, found = [], [], []
+        for i, (sources, appended, qk, step_probs) in enumerate(
+            self.alignment_steps[: n_sampled + 1]
+        ):
+            weights.append(qk[rows][match.float().argmax()])
+            found.append(match.any())
+            if i < n_sampled:
+                match = match[sources[rows] - start] & (appended[rows] == sequence[i])
+                probs.append(step_probs[rows][match.float().argmax()])
+                found.append(match.any())
+
+        if not torch.stack(found).all():
+            return None, None
+
+        weights = torch.stack(weights, dim=1)
+        probs = torch.stack(probs).tolist() if probs else []
+        return weights, probs
+
+    def _speculative_loop(
+        self, audio_features: Tensor, draft_audio_features: Tensor, tokens: Tensor
+    ):
+        """
+        Greedy decoding where the draft model proposes up to `draft_len` tokens, which the main
+        model verifies in a single forward pass. Each position is selected by `self.decoder` from
+        the main model's logits, so the output is the same as the one of `_main_loop`.
+        """
+        n_batch = tokens.shape[0]
+        sum_logprobs: Tensor = torch.zeros(n_batch, device=audio_features.device)
+        draft_sum_logprobs: Tensor = torch.zeros_like(sum_logprobs)
+        draft_decoder = GreedyDecoder(0.0, self.tokenizer.eot)
+        no_speech_probs = [np.nan] * n_batch
+        n_sampled = 0
+
+        try:
+            while n_sampled < self.sample_len:
+                n_tokens = tokens.shape[-1]
+                n_draft = min(
+                    self.options.draft_len,
+                    self.sample_len - n_sampled - 1,
+                    self.n_ctx - n_tokens,
+                )
+
+                # let the draft model propose the next tokens autoregressively
+                proposals = tokens
+                for _ in range(n_draft):
+                    draft_logits = self.draft_inference.logits(
+                        proposals, draft_audio_features
+                    )[:, -1]
+                    for logit_filter in self.logit_filters:
+                        logit_filter.apply(draft_logits, proposals)
+                    proposals, draft_completed = draft_decoder.update(
+                        proposals, draft_logits, draft_sum_logprobs
+                    )
+                    if draft_completed:
+                        break
+
+                # score all proposed positions at once with the main model
+                cached_length = self.inference.cached_length
+                logits = self.inference.logits(proposals, audio_features)
+
+                if n_sampled == 0 and self.tokenizer.no_speech is not None:
+                    probs_at_sot = logits[:, self.sot_index].float().softmax(dim=-1)
+                    no_speech_probs = probs_at_sot[:, self.tokenizer.no_speech].tolist()
+
+                # accept the proposals for as long as they match the main model's choices
+                completed = False
+                for i in range(proposals.shape[-1] - n_tokens + 1):
+                    position_logits = logits[:, n_tokens + i - 1 - cached_length]
+                    for logit_filter in self.logit_filters:
+                        logit_filter.apply(position_logits, tokens)
+                    tokens, completed = self.decoder.update(
+                        tokens, position_logits, sum_logprobs
+                    )
+                    n_sampled += 1
+
+                    if completed or tokens.shape[-1] > self.n_ctx:
+                        break
+                    if n_tokens + i >= proposals.shape[-1]:
+                        break  # every proposal has been accepted
+                    if not torch.equal(tokens[:, -1], proposals[:, n_tokens + i]):
+                        break
+
                 if completed or tokens.shape[-1] > self.n_ctx:
                     break
+
+                # drop the cached keys and values of the rejected proposals
+                self.inference.rewind_kv_cache(tokens.shape[-1] - 1)
+                self.draft_inference.rewind_kv_cache(tokens.shape[-1] - 1)
         finally:
             self.inference.cleanup_caching()
+            self.draft_inference.cleanup_caching()
 
         return tokens, sum_logprobs, no_speech_probs
 
     @torch.no_grad()
     def run(self, mel: Tensor) -> List[DecodingResult]:
         self.decoder.reset()
+        self.alignment_steps = []
         tokenizer: Tokenizer = self.tokenizer
         n_audio: int = mel.shape[0]
 
@@ -734,7 +1271,19 @@ class DecodingTask:
         tokens = tokens.repeat_interleave(self.n_group, dim=0).to(audio_features.device)
 
         # call the main sampling loop
-        tokens, sum_logprobs, no_speech_probs = self._main_loop(audio_features, tokens)
+        if self.draft_inference is not None:
+            if mel.shape[-2] != self.model.dims.n_mels:
+                raise ValueError("speculative decoding requires mel spectrogram inputs")
+            draft_audio_features = self._get_audio_features(
+                mel, self.options.draft_model
+            )
+            tokens, sum_logprobs, no_speech_probs = self._speculative_loop(
+                audio_features, draft_audio_features, tokens
+            )
+        else:
+            tokens, sum_logprobs, no_speech_probs = self._main_loop(
+                audio_features, tokens
+            )
 
         # reshape the tensors to have (n_audio, n_group) as the first two dimensions
         audio_features = audio_features[:: self.n_group]
@@ -756,6 +1305,22 @@ class DecodingTask:
         tokens: List[List[int]] = [t[i].tolist() for i, t in zip(selected, tokens)]
         texts: List[str] = [tokenizer.decode(t).strip() for t in tokens]
 
+        # gather the alignment weights captured along the selected sequences
+        alignments = [(None, None)] * n_audio
+        if self.inference.alignment_heads:
+            alignments = [self._collect_alignment(i, t) for i, t in enumerate(tokens)]
+            self.alignment_steps = []
+
+        # flag the selected sequences which were stopped, or ended, in a repetition loop
+        repetitive: List[bool] = [False] * n_audio
+        if self.stop_repetitions is not None:
+            repetitive = [
+                self.stop_repetitions.detect(
+                    torch.tensor([self.initial_tokens + tuple(t)])
+                ).item()
+                for t in tokens
+            ]
+
         sum_logprobs: List[float] = [lp[i] for i, lp in zip(selected, sum_logprobs)]
         avg_logprobs: List[float] = [
             lp / (len(t) + 1) for t, lp in zip(tokens, sum_logprobs)
@@ -768,6 +1333,8 @@ class DecodingTask:
             audio_features,
             avg_logprobs,
             no_speech_probs,
+            repetitive,
+            alignments,
         )
         if len(set(map(len, fields))) != 1:
             raise RuntimeError(f"inconsistent result lengths: {list(map(len, fields))}")
@@ -782,10 +1349,20 @@ class DecodingTask:
                 no_speech_prob=no_speech_prob,
                 temperature=self.options.temperature,
                 compression_ratio=compression_ratio(text),
+                repetitive=is_repetitive,
+                alignment_weights=alignment_weights,
+                token_probs=token_probs,
             )
-            for text, language, tokens, features, avg_logprob, no_speech_prob in zip(
-                *fields
-            )
+            for (
+                text,
+                language,
+                tokens,
+                features,
+                avg_logprob,
+                no_speech_prob,
+                is_repetitive,
+                (alignment_weights, token_probs),
+            ) in zip(*fields)
         ]
 
 
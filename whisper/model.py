@@ -120,16 +120,24 @@ class MultiHeadAttention(nn.Module):
         k = k.view(*k.shape[:2], self.n_head, -1).permute(0, 2, 1, 3)
         v = v.view(*v.shape[:2], self.n_head, -1).permute(0, 2, 1, 3)
 
-        if SDPA_AVAILABLE and MultiHeadAttention.use_sdpa:
-            a = scaled_dot_product_attention(
-                q, k, v, is_causal=mask is not None and n_ctx > 1
-            )
+        # when several new tokens are appended to a kv-cached prefix, the queries are
+        # aligned with the last rows of the causal mask rather than the first ones.
+        n_kv = k.shape[2]
+
+        if SDPA_AVAILABLE and self.use_sdpa:
+            if mask is not None and 1 < n_ctx < n_kv:
+                causal_mask = mask[n_kv - n_ctx : n_kv, :n_kv] == 0
+                a = scaled_dot_product_attention(q, k, v, attn_mask=causal_mask)
+            else:
+                a = scaled_dot_product_attention(
+                    q, k, v, is_causal=mask is not None and n_ctx > 1
+                )
             out = a.permute(0, 2, 1, 3).flatten(start_dim=2)
             qk = None
         else:
             qk = (q * scale) @ (k * scale).transpose(-1, -2)
             if mask is not None:
-                qk = qk + mask[:n_ctx, :n_ctx]
+                qk = qk + mask[n_kv - n_ctx : n_kv, :n_kv]
             qk = qk.float()
 
             w = F.softmax(qk, dim=-1).to(q.dtype)
@@ -221,7 +229,9 @@ class TextDecoder(nn.Module):
         )
         self.ln = LayerNorm(n_state)
 
-        mask = torch.empty(n_ctx, n_ctx).fill_(-np.inf).triu_(1)
+        # the buffers missing from checkpoints are created on the CPU even when the model is
+        # created on the meta device, to load memory-mapped weights without copying them
+        mask = torch.empty(n_ctx, n_ctx, device="cpu").fill_(-np.inf).triu_(1)
         self.register_buffer("mask", mask, persistent=False)
 
     def forward(self, x: Tensor, xa: Tensor, kv_cache: Optional[dict] = None):
@@ -270,7 +280,10 @@ class Whisper(nn.Module):
         # use the last half among the decoder layers for time alignment by default;
         # to use a specific set of heads, see `set_alignment_heads()` below.
         all_heads = torch.zeros(
-            self.dims.n_text_layer, self.dims.n_text_head, dtype=torch.bool
+            self.dims.n_text_layer,
+            self.dims.n_text_head,
+            dtype=torch.bool,
+            device="cpu",
         )
         all_heads[self.dims.n_text_layer // 2 :] = True
         self.register_buffer("alignment_heads", all_heads.to_sparse(), persistent=False)
@@ -1,8 +1,10 @@
 import itertools
+import os
 import subprocess
 import warnings
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass
-from typing import TYPE_CHECKING, List
+from typing import TYPE_CHECKING, List, Optional, Tuple
 
 import numba
 import numpy as np
@@ -11,11 +13,55 @@ import torch.nn.functional as F
 
 from .audio import HOP_LENGTH, SAMPLE_RATE, TOKENS_PER_SECOND
 from .tokenizer import Tokenizer
+from .utils import get_end
 
 if TYPE_CHECKING:
     from .model import Whisper
 
 
+@numba.jit(nopython=True, nogil=True, cache=True)
+def running_median(x: np.ndarray, filter_width: int) -> np.ndarray:
+    """
+    The median of each window of `filter_width` values along the rows of `x`, keeping the values
+    of the window sorted as it slides, which takes O(filter_width) steps per value. The rows
+    must not contain NaN, which makes the outgoing value of the window impossible to find.
+    """
+    num_rows, length = x.shape
+    n = length - filter_width + 1
+    result = np.empty((num_rows, n), dtype=x.dtype)
+    window = np.empty(filter_width, dtype=x.dtype)
+    middle = filter_width // 2
+
+    for r in range(num_rows):
+        row = x[r]
+        for i in range(filter_width):  # insertion sort of the first window
+            value, j = row[i], i
+            while j > 0 and window[j - 1] > value:
+                window[j] = window[j - 1]
+                j -= 1
+            window[j] = value
+        result[r, 0] = window[middle]
+
+        for i in range(1, n):
+            outgoing, incoming = row[i - 1], row[i + filter_width - 1]
+            j = 0
+            while window[j] != outgoing:
+                j += 1
+            # replace the outgoing value, shifting the values between it and the new position
+            if incoming > outgoing:
+                while j + 1 < filter_width and window[j + 1] < incoming:
+                    window[j] = window[j + 1]
+                    j += 1
+            else:
+                while j > 0 and window[j - 1] > incoming:
+                    window[j] = window[j - 1]
+                    j -= 1
+            window[j] = incoming
+            result[r, i] = window[middle]
+
+    return result
+
+
 def median_filter(x: torch.Tensor, filter_width: int):
     """Apply a median filter of width `filter_width` along the last dimension of `x`"""
     pad_width = filter_width // 2
@@ -44,6 +90,16 @@ def median_filter(x: torch.Tensor, filter_width: int):
                 "falling back to a slower median kernel implementation..."
             )
 
+    if (
+        result is None
+        and x.device.type == "cpu"
+        and x.dtype in (torch.float32, torch.float64)
+        and not x.isnan().any()
+    ):
+        rows = x.detach().contiguous().view(-1, x.shape[-1]).numpy()
+        result = torch.from_numpy(running_median(rows, filter_width))
+        result = result.view(*x.shape[:-1], -1)
+
     if result is None:
         # sort() is faster than torch.median (https://github.com/pytorch/pytorch/issues/51450)
         result = x.unfold(-1, filter_width, 1).sort()[0][..., filter_width // 2]
@@ -54,7 +110,7 @@ def median_filter(x: torch.Tensor, filter_width: int):
     return result
 
 
-@numba.jit(nopython=True)
+@numba.jit(nopython=True, nogil=True, cache=True)
 def backtrace(trace: np.ndarray):
     i = trace.shape[0] - 1
     j = trace.shape[1] - 1
@@ -79,7 +135,7 @@ def backtrace(trace: np.ndarray):
     return result[::-1, :].T
 
 
-@numba.jit(nopython=True, parallel=True)
+@numba.jit(nopython=True, parallel=True, cache=True)
 def dtw_cpu(x: np.ndarray):
     N, M = x.shape
     cost = np.ones((N + 1, M + 1), dtype=np.float32) * np.inf
@@ -105,6 +161,94 @@ def dtw_cpu(x: np.ndarray):
     return backtrace(trace)
 
 
+def _dtw_wavefront(x: np.ndarray, lo: np.ndarray, hi: np.ndarray) -> np.ndarray:
+    """
+    The same recurrence as `dtw_cpu`, restricted to the columns lo[i - 1] <= j <= hi[i - 1] of
+    each row i, and swept along the anti-diagonals i + j = d whose cells are independent of each
+    other. Only the costs of the last three anti-diagonals are kept, indexed by row.
+    """
+    N, M = x.shape
+    cost = np.ones((3, N + 2), dtype=np.float32) * np.inf
+    trace = -np.ones((N + 1, M + 1), dtype=np.int8)
+
+    cost[0, 0] = 0
+    first, last = 1, 0  # the rows of the current anti-diagonal within the band
+    for d in range(2, N + M + 1):
+        while first <= N and first + hi[first - 1] < d:
+            first += 1
+        while last < N and last + 1 + lo[last] <= d:
+            last += 1
+
+        current, previous, before = cost[d % 3], cost[(d - 1) % 3], cost[(d - 2) % 3]
+        current[first - 1] = np.inf
+        current[last + 1] = np.inf
+        for i in numba.prange(first, last + 1):
+            c0 = before[i - 1]
+            c1 = previous[i - 1]
+            c2 = previous[i]
+
+            if c0 < c1 and c0 < c2:
+                c, t = c0, 0
+            elif c1 < c0 and c1 < c2:
+                c, t = c1, 1
+            else:
+                c, t = c2, 2
+
+            current[i] = x[i - 1, d - i - 1] + c
+            trace[i, d - i] = t
+
+    return trace
+
+
+# numba keys its on-disk cache by the Python function, so that only one of the two can be cached
+dtw_wavefront = numba.jit(nopython=True, nogil=True, cache=True)(_dtw_wavefront)
+dtw_wavefront_parallel = numba.jit(nopython=True, parallel=True)(_dtw_wavefront)
+
+# the minimum number of cells in an anti-diagonal for the parallel sweep to pay off
+PARALLEL_DTW_CELLS = 256
+
+
+def sakoe_chiba_band(
+    center: np.ndarray, radius: float, num_columns: int
+) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    A Sakoe-Chiba band of the given radius around the expected column of each row, as the first
+    and last allowed (1-indexed) columns, widened so that a warping path always exists
+    """
+    lo = np.floor(center - radius).astype(np.int64) + 1
+    hi = np.ceil(center + radius).astype(np.int64) + 1
+    lo = np.minimum.accumulate(np.clip(lo, 1, num_columns)[::-1])[::-1].copy()
+    hi = np.maximum.accumulate(np.clip(hi, 1, num_columns))
+    lo[0], hi[-1] = 1, num_columns
+
+    # every row must overlap with, or directly follow, the allowed columns of the previous row
+    hi[:-1] = np.maximum(hi[:-1], lo[1:] - 1)
+    hi = np.maximum.accumulate(np.maximum(hi, lo))
+    return lo, hi
+
+
+def dtw_cpu_banded(
+    x: np.ndarray, band: Optional[Tuple[np.ndarray, np.ndarray]] = None
+) -> np.ndarray:
+    """
+    DTW with an int8 trace, computing only the cells within the `band` from `sakoe_chiba_band`,
+    if any; barring exact ties, the path is the one of `dtw_cpu` whenever the band contains it.
+    Without a band, the anti-diagonal sweep only runs when it is parallel, as the column by
+    column loop of `dtw_cpu` is faster on a single thread.
+    """
+    N, M = x.shape
+    if band is None:
+        if min(N, M) < PARALLEL_DTW_CELLS or numba.get_num_threads() == 1:
+            return dtw_cpu(x)
+        band = np.ones(N, dtype=np.int64), np.full(N, M, dtype=np.int64)
+
+    lo, hi = band
+    cells = min(N, (hi - lo).max() + 1)
+    if cells >= PARALLEL_DTW_CELLS and numba.get_num_threads() > 1:
+        return backtrace(dtw_wavefront_parallel(x, lo, hi))
+    return backtrace(dtw_wavefront(x, lo, hi))
+
+
 def dtw_cuda(x, BLOCK_SIZE=1024):
     from .triton_ops import dtw_kernel
 
@@ -138,8 +282,10 @@ def dtw_cuda(x, BLOCK_SIZE=1024):
     return backtrace(trace.cpu().numpy())
 
 
-def dtw(x: torch.Tensor) -> np.ndarray:
-    if x.is_cuda:
+def dtw(
+    x: torch.Tensor, band: Optional[Tuple[np.ndarray, np.ndarray]] = None
+) -> np.ndarray:
+    if x.is_cuda and band is None:
         try:
             return dtw_cuda(x)
         except (RuntimeError, subprocess.CalledProcessError):
@@ -148,7 +294,7 @@ def dtw(x: torch.Tensor) -> np.ndarray:
                 "falling back to a slower DTW implementation..."
             )
 
-    return dtw_cpu(x.double().cpu().numpy())
+    return dtw_cpu_banded(x.double().cpu().numpy(), band)
 
 
 @dataclass
@@ -160,61 +306,106 @@ class WordTiming:
     probability: float
 
 
-def find_alignment(
+def alignment_forward(
     model: "Whisper",
     tokenizer: Tokenizer,
-    text_tokens: List[int],
+    text_tokens: List[List[int]],
     mel: torch.Tensor,
-    num_frames: int,
-    *,
-    medfilt_width: int = 7,
-    qk_scale: float = 1.0,
-) -> List[WordTiming]:
-    if len(text_tokens) == 0:
-        return []
-
+    audio_features: Optional[torch.Tensor] = None,
+) -> Tuple[List[torch.Tensor], List[List[float]]]:
+    """
+    Run the model on the text tokens of a batch of windows to retrieve, for each window, the
+    cross-attention weights of the alignment heads, shape = (n_alignment_heads, n_tokens,
+    n_audio_ctx), and the text token probabilities. The token sequences are padded at the end,
+    which the causal self-attention keeps from affecting the other positions. Only the decoder
+    runs when the encoded `mel`, shape = (n_batch, n_audio_ctx, n_audio_state), is given.
+    """
+    sequences = [
+        [*tokenizer.sot_sequence, tokenizer.no_timestamps, *tokens, tokenizer.eot]
+        for tokens in text_tokens
+    ]
+    length = max(len(sequence) for sequence in sequences)
     tokens = torch.tensor(
         [
-            *tokenizer.sot_sequence,
-            tokenizer.no_timestamps,
-            *text_tokens,
-            tokenizer.eot,
+            sequence + [tokenizer.eot] * (length - len(sequence))
+            for sequence in sequences
         ]
     ).to(model.device)
 
-    # install hooks on the cross attention layers to retrieve the attention weights
-    QKs = [None] * model.dims.n_text_layer
+    # install hooks on the cross attention layers to retrieve the alignment heads' weights
+    layer_heads = {}
+    for layer, head in model.alignment_heads.indices().T.tolist():
+        layer_heads.setdefault(layer, []).append(head)
+    QKs = {}
     hooks = [
-        block.cross_attn.register_forward_hook(
-            lambda _, ins, outs, index=i: QKs.__setitem__(index, outs[-1][0])
+        model.decoder.blocks[layer].cross_attn.register_forward_hook(
+            lambda _, ins, outs, layer=layer, heads=heads: QKs.__setitem__(
+                layer, outs[-1][:, heads]
+            )
         )
-        for i, block in enumerate(model.decoder.blocks)
+        for layer, heads in layer_heads.items()
     ]
 
     from .model import disable_sdpa
 
     with torch.no_grad(), disable_sdpa():
-        logits = model(mel.unsqueeze(0), tokens.unsqueeze(0))[0]
-        sampled_logits = logits[len(tokenizer.sot_sequence) :, : tokenizer.eot]
+        if audio_features is None:
+            audio_features = model.embed_audio(mel)
+        logits = model.logits(tokens, audio_features)
+        sampled_logits = logits[:, len(tokenizer.sot_sequence) :, : tokenizer.eot]
         token_probs = sampled_logits.softmax(dim=-1)
-        text_token_probs = token_probs[np.arange(len(text_tokens)), text_tokens]
-        text_token_probs = text_token_probs.tolist()
+        text_token_probs = [
+            token_probs[i, np.arange(len(t)), t].tolist()
+            for i, t in enumerate(text_tokens)
+        ]
 
     for hook in hooks:
         hook.remove()
 
-    # heads * tokens * frames
-    weights = torch.stack([QKs[_l][_h] for _l, _h in model.alignment_heads.indices().T])
-    weights = weights[:, :, : num_frames // 2]
+    # batch * heads * tokens * frames
+    weights = torch.cat([QKs[layer] for layer in sorted(QKs)], dim=1)
+    weights = [w[:, : len(sequence)] for w, sequence in zip(weights, sequences)]
+    return weights, text_token_probs
+
+
+def alignment_matrix(
+    alignment_weights: torch.Tensor,
+    num_frames: int,
+    *,
+    medfilt_width: int = 7,
+    qk_scale: float = 1.0,
+) -> torch.Tensor:
+    """Average the normalized and filtered weights of the alignment heads, shape = (tokens, frames)"""
+    weights = alignment_weights[:, :, : num_frames // 2]
     weights = (weights * qk_scale).softmax(dim=-1)
     std, mean = torch.std_mean(weights, dim=-2, keepdim=True, unbiased=False)
     weights = (weights - mean) / std
     weights = median_filter(weights, medfilt_width)
 
-    matrix = weights.mean(axis=0)
-    matrix = matrix[len(tokenizer.sot_sequence) : -1]
-    text_indices, time_indices = dtw(-matrix)
+    return weights.mean(axis=0)
+
+
+def alignment_band(
+    matrix_shape: Tuple[int, int],
+    dtw_band: Optional[float],
+    token_frames: Optional[np.ndarray] = None,
+) -> Optional[Tuple[np.ndarray, np.ndarray]]:
+    if dtw_band is None:
+        return None
 
+    num_rows, num_columns = matrix_shape
+    if token_frames is None:
+        token_frames = (np.arange(num_rows) + 0.5) * num_columns / num_rows
+    return sakoe_chiba_band(token_frames, dtw_band * TOKENS_PER_SECOND, num_columns)
+
+
+def word_timings(
+    tokenizer: Tokenizer,
+    text_tokens: List[int],
+    text_token_probs: List[float],
+    text_indices: np.ndarray,
+    time_indices: np.ndarray,
+) -> List[WordTiming]:
     words, word_tokens = tokenizer.split_to_word_tokens(text_tokens + [tokenizer.eot])
     if len(word_tokens) <= 1:
         # return on eot only
@@ -242,6 +433,55 @@ def find_alignment(
     ]
 
 
+def find_alignment(
+    model: "Whisper",
+    tokenizer: Tokenizer,
+    text_tokens: List[int],
+    mel: torch.Tensor,
+    num_frames: int,
+    *,
+    medfilt_width: int = 7,
+    qk_scale: float = 1.0,
+    alignment_weights: Optional[torch.Tensor] = None,
+    text_token_probs: Optional[List[float]] = None,
+    audio_features: Optional[torch.Tensor] = None,
+    dtw_band: Optional[float] = None,
+    token_frames: Optional[np.ndarray] = None,
+) -> List[WordTiming]:
+    """
+    The additional forward pass is skipped when the alignment weights of the queries predicting
+    each text token and the final EOT, shape = (n_alignment_heads, len(text_tokens) + 1,
+    n_audio_ctx), and the text token probabilities are given, e.g. as captured while decoding.
+    Otherwise, passing the `audio_features` of `mel` computed while decoding skips the encoder.
+
+    With `dtw_band`, the alignment of each token deviates at most this many seconds from its
+    expected frame in `token_frames`, which defaults to spreading the tokens evenly in time.
+    """
+    if len(text_tokens) == 0:
+        return []
+
+    text_rows = slice(None)
+    if alignment_weights is None or text_token_probs is None:
+        if audio_features is not None:
+            audio_features = audio_features.unsqueeze(0)
+        weights, probs = alignment_forward(
+            model, tokenizer, [text_tokens], mel.unsqueeze(0), audio_features
+        )
+        alignment_weights, text_token_probs = weights[0], probs[0]
+        text_rows = slice(len(tokenizer.sot_sequence), -1)
+
+    matrix = alignment_matrix(
+        alignment_weights, num_frames, medfilt_width=medfilt_width, qk_scale=qk_scale
+    )
+    matrix = matrix[text_rows]
+    band = alignment_band(matrix.shape, dtw_band, token_frames)
+    text_indices, time_indices = dtw(-matrix, band)
+
+    return word_timings(
+        tokenizer, text_tokens, text_token_probs, text_indices, time_indices
+    )
+
+
 def merge_punctuations(alignment: List[WordTiming], prepended: str, appended: str):
     # merge prepended punctuations
     i = len(alignment) - 2
@@ -276,6 +516,20 @@ def merge_punctuations(alignment: List[WordTiming], prepended: str, appended: st
         j += 1
 
 
+def segment_token_frames(
+    segments: List[dict], text_tokens_per_segment: List[List[int]]
+) -> np.ndarray:
+    """Expect the text tokens of each segment, and then EOT, to be spread between its timestamps"""
+    time_offset = segments[0]["seek"] * HOP_LENGTH / SAMPLE_RATE
+    token_frames = []
+    for segment, tokens in zip(segments, text_tokens_per_segment):
+        start = (segment["start"] - time_offset) * TOKENS_PER_SECOND
+        end = (segment["end"] - time_offset) * TOKENS_PER_SECOND
+        offsets = (np.arange(len(tokens)) + 0.5) / max(len(tokens), 1)
+        token_frames.extend(start + offsets * (end - start))
+    return np.array(token_frames + [end])
+
+
 def add_word_timestamps(
     *,
     segments: List[dict],
@@ -286,6 +540,9 @@ def add_word_timestamps(
     prepend_punctuations: str = "\"'“¿([{-",
     append_punctuations: str = "\"'.。,，!！?？:：”)]}、",
     last_speech_timestamp: float,
+    alignment_weights: Optional[torch.Tensor] = None,
+    token_probs: Optional[List[float]] = None,
+    alignment: Optional[List[WordTiming]] = None,
     **kwargs,
 ):
     if len(segments) == 0:
@@ -297,7 +554,25 @@ def add_word_timestamps(
     ]
 
     text_tokens = list(itertools.chain.from_iterable(text_tokens_per_segment))
-    alignment = find_alignment(model, tokenizer, text_tokens, mel, num_frames, **kwargs)
+    time_offset = segments[0]["seek"] * HOP_LENGTH / SAMPLE_RATE
+    if alignment is None:
+        if kwargs.get("dtw_band") is not None:
+            kwargs["token_frames"] = segment_token_frames(
+                segments, text_tokens_per_segment
+            )
+
+        if alignment_weights is not None and token_probs is not None:
+            # the weights and probabilities captured while decoding follow the decoded tokens,
+            # of which the tokens of the segments are a prefix; keep the rows of text tokens
+            tokens = list(itertools.chain.from_iterable(s["tokens"] for s in segments))
+            positions = [i for i, token in enumerate(tokens) if token < tokenizer.eot]
+            rows = positions + [positions[-1] + 1 if positions else 0]
+            kwargs["alignment_weights"] = alignment_weights[:, rows]
+            kwargs["text_token_probs"] = [token_probs[i] for i in positions]
+
+        alignment = find_alignment(
+            model, tokenizer, text_tokens, mel, num_frames, **kwargs
+        )
     word_durations = np.array([t.end - t.start for t in alignment])
     word_durations = word_durations[word_durations.nonzero()]
     median_duration = np.median(word_durations) if len(word_durations) > 0 else 0.0
@@ -318,7 +593,6 @@ def add_word_timestamps(
 
     merge_punctuations(alignment, prepend_punctuations, append_punctuations)
 
-    time_offset = segments[0]["seek"] * HOP_LENGTH / SAMPLE_RATE
     word_index = 0
 
     for segment, text_tokens in zip(segments, text_tokens_per_segment):
@@ -386,3 +660,108 @@ def add_word_timestamps(
             last_speech_timestamp = segment["end"]
 
         segment["words"] = words
+
+
+def _dtw_serial(x: np.ndarray, band: Tuple[np.ndarray, np.ndarray]) -> np.ndarray:
+    # also over a full band: a serial, GIL-releasing build of `dtw_cpu` is slower than this
+    # sweep, as `dtw_cpu` only owes its speed to being compiled with parallel=True
+    return backtrace(dtw_wavefront(x, *band))
+
+
+def add_word_timestamps_batch(
+    *,
+    windows: List[List[dict]],
+    model: "Whisper",
+    tokenizer: Tokenizer,
+    mel: torch.Tensor,
+    num_frames: List[int],
+    prepend_punctuations: str = "\"'“¿([{-",
+    append_punctuations: str = "\"'.。,，!！?？:：”)]}、",
+    batch_size: int = 8,
+    num_workers: Optional[int] = None,
+    medfilt_width: int = 7,
+    qk_scale: float = 1.0,
+    dtw_band: Optional[float] = None,
+):
+    """
+    Add word timestamps to the segments of consecutive windows at once, e.g. after transcribing a
+    long file. The alignment forward passes run on batches of `batch_size` windows, sliced from
+    the whole `mel` at the "seek" of their segments, and the DTW of every window runs in a pool of
+    `num_workers` threads, one per CPU by default, as its numba kernels release the GIL. The
+    segments are then adjusted in order, as if `add_word_timestamps` had been called after each
+    window.
+    """
+    from .audio import N_FRAMES, pad_or_trim
+
+    text_tokens_per_segment = [
+        [
+            [token for token in segment["tokens"] if token < tokenizer.eot]
+            for segment in w
+        ]
+        for w in windows
+    ]
+    text_tokens = [
+        list(itertools.chain.from_iterable(t)) for t in text_tokens_per_segment
+    ]
+    aligned = [k for k, tokens in enumerate(text_tokens) if len(tokens) > 0]
+    seeks = [segments[0]["seek"] for segments in windows]
+
+    matrices, bands, token_probs = [], [], []
+    for b in range(0, len(aligned), batch_size):
+        batch = aligned[b : b + batch_size]
+        mel_batch = torch.stack(
+            [
+                pad_or_trim(mel[:, seeks[k] : seeks[k] + num_frames[k]], N_FRAMES)
+                for k in batch
+            ]
+        ).to(model.device)
+        weights, probs = alignment_forward(
+            model, tokenizer, [text_tokens[k] for k in batch], mel_batch
+        )
+        for k, w in zip(batch, weights):
+            matrix = alignment_matrix(
+                w, num_frames[k], medfilt_width=medfilt_width, qk_scale=qk_scale
+            )
+            matrix = matrix[len(tokenizer.sot_sequence) : -1]
+            token_frames = None
+            if dtw_band is not None:
+                token_frames = segment_token_frames(
+                    windows[k], text_tokens_per_segment[k]
+                )
+            bands.append(alignment_band(matrix.shape, dtw_band, token_frames))
+            matrices.append(matrix)
+        token_probs.extend(probs)
+
+    num_workers = os.cpu_count() if num_workers is None else num_workers
+    if num_workers > 1 and len(matrices) > 1:
+        inputs = [(-matrix).double().cpu().numpy() for matrix in matrices]
+        for k, (N, M) in enumerate(x.shape for x in inputs):
+            if bands[k] is None:
+                bands[k] = np.ones(N, dtype=np.int64), np.full(N, M, dtype=np.int64)
+        with ThreadPoolExecutor(min(num_workers, len(inputs))) as executor:
+            paths = list(executor.map(_dtw_serial, inputs, bands))
+    else:
+        paths = [dtw(-matrix, band) for matrix, band in zip(matrices, bands)]
+
+    alignments = [[] for _ in windows]
+    for k, probs, (text_indices, time_indices) in zip(aligned, token_probs, paths):
+        alignments[k] = word_timings(
+            tokenizer, text_tokens[k], probs, text_indices, time_indices
+        )
+
+    last_speech_timestamp = 0.0
+    for segments, frames, alignment in zip(windows, num_frames, alignments):
+        add_word_timestamps(
+            segments=segments,
+            model=model,
+            tokenizer=tokenizer,
+            mel=None,
+            num_frames=frames,
+            prepend_punctuations=prepend_punctuations,
+            append_punctuations=append_punctuations,
+            last_speech_timestamp=last_speech_timestamp,
+            alignment=alignment,
+        )
+        last_word_end = get_end(segments)
+        if last_word_end is not None:
+            last_speech_timestamp = last_word_end
@@ -1,6 +1,8 @@
 import base64
+import mmap
 import os
 import string
+import struct
 from dataclasses import dataclass, field
 from functools import cached_property, lru_cache
 from typing import Dict, List, Optional, Tuple
@@ -128,6 +130,18 @@ TO_LANGUAGE_CODE = {
 }
 
 
+class TokenBytes(dict):
+    """The bytes of the tokens of an encoding, filled in as the tokens are looked up"""
+
+    def __init__(self, encoding: tiktoken.Encoding):
+        super().__init__()
+        self.encoding = encoding
+
+    def __missing__(self, token: int) -> bytes:
+        value = self[token] = self.encoding.decode_single_token_bytes(token)
+        return value
+
+
 @dataclass
 class Tokenizer:
     """A thin wrapper around `tiktoken` providing quick access to special tokens"""
@@ -161,16 +175,25 @@ class Tokenizer:
     def encode(self, text, **kwargs):
         return self.encoding.encode(text, **kwargs)
 
-    def decode(self, token_ids: List[int], **kwargs) -> str:
-        token_ids = [t for t in token_ids if t < self.timestamp_begin]
-        return self.encoding.decode(token_ids, **kwargs)
+    def decode(self, token_ids: List[int], errors: str = "replace") -> str:
+        token_bytes, timestamp_begin = self.token_bytes, self.timestamp_begin
+        data = b"".join([token_bytes[t] for t in token_ids if t < timestamp_begin])
+        return data.decode("utf-8", errors)
 
-    def decode_with_timestamps(self, token_ids: List[int], **kwargs) -> str:
+    def decode_with_timestamps(
+        self, token_ids: List[int], errors: str = "replace"
+    ) -> str:
         """
         Timestamp tokens are above other special tokens' id range and are ignored by `decode()`.
         This method decodes given tokens with timestamps tokens annotated, e.g. "<|1.08|>".
         """
-        return self.encoding.decode(token_ids, **kwargs)
+        token_bytes = self.token_bytes
+        return b"".join([token_bytes[t] for t in token_ids]).decode("utf-8", errors)
+
+    @cached_property
+    def token_bytes(self) -> Dict[int, bytes]:
+        """The bytes of each token, which are looked up in the encoding on first use"""
+        return TokenBytes(self.encoding)
 
     @cached_property
     def eot(self) -> int:
@@ -290,11 +313,13 @@ class Tokenizer:
         words = []
         word_tokens = []
         current_tokens = []
+        current_bytes = b""
         unicode_offset = 0
 
         for token in tokens:
             current_tokens.append(token)
-            decoded = self.decode_with_timestamps(current_tokens)
+            current_bytes += self.token_bytes[token]
+            decoded = current_bytes.decode("utf-8", errors="replace")
 
             if (
                 replacement_char not in decoded
@@ -304,6 +329,7 @@ class Tokenizer:
                 words.append(decoded)
                 word_tokens.append(current_tokens)
                 current_tokens = []
+                current_bytes = b""
                 unicode_offset += len(decoded)
 
         return words, word_tokens
@@ -327,13 +353,76 @@ class Tokenizer:
         return words, word_tokens
 
 
-@lru_cache(maxsize=None)
-def get_encoding(name: str = "gpt2", num_languages: int = 99):
-    vocab_path = os.path.join(os.path.dirname(__file__), "assets", f"{name}.tiktoken")
+RANKS_CACHE_MAGIC = b"WHISPER-RANKS-2\0"
+
+
+def load_ranks(vocab_path: str, cache_dir: Optional[str] = None) -> Dict[bytes, int]:
+    """
+    Read the mergeable ranks of a `.tiktoken` vocabulary, from a binary copy in `cache_dir` which
+    stores the token bytes back to back along with their offsets and ranks, so that it is read
+    without base64-decoding every line. The copy is made on first use, and made again when the
+    size or modification time of the vocabulary differs from those recorded in the copy; the ranks
+    are parsed from the vocabulary when the cache directory is not writable.
+    """
+    stat = os.stat(vocab_path)
+    source = (stat.st_size, stat.st_mtime_ns)
+
+    if cache_dir is None:
+        default = os.path.join(os.path.expanduser("~"), ".cache")
+        cache_dir = os.path.join(os.getenv("XDG_CACHE_HOME", default), "whisper")
+    cache_path = os.path.join(cache_dir, os.path.basename(vocab_path) + ".ranks")
+
+    # header: magic, size and mtime of the vocabulary, number of tokens, then uint32 ranks and
+    # offsets
+    header = struct.Struct(f"={len(RANKS_CACHE_MAGIC)}sQqI")
+    try:
+        with open(cache_path, "rb") as f, mmap.mmap(
+            f.fileno(), 0, access=mmap.ACCESS_READ
+        ) as cache:
+            magic, size, mtime_ns, n_tokens = header.unpack_from(cache)
+            if magic == RANKS_CACHE_MAGIC and (size, mtime_ns) == source:
+                start = header.size
+                ranks = memoryview(cache)[start : start + 4 * n_tokens].cast("I")
+                offsets = memoryview(cache)[
+                    start + 4 * n_tokens : start + 8 * n_tokens + 4
+                ].cast("I")
+                ranks, offsets = ranks.tolist(), offsets.tolist()
+                tokens = [cache[a:b] for a, b in zip(offsets, offsets[1:])]
+                return dict(zip(tokens, ranks))
+    except (OSError, ValueError, struct.error):
+        pass
+
+    with open(vocab_path, "rb") as f:
+        contents = f.read()
     ranks = {
         base64.b64decode(token): int(rank)
-        for token, rank in (line.split() for line in open(vocab_path) if line)
+        for token, rank in (line.split() for line in contents.splitlines() if line)
     }
+
+    offsets = [0]
+    for token in ranks:
+        offsets.append(offsets[-1] + len(token))
+    start = header.size + 8 * len(ranks) + 4
+    offsets = [start + offset for offset in offsets]
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        temp_path = f"{cache_path}.{os.getpid()}.tmp"
+        with open(temp_path, "wb") as f:
+            f.write(header.pack(RANKS_CACHE_MAGIC, *source, len(ranks)))
+            f.write(struct.pack(f"={len(ranks)}I", *ranks.values()))
+            f.write(struct.pack(f"={len(offsets)}I", *offsets))
+            f.write(b"".join(ranks))
+        os.replace(temp_path, cache_path)
+    except OSError:
+        pass
+
+    return ranks
+
+
+@lru_cache(maxsize=None)
+def get_encoding(name: str = "gpt2", num_languages: int = 99):
+    vocab_path = os.path.join(os.path.dirname(__file__), "assets", f"{name}.tiktoken")
+    ranks = load_ranks(vocab_path)
     n_vocab = len(ranks)
     special_tokens = {}
 
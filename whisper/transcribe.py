@@ -2,7 +2,8 @@ import argparse
 import os
 import traceback
 import warnings
-from typing import TYPE_CHECKING, List, Optional, Tuple, Union
+from concurrent.futures import Future
+from typing import TYPE_CHECKING, Dict, List, Optional, Tuple, Union
 
 import numpy as np
 import torch
@@ -14,11 +15,19 @@ from .audio import (
     N_FRAMES,
     N_SAMPLES,
     SAMPLE_RATE,
+    LogMelStream,
+    cached_log_mel_spectrogram,
     log_mel_spectrogram,
     pad_or_trim,
+    prefetch_audio,
+    speech_activity,
+)
+from .decoding import (
+    DecodingOptions,
+    DecodingResult,
+    DecodingTask,
+    detect_language_windows,
 )
-from .decoding import DecodingOptions, DecodingResult
-from .timing import add_word_timestamps
 from .tokenizer import LANGUAGES, TO_LANGUAGE_CODE, get_tokenizer
 from .utils import (
     exact_div,
@@ -52,6 +61,12 @@ def transcribe(
     append_punctuations: str = "\"'.。,，!！?？:：”)]}、",
     clip_timestamps: Union[str, List[float]] = "0",
     hallucination_silence_threshold: Optional[float] = None,
+    dtw_band: Optional[float] = None,
+    deferred_word_timestamps: bool = False,
+    language_detection_windows: int = 1,
+    language_detection_threshold: float = 0.9,
+    stream_audio: bool = False,
+    cache_mel: bool = False,
     **decode_options,
 ):
     """
@@ -119,6 +134,35 @@ def transcribe(
         When word_timestamps is True, skip silent periods longer than this threshold (in seconds)
         when a possible hallucination is detected
 
+    dtw_band: Optional[float]
+        When word_timestamps is True, align each word at most this many seconds away from where
+        the segment timestamps place it, which makes the alignment faster on long segments
+
+    deferred_word_timestamps: bool
+        When word_timestamps is True, extract the word-level timestamps of all windows after the
+        transcription, in batches and with the DTW on every CPU, instead of after each window.
+        The windows then follow the segment timestamps only, as without word timestamps, and
+        hallucination_silence_threshold is not supported
+
+    language_detection_windows: int
+        When the language is detected, use up to this many 30-second windows with the most speech
+        instead of only the first 30 seconds, and average their language probabilities
+
+    language_detection_threshold: float
+        Stop encoding windows for language detection once the average probability of the most
+        likely language is above this value
+
+    stream_audio: bool
+        When `audio` is a path, decode it in blocks and compute the Mel spectrogram of each window
+        when it is reached, instead of decoding the whole file, so that the memory does not grow
+        with the duration of the file. The file is then decoded at least twice
+
+    cache_mel: bool
+        When `audio` is a path, read its Mel spectrogram from the copy stored on disk by
+        `cached_log_mel_spectrogram` the first time the same file is transcribed, by any model
+        with the same number of Mel bins, in float16 for fp16 inference and float32 otherwise.
+        Takes precedence over `stream_audio`
+
     Returns
     -------
     A dictionary containing the resulting text ("text") and segment-level details ("segments"), and
@@ -136,20 +180,71 @@ def transcribe(
         decode_options["fp16"] = False
 
     # Pad 30-seconds of silence to the input audio, for slicing
-    mel = log_mel_spectrogram(audio, model.dims.n_mels, padding=N_SAMPLES)
+    if cache_mel and isinstance(audio, str):
+        mel = cached_log_mel_spectrogram(
+            audio, model.dims.n_mels, padding=N_SAMPLES, dtype=dtype
+        )
+    elif stream_audio and isinstance(audio, str):
+        mel = LogMelStream(audio, model.dims.n_mels, padding=N_SAMPLES, dtype=dtype)
+    else:
+        mel = log_mel_spectrogram(audio, model.dims.n_mels, padding=N_SAMPLES)
     content_frames = mel.shape[-1] - N_FRAMES
     content_duration = float(content_frames * HOP_LENGTH / SAMPLE_RATE)
 
+    if isinstance(clip_timestamps, str):
+        clip_timestamps = [
+            float(ts) for ts in (clip_timestamps.split(",") if clip_timestamps else [])
+        ]
+    seek_points: List[int] = [round(ts * FRAMES_PER_SECOND) for ts in clip_timestamps]
+    if len(seek_points) == 0:
+        seek_points.append(0)
+    if len(seek_points) % 2 == 1:
+        seek_points.append(content_frames)
+    seek_clips: List[Tuple[int, int]] = list(zip(seek_points[::2], seek_points[1::2]))
+
+    # the first window encoded by the language detection, to be decoded without encoding it again
+    first_window: Optional[Tuple[int, torch.Tensor]] = None
+
     if decode_options.get("language", None) is None:
         if not model.is_multilingual:
             decode_options["language"] = "en"
         else:
-            if verbose:
+            # the 30-second windows that the seek loop would decode, if no segment shifted them
+            windows = [
+                (start, min(start + N_FRAMES, clip_end, content_frames))
+                for clip_start, clip_end in seek_clips
+                for start in range(clip_start, min(clip_end, content_frames), N_FRAMES)
+            ] or [(0, 0)]
+            selected, weights = [0], [1.0]
+            if language_detection_windows > 1 and len(windows) > 1:
+                if verbose:
+                    print(
+                        f"Detecting language using up to {language_detection_windows} windows of 30 seconds. Use `--language` to specify the language"
+                    )
+                # the first window, and the others with the most speech
+                speech = speech_activity(mel, end=content_frames)
+                weights = [speech[a:b].sum().item() / N_FRAMES for a, b in windows]
+                ranked = sorted(range(1, len(windows)), key=lambda i: -weights[i])
+                ranked = [i for i in ranked if weights[i] > 0]
+                selected = [0] + ranked[: language_detection_windows - 1]
+            elif verbose:
                 print(
                     "Detecting language using up to the first 30 seconds. Use `--language` to specify the language"
                 )
-            mel_segment = pad_or_trim(mel, N_FRAMES).to(model.device).to(dtype)
-            _, probs = model.detect_language(mel_segment)
+            # sliced in order of time, so that a LogMelStream decodes the file only once
+            mel_windows = {
+                i: pad_or_trim(mel[:, slice(*windows[i])], N_FRAMES)
+                for i in sorted(selected)
+            }
+            probs, audio_features = detect_language_windows(
+                model,
+                [mel_windows[i].to(model.device).to(dtype) for i in selected],
+                [weights[i] for i in selected],
+                threshold=language_detection_threshold,
+            )
+            # speculative decoding needs the mel spectrogram for the draft model
+            if decode_options.get("draft_model") is None:
+                first_window = (windows[0][0], audio_features)
             decode_options["language"] = max(probs, key=probs.get)
             if verbose is not None:
                 print(
@@ -165,21 +260,25 @@ def transcribe(
         task=task,
     )
 
-    if isinstance(clip_timestamps, str):
-        clip_timestamps = [
-            float(ts) for ts in (clip_timestamps.split(",") if clip_timestamps else [])
-        ]
-    seek_points: List[int] = [round(ts * FRAMES_PER_SECOND) for ts in clip_timestamps]
-    if len(seek_points) == 0:
-        seek_points.append(0)
-    if len(seek_points) % 2 == 1:
-        seek_points.append(content_frames)
-    seek_clips: List[Tuple[int, int]] = list(zip(seek_points[::2], seek_points[1::2]))
-
     punctuation = "\"'“¿([{-\"'.。,，!！?？:：”)]}、"
 
     if word_timestamps and task == "translate":
         warnings.warn("Word-level timestamps on translations may not be reliable.")
+    if word_timestamps:
+        # imported on first use, as numba takes a while to import
+        from .timing import add_word_timestamps, add_word_timestamps_batch
+
+    deferred_word_timestamps = word_timestamps and deferred_word_timestamps
+    if deferred_word_timestamps and hallucination_silence_threshold is not None:
+        raise ValueError(
+            "hallucination_silence_threshold requires the word timestamps of each window "
+            "while transcribing, which is incompatible with deferred_word_timestamps"
+        )
+    deferred_windows: List[List[dict]] = []
+    deferred_num_frames: List[int] = []
+
+    # the decoding tasks are reused across windows, only swapping their prompt
+    decoding_tasks: Dict[float, DecodingTask] = {}
 
     def decode_with_fallback(segment: torch.Tensor) -> DecodingResult:
         temperatures = (
@@ -188,17 +287,23 @@ def transcribe(
         decode_result = None
 
         for t in temperatures:
-            kwargs = {**decode_options}
-            if t > 0:
-                # disable beam_size and patience when t > 0
-                kwargs.pop("beam_size", None)
-                kwargs.pop("patience", None)
-            else:
-                # disable best_of when t == 0
-                kwargs.pop("best_of", None)
+            if t not in decoding_tasks:
+                kwargs = {**decode_options}
+                if t > 0:
+                    # disable beam_size, patience and speculative decoding when t > 0
+                    kwargs.pop("beam_size", None)
+                    kwargs.pop("patience", None)
+                    kwargs.pop("draft_model", None)
+                else:
+                    # disable best_of when t == 0
+                    kwargs.pop("best_of", None)
+
+                options = DecodingOptions(**kwargs, temperature=t)
+                decoding_tasks[t] = DecodingTask(model, options)
 
-            options = DecodingOptions(**kwargs, temperature=t)
-            decode_result = model.decode(segment, options)
+            task = decoding_tasks[t]
+            task.set_prompt(decode_options["prompt"], decode_options.get("prefix"))
+            decode_result = task.run(segment.unsqueeze(0))[0]
 
             needs_fallback = False
             if (
@@ -206,6 +311,8 @@ def transcribe(
                 and decode_result.compression_ratio > compression_ratio_threshold
             ):
                 needs_fallback = True  # too repetitive
+            if decode_result.repetitive:
+                needs_fallback = True  # stopped early in a repetition loop
             if (
                 logprob_threshold is not None
                 and decode_result.avg_logprob < logprob_threshold
@@ -285,6 +392,12 @@ def transcribe(
             segment_duration = segment_size * HOP_LENGTH / SAMPLE_RATE
             mel_segment = pad_or_trim(mel_segment, N_FRAMES).to(model.device).to(dtype)
 
+            # the first window may have been encoded by the language detection already
+            encoder_input = mel_segment
+            if first_window is not None and first_window[0] == seek:
+                encoder_input = first_window[1]
+            first_window = None
+
             if carry_initial_prompt:
                 nignored = max(len(initial_prompt_tokens), prompt_reset_since)
                 remaining_prompt = all_tokens[nignored:][-remaining_prompt_length:]
@@ -292,7 +405,7 @@ def transcribe(
             else:
                 decode_options["prompt"] = all_tokens[prompt_reset_since:]
 
-            result: DecodingResult = decode_with_fallback(mel_segment)
+            result: DecodingResult = decode_with_fallback(encoder_input)
             tokens = torch.tensor(result.tokens)
 
             if no_speech_threshold is not None:
@@ -398,7 +511,7 @@ def transcribe(
                 )
                 seek += segment_size
 
-            if word_timestamps:
+            if word_timestamps and not deferred_word_timestamps:
                 add_word_timestamps(
                     segments=current_segments,
                     model=model,
@@ -408,6 +521,10 @@ def transcribe(
                     prepend_punctuations=prepend_punctuations,
                     append_punctuations=append_punctuations,
                     last_speech_timestamp=last_speech_timestamp,
+                    alignment_weights=result.alignment_weights,
+                    token_probs=result.token_probs,
+                    audio_features=result.audio_features,
+                    dtw_band=dtw_band,
                 )
 
                 if not single_timestamp_ending:
@@ -499,6 +616,9 @@ def transcribe(
             all_tokens.extend(
                 [token for segment in current_segments for token in segment["tokens"]]
             )
+            if deferred_word_timestamps and len(current_segments) > 0:
+                deferred_windows.append(all_segments[-len(current_segments) :])
+                deferred_num_frames.append(segment_size)
 
             if not condition_on_previous_text or result.temperature > 0.5:
                 # do not feed the prompt tokens if a high temperature was used
@@ -507,6 +627,18 @@ def transcribe(
             # update progress bar
             pbar.update(min(content_frames, seek) - previous_seek)
 
+    if deferred_word_timestamps:
+        add_word_timestamps_batch(
+            windows=deferred_windows,
+            model=model,
+            tokenizer=tokenizer,
+            mel=mel.to(dtype) if torch.is_tensor(mel) else mel,
+            num_frames=deferred_num_frames,
+            prepend_punctuations=prepend_punctuations,
+            append_punctuations=append_punctuations,
+            dtw_band=dtw_band,
+        )
+
     return dict(
         text=tokenizer.decode(all_tokens[len(initial_prompt_tokens) :]),
         segments=all_segments,
@@ -530,12 +662,15 @@ def cli():
     parser.add_argument("--model", default="turbo", type=valid_model_name, help="name of the Whisper model to use")
     parser.add_argument("--model_dir", type=str, default=None, help="the path to save model files; uses ~/.cache/whisper by default")
     parser.add_argument("--device", default="cuda" if torch.cuda.is_available() else "cpu", help="device to use for PyTorch inference")
+    parser.add_argument("--verify", type=str2bool, default=False, help="hash the downloaded model file again instead of trusting the checksum recorded when it was last verified")
     parser.add_argument("--output_dir", "-o", type=str, default=".", help="directory to save the outputs")
     parser.add_argument("--output_format", "-f", type=str, default="all", choices=["txt", "vtt", "srt", "tsv", "json", "all"], help="format of the output file; if not specified, all available formats will be produced")
     parser.add_argument("--verbose", type=str2bool, default=True, help="whether to print out the progress and debug messages")
 
     parser.add_argument("--task", type=str, default="transcribe", choices=["transcribe", "translate"], help="whether to perform X->X speech recognition ('transcribe') or X->English translation ('translate')")
     parser.add_argument("--language", type=str, default=None, choices=sorted(LANGUAGES.keys()) + sorted([k.title() for k in TO_LANGUAGE_CODE.keys()]), help="language spoken in the audio, specify None to perform language detection")
+    parser.add_argument("--language_detection_windows", type=int, default=1, help="number of 30-second windows with the most speech to detect the language from, instead of only the first 30 seconds")
+    parser.add_argument("--language_detection_threshold", type=float, default=0.9, help="stop encoding windows for language detection once the most likely language is above this probability")
 
     parser.add_argument("--temperature", type=float, default=0, help="temperature to use for sampling")
     parser.add_argument("--best_of", type=optional_int, default=5, help="number of candidates when sampling with non-zero temperature")
@@ -552,9 +687,11 @@ def cli():
 
     parser.add_argument("--temperature_increment_on_fallback", type=optional_float, default=0.2, help="temperature to increase when falling back when the decoding fails to meet either of the thresholds below")
     parser.add_argument("--compression_ratio_threshold", type=optional_float, default=2.4, help="if the gzip compression ratio is higher than this value, treat the decoding as failed")
+    parser.add_argument("--repetition_threshold", type=optional_int, default=None, help="stop decoding a window as soon as an n-gram repeats this many times in a row, and treat the decoding as failed")
     parser.add_argument("--logprob_threshold", type=optional_float, default=-1.0, help="if the average log probability is lower than this value, treat the decoding as failed")
     parser.add_argument("--no_speech_threshold", type=optional_float, default=0.6, help="if the probability of the <|nospeech|> token is higher than this value AND the decoding has failed due to `logprob_threshold`, consider the segment as silence")
     parser.add_argument("--word_timestamps", type=str2bool, default=False, help="(experimental) extract word-level timestamps and refine the results based on them")
+    parser.add_argument("--capture_alignment", type=str2bool, default=False, help="(requires --word_timestamps True) capture the cross-attention weights for word timestamps while decoding, instead of running an additional forward pass")
     parser.add_argument("--prepend_punctuations", type=str, default="\"\'“¿([{-", help="if word_timestamps is True, merge these punctuation symbols with the next word")
     parser.add_argument("--append_punctuations", type=str, default="\"\'.。,，!！?？:：”)]}、", help="if word_timestamps is True, merge these punctuation symbols with the previous word")
     parser.add_argument("--highlight_words", type=str2bool, default=False, help="(requires --word_timestamps True) underline each word as it is spoken in srt and vtt")
@@ -562,8 +699,13 @@ def cli():
     parser.add_argument("--max_line_count", type=optional_int, default=None, help="(requires --word_timestamps True) the maximum number of lines in a segment")
     parser.add_argument("--max_words_per_line", type=optional_int, default=None, help="(requires --word_timestamps True, no effect with --max_line_width) the maximum number of words in a segment")
     parser.add_argument("--threads", type=optional_int, default=0, help="number of threads used by torch for CPU inference; supercedes MKL_NUM_THREADS/OMP_NUM_THREADS")
+    parser.add_argument("--prefetch", type=int, default=1, help="number of audio files decoded by ffmpeg in the background ahead of the one being transcribed; 0 decodes each file only when its turn comes")
+    parser.add_argument("--stream_audio", type=str2bool, default=False, help="decode each file in blocks while it is transcribed, computing the Mel spectrogram of each window when it is reached, so that the memory does not grow with the duration of the file; --prefetch is ignored")
+    parser.add_argument("--cache_mel", type=str2bool, default=False, help="store the Mel spectrogram of each file under ~/.cache/whisper/mel, in float16 with --fp16 True and float32 otherwise, and read it from there when the same file is transcribed again, e.g. by another model; the least recently used are deleted above 2 GiB; --prefetch and --stream_audio are ignored")
     parser.add_argument("--clip_timestamps", type=str, default="0", help="comma-separated list start,end,start,end,... timestamps (in seconds) of clips to process, where the last end timestamp defaults to the end of the file")
     parser.add_argument("--hallucination_silence_threshold", type=optional_float, help="(requires --word_timestamps True) skip silent periods longer than this threshold (in seconds) when a possible hallucination is detected")
+    parser.add_argument("--deferred_word_timestamps", type=str2bool, default=False, help="(requires --word_timestamps True) extract the word timestamps of all windows after the transcription, in batches and with the DTW on every CPU")
+    parser.add_argument("--dtw_band", type=optional_float, default=None, help="(requires --word_timestamps True) align each word at most this many seconds away from where the segment timestamps place it")
     # fmt: on
 
     args = parser.parse_args().__dict__
@@ -572,6 +714,7 @@ def cli():
     output_dir: str = args.pop("output_dir")
     output_format: str = args.pop("output_format")
     device: str = args.pop("device")
+    verify: bool = args.pop("verify")
     os.makedirs(output_dir, exist_ok=True)
 
     if model_name.endswith(".en") and args["language"] not in {"en", "English"}:
@@ -592,7 +735,9 @@ def cli():
 
     from . import load_model
 
-    model = load_model(model_name, device=device, download_root=model_dir)
+    model = load_model(
+        model_name, device=device, download_root=model_dir, verify=verify
+    )
 
     writer = get_writer(output_format, output_dir)
     word_options = [
@@ -605,14 +750,28 @@ def cli():
         for option in word_options:
             if args[option]:
                 parser.error(f"--{option} requires --word_timestamps True")
+    if args["capture_alignment"] and not args["word_timestamps"]:
+        parser.error("--capture_alignment requires --word_timestamps True")
+    if args["deferred_word_timestamps"] and not args["word_timestamps"]:
+        parser.error("--deferred_word_timestamps requires --word_timestamps True")
+    if args["dtw_band"] is not None and not args["word_timestamps"]:
+        parser.error("--dtw_band requires --word_timestamps True")
     if args["max_line_count"] and not args["max_line_width"]:
         warnings.warn("--max_line_count has no effect without --max_line_width")
     if args["max_words_per_line"] and args["max_line_width"]:
         warnings.warn("--max_words_per_line has no effect with --max_line_width")
     writer_args = {arg: args.pop(arg) for arg in word_options}
-    for audio_path in args.pop("audio"):
+    audio_paths, prefetch = args.pop("audio"), args.pop("prefetch")
+    if args["stream_audio"] or args["cache_mel"]:
+        # transcribe decodes each file itself, in blocks or once for all models
+        audio_files = zip(audio_paths, audio_paths)
+    else:
+        audio_files = prefetch_audio(audio_paths, prefetch)
+    for audio_path, audio in audio_files:
         try:
-            result = transcribe(model, audio_path, temperature=temperature, **args)
+            if isinstance(audio, Future):
+                audio = audio.result()
+            result = transcribe(model, audio, temperature=temperature, **args)
             writer(result, audio_path, **writer_args)
         except Exception as e:
             traceback.print_exc()